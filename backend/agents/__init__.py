@@ -4,5 +4,6 @@ Contains planner and executor agents for query processing.
 """
 from agents.planner import PlannerAgent
 from agents.executor import ExecutorAgent
+from agents.registry import get_agents
 
-__all__ = ['PlannerAgent', 'ExecutorAgent']
+__all__ = ['PlannerAgent', 'ExecutorAgent', 'get_agents']
@@ -0,0 +1,94 @@
+"""
+Out-of-core execution of aggregate plans
+Datasets too large to load are queried chunk by chunk: every chunk is reduced
+to a partial aggregate (row count, sum and count per group) that is merged
+into a running total, so memory is bounded by one chunk plus the groups.
+Covers the template shapes: group-by sum/count/mean with top-N, value counts,
+monthly trends, and scatter plots (a random sample of the points as the
+result, the chart binned from all of them).
+"""
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from agents.code_templates import plan_shape
+from agents.rollup import MONTH, _months, finalize_partial, merge_partials, partial_aggregate, shape_result
+from utils.dataset_profile import DatasetProfile
+from utils.downsample import cell_centroids, coarsen, grid_cells, grid_side, point_budget, trendline_from_sums
+
+Batches = Callable[[List[str]], Iterator[pd.DataFrame]]
+
+
+def _scatter(shape: Dict, batches: Batches, profile: DatasetProfile) -> Tuple[pd.DataFrame, str]:
+    """A uniform random sample of the points, with the chart's points
+    grid-binned chunk by chunk on the columns' profiled ranges and its
+    trendline fitted over all of them from running sums (see downsample)"""
+    x_name, y_name = shape["x"], shape["y"]
+    budget = point_budget()
+    if profile.rows <= budget:
+        parts = [chunk.dropna() for chunk in batches([x_name, y_name])]
+        result = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(columns=[x_name, y_name])
+        return result, f"{x_name} vs {y_name}"
+
+    ranges = {c["name"]: c for c in profile.columns}
+    bounds = (float(ranges[x_name]["min"]), float(ranges[x_name]["max"]),
+              float(ranges[y_name]["min"]), float(ranges[y_name]["max"]))
+    side = grid_side(budget)
+    cells = None
+    # n, sum x, sum y, sum x*x, sum x*y
+    sums = np.zeros(5)
+    x_min, x_max = np.inf, -np.inf
+    # Every point gets a random key and the sample keeps the lowest budget
+    # keys seen so far (indexed by key); seeded so answers repeat
+    random = np.random.default_rng(0)
+    sample = None
+    for chunk in batches([x_name, y_name]):
+        chunk = chunk.dropna()
+        if chunk.empty:
+            continue
+        x, y = chunk[x_name].to_numpy(dtype=float), chunk[y_name].to_numpy(dtype=float)
+        cells = merge_partials(cells, grid_cells(x, y, bounds, side))
+        sums += (len(x), x.sum(), y.sum(), (x * x).sum(), (x * y).sum())
+        x_min, x_max = min(x_min, x.min()), max(x_max, x.max())
+        sample = pd.concat([sample, chunk.set_axis(random.random(len(chunk)))])
+        if len(sample) > budget:
+            sample = sample.iloc[np.argpartition(sample.index.to_numpy(), budget)[:budget]]
+    if cells is None:
+        return pd.DataFrame(columns=[x_name, y_name]), f"{x_name} vs {y_name}"
+    result = sample.sort_index().reset_index(drop=True)
+    result.attrs["total_rows"] = int(sums[0])
+    result.attrs["chart_points"] = cell_centroids(coarsen(cells, side, budget), x_name, y_name)
+    result.attrs["trendline"] = trendline_from_sums(*sums, x_min, x_max)
+    return result, f"{x_name} vs {y_name}, sampled"
+
+
+def run_chunked(plan: Dict, profile: DatasetProfile, batches: Batches) -> Optional[Tuple[pd.DataFrame, str]]:
+    """(result, description) for plan computed chunk by chunk, or None if its
+    shape can't be merged from partial aggregates
+
+    batches(columns) yields the dataset's chunks restricted to columns;
+    profile is the dataset's (dataset_store.load_profile).
+    """
+    shape = plan_shape(plan, profile.column_types)
+    if shape is None:
+        return None
+    if shape["kind"] == "scatter":
+        return _scatter(shape, batches, profile)
+
+    measures = [shape["measure"]] if shape.get("measure") else []
+    if shape["kind"] == "monthly":
+        keys = [MONTH] + ([shape["series"]] if shape["series"] else [])
+        columns = [shape["date"]] + keys[1:] + measures
+    else:
+        keys = [shape["dimension"]]
+        columns = keys + measures
+
+    total = None
+    for chunk in batches(columns):
+        if shape["kind"] == "monthly":
+            chunk = chunk.assign(**{MONTH: _months(chunk[shape["date"]])})
+        total = merge_partials(total, partial_aggregate(chunk, keys, measures))
+    if total is None:
+        return None
+    return shape_result(shape, finalize_partial(total, measures))
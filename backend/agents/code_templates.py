@@ -0,0 +1,154 @@
+"""
+Template-based pandas code generation
+Builds deterministic code for the standard plan shapes (group-by aggregate,
+top-N, value counts, monthly pivot, binned scatter) without an LLM call.
+"""
+import re
+from typing import Dict, Any, List, Optional
+
+from agents.rule_planner import column_kind
+
+# Plans mentioning these need reasoning the templates don't cover
+UNSUPPORTED_STEP_WORDS = re.compile(
+    r"\b(filter|where|only|exclud\w*|except|between|greater|less|above|below|negative|"
+    r"positive|unprofitable|percent\w*|ratio|margin|growth|rank\w*|merge|join|year \d{4}|\d{4}|"
+    r"max|maximum|min|minimum|median|unique|distinct|std|variance)\b"
+)
+_TOP_N = re.compile(r"\b(top|bottom|highest|lowest|largest|smallest)\s+(\d+)\b")
+AGGREGATIONS = {"sum": "sum", "mean": "mean", "count": "count"}
+
+
+def _plan_text(plan: Dict[str, Any]) -> str:
+    parts = [str(step) for step in plan.get("steps", [])] + [str(plan.get("reasoning", ""))]
+    return " ".join(parts).lower()
+
+
+def _aggregation(plan: Dict[str, Any], text: str) -> str:
+    if plan.get("aggregation") in AGGREGATIONS:
+        return AGGREGATIONS[plan["aggregation"]]
+    if re.search(r"\b(average|avg|mean)\b", text):
+        return "mean"
+    if re.search(r"\b(count|number of|how many)\b", text):
+        return "count"
+    return "sum"
+
+
+def _top_n(plan: Dict[str, Any], text: str):
+    """(n, ascending) from structured plan fields or the plan's own wording"""
+    if plan.get("top_n"):
+        return int(plan["top_n"]), plan.get("sort") == "asc"
+    match = _TOP_N.search(text)
+    if match:
+        return int(match.group(2)), match.group(1) in ("bottom", "lowest", "smallest")
+    return None, False
+
+
+def _groupby_code(dimension: str, measure: str, aggregation: str, top_n: Optional[int], ascending: bool) -> str:
+    lines = [
+        f"result = df.groupby({dimension!r}, observed=True)[{measure!r}].{aggregation}().reset_index()",
+        f"result = result.sort_values({measure!r}, ascending={ascending})",
+    ]
+    if top_n:
+        lines.append(f"result = result.head({top_n})")
+    return "\n".join(lines)
+
+
+def _value_counts_code(dimension: str, top_n: Optional[int], ascending: bool) -> str:
+    lines = [
+        f"result = df[{dimension!r}].value_counts(ascending={ascending}).reset_index()",
+        f"result.columns = [{dimension!r}, 'count']",
+    ]
+    if top_n:
+        lines.append(f"result = result.head({top_n})")
+    return "\n".join(lines)
+
+
+def _monthly_code(date_column: str, measure: str, series: Optional[str], aggregation: str) -> str:
+    # Derived columns go on a new frame so the source DataFrame is left untouched
+    lines = [
+        f"months = pd.to_datetime(df[{date_column!r}]).dt.to_period('M').astype(str)",
+        "data = df.assign(YearMonth=months)",
+    ]
+    if series:
+        lines += [
+            f"result = data.pivot_table(values={measure!r}, index='YearMonth', columns={series!r}, "
+            f"aggfunc={aggregation!r}, observed=True).reset_index()",
+            "result.columns.name = None",
+        ]
+    else:
+        lines.append(f"result = data.groupby('YearMonth')[{measure!r}].{aggregation}().reset_index()")
+    return "\n".join(lines)
+
+
+def _scatter_code(x_col: str, y_col: str) -> str:
+    # The real points; the chart bins them and fits the trendline
+    return f"result = df[[{x_col!r}, {y_col!r}]].dropna()"
+
+
+def plan_shape(plan: Dict[str, Any], column_types: Dict[str, str]) -> Optional[Dict[str, Any]]:
+    """The standard shape plan matches, as {"kind": ..., parameters}, else None
+
+    Kinds: "scatter" (x, y), "monthly" (date, measure, series, aggregation),
+    "groupby" (dimension, measure, aggregation, top_n, ascending) and
+    "value_counts" (dimension, top_n, ascending).
+    """
+    columns: List[str] = [str(c) for c in plan.get("columns_needed", [])]
+    if not columns or any(c not in column_types for c in columns):
+        return None
+
+    text = _plan_text(plan)
+    if plan.get("planner") != "rules" and UNSUPPORTED_STEP_WORDS.search(text):
+        return None
+
+    kinds = {c: column_kind(c, str(column_types[c])) for c in columns}
+    dimensions = [c for c in columns if kinds[c] == "dimension"]
+    measures = [c for c in columns if kinds[c] == "numeric"]
+    dates = [c for c in columns if kinds[c] == "date"]
+    chart_type = plan.get("chart_type", "table")
+    aggregation = _aggregation(plan, text)
+    top_n, ascending = _top_n(plan, text)
+
+    if chart_type == "scatter" and len(measures) == 2 and len(columns) == 2:
+        return {"kind": "scatter", "x": columns[0], "y": columns[1]}
+
+    if chart_type == "line" and len(dates) == 1 and len(measures) == 1 and len(dimensions) <= 1:
+        return {"kind": "monthly", "date": dates[0], "measure": measures[0],
+                "series": dimensions[0] if dimensions else None, "aggregation": aggregation}
+
+    if chart_type in ("bar", "pie", "table") and len(columns) == 2 and len(dimensions) == 1 and len(measures) == 1:
+        dimension = plan.get("group_by") or dimensions[0]
+        if aggregation == "count":
+            return {"kind": "value_counts", "dimension": dimension, "top_n": top_n, "ascending": ascending}
+        return {"kind": "groupby", "dimension": dimension, "measure": plan.get("measure") or measures[0],
+                "aggregation": aggregation, "top_n": top_n, "ascending": ascending}
+
+    if chart_type in ("bar", "pie", "table") and len(columns) == 1 and len(dimensions) == 1 \
+            and (aggregation == "count" or plan.get("planner") == "rules"):
+        return {"kind": "value_counts", "dimension": dimensions[0], "top_n": top_n, "ascending": ascending}
+
+    return None
+
+
+def generate_template_code(plan: Dict[str, Any], column_types: Dict[str, str]) -> Optional[str]:
+    """Pandas code for plan if it matches a standard shape, else None"""
+    shape = plan_shape(plan, column_types)
+    if shape is None:
+        return None
+
+    kind = shape["kind"]
+    if kind == "scatter":
+        code = _scatter_code(shape["x"], shape["y"])
+    elif kind == "monthly":
+        code = _monthly_code(shape["date"], shape["measure"], shape["series"], shape["aggregation"])
+    elif kind == "groupby":
+        code = _groupby_code(shape["dimension"], shape["measure"], shape["aggregation"],
+                             shape["top_n"], shape["ascending"])
+    else:
+        code = _value_counts_code(shape["dimension"], shape["top_n"], shape["ascending"])
+
+    # Never hand back something that doesn't even compile
+    try:
+        compile(code, "<template>", "exec")
+    except SyntaxError:
+        return None
+    return code
@@ -1,54 +1,168 @@
-import google.generativeai as genai
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
-import os
+import threading
 from dotenv import load_dotenv
 from typing import Dict, Any, Optional
 from utils.logger import get_logger
-import json
+from utils.genai_client import get_model
+from utils.cache import CodeCache
+from utils.dataset_profile import DatasetProfile
+from utils.downsample import grid_bin, least_squares, lttb_frame, point_budget
+from agents.code_templates import generate_template_code
+from agents.rollup import RollupCube
+from agents.chunked import run_chunked
+from agents.sql_backend import SqlStore
+from utils.dataset_store import iter_batches
+from utils.sandbox import get_pool
 
 load_dotenv()
 logger = get_logger()
 
+# Copy-on-write: generated code gets a lazy copy of the dataset, and any write
+# it makes copies just the touched columns, so cached (and memory-mapped) frames
+# are never mutated and nothing has to be copied up front. Set process-wide
+# because option_context isn't thread-safe.
+pd.set_option("mode.copy_on_write", True)
+
+# Plotly builds its templates and property validators lazily and not
+# thread-safely; concurrent first uses (job threads, threaded requests) fail
+# with "Invalid value". Figure construction is cheap, so it is serialized.
+_figure_lock = threading.Lock()
+
+# Low-cardinality text is stored as category (utils.dtype_optimizer), which
+# rejects new labels and string concatenation; code that trips over that is
+# run once more with those columns as plain text
+CATEGORIES_AS_TEXT = "df = df.astype({c: object for c in df.select_dtypes('category').columns})\n"
+
 class ExecutorAgent:
-    def __init__(self, model_name: str = 'gemini-2.5-flash'):
-        genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+    def __init__(self, model_name: str = 'gemini-2.5-flash', use_cache: bool = True):
         self.model_name = model_name
-        self.model = genai.GenerativeModel(model_name)
+        self.model = get_model(model_name)
+        self.use_cache = use_cache
+        self.code_cache = CodeCache() if use_cache else None
         print(f"[EXECUTOR]  Using model: {model_name}")
     
-    def execute_plan(self, plan: Dict[str, Any], df: pd.DataFrame) -> Dict[str, Any]:
+    def execute_plan(self, plan: Dict[str, Any], df: Optional[pd.DataFrame], code: Optional[str] = None,
+                     filepath: Optional[str] = None,
+                     profile: Optional[DatasetProfile] = None,
+                     rollups: Optional[RollupCube] = None,
+                     sql_store: Optional[SqlStore] = None,
+                     chart_format: str = "figure") -> Dict[str, Any]:
+        """Run plan against df; code is pre-generated pandas code (fused mode), if any
+        
+        With filepath (the file df was loaded from) the code runs in the
+        sandbox pool instead of this process. profile is df's precomputed
+        DatasetProfile; it is built from df when not given. Plans the
+        rollups cover are answered from them without touching df, and with
+        sql_store (the dataset uses the SQL engine) plans with a SQL form run
+        there instead of in pandas. chart_format is passed to build_chart.
+        """
+        result = self.run_code(plan, df, code, filepath, profile, rollups, sql_store)
+        if not result["success"]:
+            return result
+        result_df = result.pop("result_df")
+        result["chart"] = self.build_chart(result_df, plan, df, chart_format)
+        
+        # Log output
+        logger.log_executor_output(result)
+        return result
+    
+    def run_code(self, plan: Dict[str, Any], df: Optional[pd.DataFrame], code: Optional[str] = None,
+                 filepath: Optional[str] = None,
+                 profile: Optional[DatasetProfile] = None,
+                 rollups: Optional[RollupCube] = None,
+                 sql_store: Optional[SqlStore] = None) -> Dict[str, Any]:
+        """Produce and run the pandas code for plan, without building the chart
+        
+        On success the result carries the tabular result as "result_df" for
+        build_chart; streaming clients get the data before the chart exists.
+        "execution_path" says whether it came from the rollups, the SQL
+        engine, a chunked scan or a full scan. df is None for out-of-core datasets (see
+        dataset_store.is_out_of_core); filepath and profile are then required.
+        """
         # Log input
-        logger.log_executor_input(plan, df.shape)
+        logger.log_executor_input(plan, df.shape if df is not None else profile.shape)
         
         try:
-            # Build prompt for Gemini to generate pandas code
-            code_prompt = self._build_code_generation_prompt(plan, df)
+            if profile is None:
+                profile = DatasetProfile.from_frame(df)
+            
+            # Pre-aggregated answer: O(groups), no code at all
+            answered = rollups.answer(plan, profile.column_types) if rollups is not None else None
+            if answered is not None:
+                return self._aggregate_result(answered, "rollup")
+            
+            # Datasets stored for the SQL engine: one query, only the result is materialized
+            if sql_store is not None:
+                try:
+                    answered = sql_store.answer(plan, profile.column_types)
+                except Exception as e:
+                    logger.log_error("executor", f"SQL engine failed, using pandas: {e}")
+                    answered = None
+                if answered is not None:
+                    result_df, description, sql = answered
+                    return self._aggregate_result((result_df, description), "sql", query_used=sql)
             
-            # Generate pandas code using Gemini
-            response = self.model.generate_content(code_prompt)
-            code = self._extract_code(response.text)
+            # Out-of-core dataset: merge partial aggregates chunk by chunk
+            if df is None:
+                answered = run_chunked(plan, profile, lambda columns: iter_batches(filepath, columns))
+                if answered is None:
+                    raise ValueError(
+                        "This dataset is too large to load; only totals, averages and counts "
+                        "by a column or over time are supported"
+                    )
+                return self._aggregate_result(answered, "chunked")
+            
+            # Standard plan shapes get deterministic template code, no LLM call
+            fused_code = code
+            code = generate_template_code(plan, profile.column_types)
+            code_source = "template"
+            
+            # Then code that came with the plan from a fused planner call
+            if code is None and fused_code:
+                code = fused_code
+                code_source = "fused"
+            
+            # Otherwise reuse code already generated for the same plan and schema
+            fingerprint = profile.fingerprint
+            if code is None and self.use_cache and self.code_cache:
+                code = self.code_cache.get_code(plan, fingerprint)
+                code_source = "cache"
+            
+            if code is None:
+                code_source = "llm"
+                code = self._generate_code(plan, profile)
+            elif code_source == "cache":
+                print("[CACHE]  Using cached code")
             
             # Execute the generated code safely
-            result_data, result_df = self._execute_pandas_code(code, df)
+            try:
+                result_data, result_df = self._execute_pandas_code(code, df, filepath)
+            except Exception as e:
+                if code_source == "llm":
+                    raise
+                # Never serve cached code that failed again
+                if code_source == "cache" and self.use_cache and self.code_cache:
+                    self.code_cache.evict_code(plan, fingerprint)
+                logger.log_error("executor", f"{code_source.title()} code failed, regenerating: {e}")
+                code_source = "llm"
+                code = self._generate_code(plan, profile)
+                result_data, result_df = self._execute_pandas_code(code, df, filepath)
             
-            # Create visualization if needed
-            chart = None
-            if plan["chart_type"] != "table":
-                chart = self._create_visualization(result_df, plan, df)
+            if self.use_cache and self.code_cache and code_source in ("llm", "fused"):
+                self.code_cache.set_code(plan, fingerprint, code)
             
-            final_result = {
+            return {
                 "success": True,
                 "data": result_data,
-                "chart": chart,
-                "query_used": code
+                "result_df": result_df,
+                "chart": None,
+                "query_used": code,
+                "code_source": code_source,
+                "execution_path": "full_scan"
             }
             
-            # Log output
-            logger.log_executor_output(final_result)
-            return final_result
-            
         except Exception as e:
             logger.log_error("executor", str(e), {"plan_intent": plan.get("intent")})
             error_result = {
@@ -60,12 +174,51 @@ class ExecutorAgent:
             logger.log_executor_output(error_result)
             return error_result
     
-    def _build_code_generation_prompt(self, plan: Dict[str, Any], df: pd.DataFrame) -> str:
+    def _aggregate_result(self, answered, source: str, query_used: Optional[str] = None) -> Dict[str, Any]:
+        """run_code result for a (result, description) answered without generated code"""
+        result_df, description = answered
+        print(f"[{source.upper()}]  Answered from {source}: {description}")
+        result_data, result_df = self._format_result(result_df)
+        return {
+            "success": True,
+            "data": result_data,
+            "result_df": result_df,
+            "chart": None,
+            "query_used": query_used or f"# {source}: {description}",
+            "code_source": source,
+            "execution_path": source
+        }
+    
+    def build_chart(self, result_df: Optional[pd.DataFrame], plan: Dict[str, Any], df: Optional[pd.DataFrame],
+                    chart_format: str = "figure"):
+        """Chart for a run_code result, or None for tables and failures
+        
+        chart_format "figure" gives a Plotly figure; "spec" gives the compact
+        spec of _chart_spec, which clients render themselves, and never
+        touches Plotly.
+        """
+        if plan["chart_type"] == "table":
+            return None
+        if chart_format == "spec":
+            return self._chart_spec(result_df, plan, df)
+        with _figure_lock:
+            return self._create_visualization(result_df, plan, df)
+    
+    def _generate_code(self, plan: Dict[str, Any], profile: DatasetProfile) -> str:
+        """Ask Gemini for pandas code implementing plan"""
+        # Build prompt for Gemini to generate pandas code
+        code_prompt = self._build_code_generation_prompt(plan, profile)
+        
+        # Generate pandas code using Gemini
+        response = self.model.generate_content(code_prompt)
+        return self._extract_code(response.text)
+    
+    def _build_code_generation_prompt(self, plan: Dict[str, Any], profile: DatasetProfile) -> str:
         """Create prompt for Gemini to generate pandas code"""
         
-        # Get column info
-        columns_info = ", ".join([f"{col} ({dtype})" for col, dtype in df.dtypes.items()])
-        sample_data = df.head(3).to_string()
+        # Column info comes from the profile, computed once at upload
+        columns_info = "\n" + profile.describe()
+        sample_data = profile.sample_text
         chart_type = plan.get('chart_type', 'table')
         
         # Special handling for scatter plots
@@ -73,7 +226,7 @@ class ExecutorAgent:
             prompt = f"""Generate Python pandas code to prepare data for a SCATTER PLOT.
 
 DATASET INFO:
-- Shape: {df.shape[0]} rows, {df.shape[1]} columns
+- Shape: {profile.rows} rows, {len(profile.columns)} columns
 - Columns: {columns_info}
 
 SAMPLE DATA:
@@ -87,14 +240,12 @@ REQUIREMENTS FOR SCATTER PLOT:
 1. Return RAW DATA POINTS (not aggregated)
 2. Select only the two columns needed: {plan['columns_needed']}
 3. Remove missing values with .dropna()
-4. If more than 5000 rows, sample 5000 random rows
+4. Do not sample: all points are needed for the trendline, and large charts are reduced afterwards
 5. Store result in variable 'result'
 
 Example output:
 ```python
 result = df[{plan['columns_needed']}].dropna()
-if len(result) > 5000:
-    result = result.sample(5000, random_state=42)
 ```
 
 Generate the code now:"""
@@ -103,7 +254,7 @@ Generate the code now:"""
             prompt = f"""Generate Python pandas code for a MULTI-LINE TIME SERIES chart.
 
 DATASET INFO:
-- Shape: {df.shape[0]} rows, {df.shape[1]} columns
+- Shape: {profile.rows} rows, {len(profile.columns)} columns
 - Columns: {columns_info}
 
 SAMPLE DATA:
@@ -125,7 +276,7 @@ Example output:
 import pandas as pd
 df['Order Date'] = pd.to_datetime(df['Order Date'])
 df['YearMonth'] = df['Order Date'].dt.to_period('M').astype(str)
-result = df.pivot_table(values='Sales', index='YearMonth', columns='Ship Mode', aggfunc='sum').reset_index()
+result = df.pivot_table(values='Sales', index='YearMonth', columns='Ship Mode', aggfunc='sum', observed=True).reset_index()
 result.columns.name = None
 ```
 
@@ -134,7 +285,7 @@ Generate the code now:"""
             prompt = f"""Generate Python pandas code to analyze the following dataset.
 
 DATASET INFO:
-- Shape: {df.shape[0]} rows, {df.shape[1]} columns
+- Shape: {profile.rows} rows, {len(profile.columns)} columns
 - Columns: {columns_info}
 
 SAMPLE DATA:
@@ -155,6 +306,7 @@ REQUIREMENTS:
 6. ALWAYS aggregate data - never return individual row IDs or thousands of rows
 7. Keep code simple and efficient
 8. Handle missing values gracefully
+9. Pass observed=True to groupby/pivot_table so category columns only yield values that occur
 
 OUTPUT FORMAT:
 Return ONLY the Python code, wrapped in ```python markers.
@@ -179,30 +331,57 @@ Generate the code now:"""
         
         return code.strip()
     
-    def _execute_pandas_code(self, code: str, df: pd.DataFrame) -> tuple:
+    def _execute_pandas_code(self, code: str, df: pd.DataFrame, filepath: Optional[str] = None) -> tuple:
         """Safely execute generated pandas code"""
-        # Create safe execution context
-        exec_globals = {
-            'df': df,
-            'pd': pd,
-            'result': None
-        }
-        
-        # Execute code
-        exec(code, exec_globals)
-        
-        # Get result
-        result = exec_globals.get('result')
+        try:
+            return self._run_pandas_code(code, df, filepath)
+        except Exception as e:
+            # "Cannot setitem on a Categorical with a new category", "... 'Categorical' and 'str'"
+            if "Categorical" not in str(e):
+                raise
+            print("[EXECUTOR]  Retrying with category columns as text")
+            return self._run_pandas_code(CATEGORIES_AS_TEXT + code, df, filepath)
+    
+    def _run_pandas_code(self, code: str, df: pd.DataFrame, filepath: Optional[str] = None) -> tuple:
+        pool = get_pool() if filepath else None
+        if pool is not None:
+            # Separate process with a deadline and memory cap; it loads the same file
+            result = pool.run(filepath, code)
+        else:
+            # Create safe execution context
+            # New frame object so added/dropped columns stay local; under
+            # copy-on-write it shares data with the caller's frame until written
+            exec_globals = {
+                'df': df.copy(deep=False),
+                'pd': pd,
+                'result': None
+            }
+            
+            # Execute code
+            exec(code, exec_globals)
+            
+            # Get result
+            result = exec_globals.get('result')
+        return self._format_result(result)
+    
+    @staticmethod
+    def _format_result(result) -> tuple:
+        """(readable text, DataFrame for the chart or None) for a code result"""
         result_df = None
         
         # Convert to readable format
         if isinstance(result, pd.DataFrame):
-            result_df = result.copy()
-            if len(result) <= 20:
+            result_df = result
+            # Sampled scatter points (see _chart_data) say how many rows they stand for
+            total = result.attrs.get("total_rows", len(result))
+            if len(result) <= 20 and total == len(result):
                 formatted = result.to_markdown(index=False) if len(result.columns) <= 5 else result.to_string(index=False)
             else:
                 formatted = result.head(20).to_markdown(index=False) if len(result.columns) <= 5 else result.head(20).to_string(index=False)
-                formatted += f"\n\n*Showing top 20 of {len(result)} rows*"
+                if total == len(result):
+                    formatted += f"\n\n*Showing top 20 of {len(result)} rows*"
+                else:
+                    formatted += f"\n\n*Showing {min(len(result), 20)} of a random sample of {len(result)} of {total} rows*"
             return formatted, result_df
         elif isinstance(result, pd.Series):
             # Convert Series to DataFrame for visualization
@@ -216,6 +395,136 @@ Generate the code now:"""
             # Scalar or simple value
             return f"**Result:** {result:,.2f}" if isinstance(result, (int, float)) else str(result), None
     
+    def _chart_data(
+        self,
+        result_df: Optional[pd.DataFrame],
+        plan: Dict[str, Any],
+        df: Optional[pd.DataFrame]
+    ) -> Optional[pd.DataFrame]:
+        """The frame a chart plots: x in the first column, values in the rest
+        
+        Capped to CHART_POINT_BUDGET points: line series are thinned with
+        LTTB, scatter points grid-binned. Scatter frames carry their
+        least-squares trendline, fitted before binning, in attrs["trendline"].
+        A sampled scatter result (SQL engine, chunked scans) brings the
+        points and trendline computed from all rows in its attrs instead.
+        """
+        chart_type = plan.get("chart_type", "bar")
+        columns = plan.get("columns_needed", [])
+        
+        if chart_type == "scatter":
+            # For scatter, use the result_df which should contain raw data points
+            if result_df is not None and len(result_df.columns) >= 2:
+                points = result_df
+            # Fallback: use raw data from original df
+            elif df is None or len(columns) < 2:
+                return None
+            else:
+                points = df[columns[:2]].dropna()
+            if "chart_points" in points.attrs:
+                plot_data = points.attrs["chart_points"]
+                plot_data.attrs["trendline"] = points.attrs["trendline"]
+                return plot_data
+            if any(points[c].dtype.kind not in "iuf" for c in points.columns[:2]):
+                return points
+            plot_data = grid_bin(points.iloc[:, :2].dropna(), point_budget())
+            plot_data.attrs["trendline"] = least_squares(points)
+            return plot_data
+        
+        # Use result_df if available, otherwise fall back to aggregating from plan
+        if result_df is not None and not result_df.empty:
+            data = result_df
+        else:
+            if df is None or not columns or len(columns) < 1:
+                return None
+            
+            # Prepare data based on plan
+            if len(columns) >= 2:
+                data = df.groupby(columns[0], observed=True)[columns[1]].sum().reset_index()
+            else:
+                data = df[columns[0]].value_counts().reset_index()
+                data.columns = [columns[0], 'count']
+        
+        # Ensure we have at least 2 columns for visualization
+        if len(data.columns) < 2:
+            return None
+        
+        # Limit data for readability
+        y_col = data.columns[1]
+        if chart_type in ['bar', 'pie'] and len(data) > 20:
+            data = data.nlargest(20, y_col) if chart_type == 'bar' else data.nlargest(10, y_col)
+        elif chart_type == 'line':
+            data = lttb_frame(data, point_budget())
+        return data
+    
+    @staticmethod
+    def _spec_column(column: pd.Series):
+        """Values of a spec column: numbers stay arrays (sent as typed arrays), the rest as text"""
+        if column.dtype.kind in "iuf":
+            return column.to_numpy()
+        if column.dtype.kind == "M":
+            return column.astype(str).tolist()
+        return column.astype(object).where(column.notna(), None).tolist()
+    
+    def _chart_spec(
+        self,
+        result_df: Optional[pd.DataFrame],
+        plan: Dict[str, Any],
+        df: Optional[pd.DataFrame]
+    ) -> Optional[Dict[str, Any]]:
+        """Compact chart: the plotted columns plus what _create_visualization
+        would style them with, by reference to a named template
+        
+        {"format": "spec", "type", "template", "title", "height", "x", "y" (list
+        of value columns), "x_title", "y_title", "columns" (name -> values)};
+        scatter specs add "trendline" ({"x", "y"} ends of the least-squares line).
+        """
+        try:
+            chart_type = plan.get("chart_type", "bar")
+            if chart_type not in ("bar", "line", "scatter", "pie"):
+                return None
+            data = self._chart_data(result_df, plan, df)
+            if data is None:
+                return None
+            x_col = str(data.columns[0])
+            y_cols = [str(c) for c in data.columns[1:]] if chart_type == "line" else [str(data.columns[1])]
+            y_col = y_cols[0]
+            
+            # Same titles as the figures _create_visualization builds
+            x_title, y_title = x_col, y_col
+            if chart_type == "bar":
+                title = f"{y_col} by {x_col}"
+                x_title, y_title = x_col.replace('_', ' ').title(), y_col.replace('_', ' ').title()
+            elif chart_type == "line" and len(y_cols) > 1:
+                title = "Sales Trend by Ship Mode Over Time"
+                x_title, y_title = x_col.replace('_', ' ').title(), "Sales"
+            elif chart_type == "line":
+                title = f"{y_col} Trend Over {x_col}"
+            elif chart_type == "scatter":
+                title = f"{y_col} vs {x_col}"
+            else:
+                title = f"Distribution of {y_col} by {x_col}"
+            
+            spec = {
+                "format": "spec",
+                "type": chart_type,
+                "template": "plotly_white",
+                "title": title,
+                "height": 450,
+                "x": x_col,
+                "y": y_cols,
+                "x_title": x_title,
+                "y_title": y_title,
+                "columns": {str(c): self._spec_column(data[c]) for c in data.columns[:len(y_cols) + 1]}
+            }
+            if chart_type == "scatter" and data.attrs.get("trendline"):
+                spec["trendline"] = data.attrs["trendline"]
+            return spec
+            
+        except Exception as e:
+            logger.log_error("executor", f"Chart spec error: {e}", {"chart_type": plan.get("chart_type")})
+            return None
+    
     def _create_visualization(
         self, 
         result_df: Optional[pd.DataFrame], 
@@ -226,37 +535,12 @@ Generate the code now:"""
         
         try:
             chart_type = plan.get("chart_type", "bar")
-            
-            # Use result_df if available, otherwise fall back to aggregating from plan
-            if result_df is not None and not result_df.empty:
-                data = result_df.copy()
-            else:
-                # Fallback: use columns from plan
-                columns = plan.get("columns_needed", [])
-                if not columns or len(columns) < 1:
-                    return None
-                
-                # Prepare data based on plan
-                if len(columns) >= 2:
-                    data = df.groupby(columns[0])[columns[1]].sum().reset_index()
-                elif len(columns) == 1:
-                    data = df[columns[0]].value_counts().reset_index()
-                    data.columns = [columns[0], 'count']
-                else:
-                    return None
-            
-            # Ensure we have at least 2 columns for visualization
-            if len(data.columns) < 2:
+            data = self._chart_data(result_df, plan, df)
+            if data is None:
                 return None
-            
-            # Get column names
             x_col = data.columns[0]
             y_col = data.columns[1]
             
-            # Limit data for readability
-            if chart_type in ['bar', 'pie'] and len(data) > 20:
-                data = data.nlargest(20, y_col) if chart_type == 'bar' else data.nlargest(10, y_col)
-            
             # Create chart based on type
             if chart_type == "bar":
                 fig = px.bar(
@@ -304,30 +588,25 @@ Generate the code now:"""
                     )
                 
             elif chart_type == "scatter":
-                # For scatter, use the result_df which should contain raw data points
-                if result_df is not None and len(result_df.columns) >= 2:
-                    plot_data = result_df
-                    x_col = plot_data.columns[0]
-                    y_col = plot_data.columns[1]
-                else:
-                    # Fallback: use raw data from original df
-                    if len(columns) < 2:
-                        return None
-                    plot_data = df[columns[:2]].dropna()
-                    if len(plot_data) > 5000:
-                        plot_data = plot_data.sample(5000)
-                    x_col = columns[0]
-                    y_col = columns[1]
-                
                 fig = px.scatter(
-                    plot_data,
+                    data,
                     x=x_col,
                     y=y_col,
                     title=f"{y_col} vs {x_col}",
-                    trendline="ols",
                     opacity=0.6
                 )
                 fig.update_traces(marker=dict(size=5))
+                # Fitted over all points, not the binned ones drawn
+                trendline = data.attrs.get("trendline")
+                if trendline:
+                    fig.add_trace(go.Scatter(
+                        x=trendline["x"],
+                        y=trendline["y"],
+                        mode='lines',
+                        name="OLS trendline",
+                        showlegend=False,
+                        line=dict(color=fig.data[0].marker.color)
+                    ))
                 
             elif chart_type == "pie":
                 fig = px.pie(
@@ -1,41 +1,106 @@
-import google.generativeai as genai
 import json
 import os
+import re
 from dotenv import load_dotenv
-from typing import Dict, Any
+from typing import Dict, Any, Optional, Tuple
+from utils.dataset_profile import DatasetProfile
 from utils.logger import get_logger
+from utils.genai_client import get_model
 from utils.cache import QueryCache
+from agents.rule_planner import RulePlanner
 
 load_dotenv()
 logger = get_logger()
 
 class PlannerAgent:
     def __init__(self, model_name: str = 'gemini-2.5-flash', use_cache: bool = True):
-        genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
         self.model_name = model_name
-        self.model = genai.GenerativeModel(model_name)
+        self.model = get_model(model_name)
         self.use_cache = use_cache
         self.cache = QueryCache() if use_cache else None
+        self.rule_planner = RulePlanner(
+            confidence_threshold=float(os.getenv("RULE_PLANNER_THRESHOLD", "0.8"))
+        )
         print(f"[PLANNER]  Using model: {model_name}")
     
-    def create_plan(self, query: str, schema: str, history: str = "") -> Dict[str, Any]:
-        """Create execution plan with robust error handling"""
-        
-        # Check cache first
+    def _local_plan(self, query: str, profile: DatasetProfile) -> Optional[Dict[str, Any]]:
+        """Plan from the cache or the rule planner, without calling the model"""
+        # Check cache first (columns let the cache resolve column-name aliases)
         if self.use_cache and self.cache:
-            cached_plan = self.cache.get_plan(query, schema)
+            cached_plan = self.cache.get_plan(query, profile.schema, profile.column_names)
             if cached_plan:
                 logger.log_planner_output(cached_plan)
                 print("[CACHE]  Using cached plan")
                 return cached_plan
         
+        # Fast path: confident rule-based plan, no LLM call
+        if profile.columns:
+            rule_plan, confidence = self.rule_planner.plan(query, profile.column_types, profile.column_values)
+            if rule_plan is not None and confidence >= self.rule_planner.confidence_threshold:
+                logger.log_planner_output(rule_plan)
+                print(f"[PLANNER]  Rule-based plan (confidence {confidence})")
+                return rule_plan
+        return None
+    
+    @staticmethod
+    def _parse_plan_json(text: str) -> Dict[str, Any]:
+        """Parse a plan out of model output, repairing common JSON issues"""
+        # Aggressive JSON cleanup
+        text = text.replace("```json", "").replace("```", "").strip()
+        
+        # Extract JSON from response
+        if "{" in text and "}" in text:
+            start = text.find("{")
+            end = text.rfind("}") + 1
+            text = text[start:end]
+        
+        # Fix common JSON issues
+        
+        # First, handle escaped quotes within strings (from AI model)
+        # Replace \" with a placeholder, then fix quotes, then restore
+        text = text.replace('\\"', '<<<QUOTE>>>')
+        text = text.replace("'", '"')  # Single quotes to double quotes
+        text = text.replace('<<<QUOTE>>>', '\\"')  # Restore escaped quotes
+        
+        text = re.sub(r',(\s*[}\]])', r'\1', text)  # Remove trailing commas
+        text = re.sub(r'([{,]\s*)(\w+)(\s*:)', r'\1"\2"\3', text)  # Quote unquoted keys
+        
+        plan = json.loads(text)
+        
+        # Validate and add missing keys
+        required_keys = ["intent", "steps", "chart_type", "columns_needed", "reasoning"]
+        if not all(k in plan for k in required_keys):
+            # Add defaults for missing keys
+            if "intent" not in plan:
+                plan["intent"] = "visualization"
+            if "steps" not in plan:
+                plan["steps"] = ["Analyze data", "Create visualization"]
+            if "chart_type" not in plan:
+                plan["chart_type"] = "bar"
+            if "columns_needed" not in plan:
+                plan["columns_needed"] = []
+            if "reasoning" not in plan:
+                plan["reasoning"] = "Auto-generated plan"
+        return plan
+    
+    def create_plan(self, query: str, profile: DatasetProfile, history: str = "") -> Dict[str, Any]:
+        """Create execution plan with robust error handling
+        
+        The dataset profile keys the plan cache, feeds the local rule planner
+        (which answers simple questions without calling the model) and
+        describes the columns to the model.
+        """
+        local_plan = self._local_plan(query, profile)
+        if local_plan is not None:
+            return local_plan
+        
         # Log input
-        logger.log_planner_input(query, schema, history)
+        logger.log_planner_input(query, profile.schema, history)
         
         system_prompt = f"""Analyze query and return ONLY valid JSON (no extra text).
 
-DATASET COLUMNS:
-{schema}
+DATASET COLUMNS ({profile.rows} rows):
+{profile.describe()}
 
 QUERY: {query}
 
@@ -60,48 +125,11 @@ Return ONLY the JSON object now:"""
         try:
             response = self.model.generate_content(system_prompt)
             text = response.text.strip()
-            
-            # Aggressive JSON cleanup
-            text = text.replace("```json", "").replace("```", "").strip()
-            
-            # Extract JSON from response
-            if "{" in text and "}" in text:
-                start = text.find("{")
-                end = text.rfind("}") + 1
-                text = text[start:end]
-            
-            # Fix common JSON issues
-            import re
-            
-            # First, handle escaped quotes within strings (from AI model)
-            # Replace \" with a placeholder, then fix quotes, then restore
-            text = text.replace('\\"', '<<<QUOTE>>>')
-            text = text.replace("'", '"')  # Single quotes to double quotes
-            text = text.replace('<<<QUOTE>>>', '\\"')  # Restore escaped quotes
-            
-            text = re.sub(r',(\s*[}\]])', r'\1', text)  # Remove trailing commas
-            text = re.sub(r'([{,]\s*)(\w+)(\s*:)', r'\1"\2"\3', text)  # Quote unquoted keys
-            
-            plan = json.loads(text)
-            
-            # Validate and add missing keys
-            required_keys = ["intent", "steps", "chart_type", "columns_needed", "reasoning"]
-            if not all(k in plan for k in required_keys):
-                # Add defaults for missing keys
-                if "intent" not in plan:
-                    plan["intent"] = "visualization"
-                if "steps" not in plan:
-                    plan["steps"] = ["Analyze data", "Create visualization"]
-                if "chart_type" not in plan:
-                    plan["chart_type"] = "bar"
-                if "columns_needed" not in plan:
-                    plan["columns_needed"] = []
-                if "reasoning" not in plan:
-                    plan["reasoning"] = "Auto-generated plan"
+            plan = self._parse_plan_json(text)
             
             # Cache the plan
             if self.use_cache and self.cache:
-                self.cache.set_plan(query, schema, plan)
+                self.cache.set_plan(query, profile.schema, plan, profile.column_names)
             
             # Log output
             logger.log_planner_output(plan)
@@ -110,61 +138,8 @@ Return ONLY the JSON object now:"""
         except Exception as e:
             logger.log_error("planner", f"JSON parsing error: {e}", {"raw_text": text[:500] if 'text' in locals() else 'N/A'})
             
-            # Manual plan creation for common patterns
-            import re
-            
-            # Detect intent from query
-            query_lower = query.lower()
-            
-            # Check for explicit chart type mentions first
-            if "bar chart" in query_lower or "bar graph" in query_lower:
-                chart_type = "bar"
-                intent = "visualization"
-            elif "line chart" in query_lower or "line graph" in query_lower or "multi-line" in query_lower:
-                chart_type = "line"
-                intent = "trend"
-            elif "scatter plot" in query_lower or "scatter chart" in query_lower:
-                chart_type = "scatter"
-                intent = "comparison"
-            elif "pie chart" in query_lower or "pie graph" in query_lower:
-                chart_type = "pie"
-                intent = "visualization"
-            # Check for "chart" keyword without specific type - default to bar
-            elif " chart" in query_lower or "visualize" in query_lower or "show" in query_lower or "display" in query_lower:
-                chart_type = "bar"
-                intent = "visualization"
-            # Check for intent keywords
-            elif any(word in query_lower for word in ["top", "highest", "largest", "best", "lowest", "worst", "unprofitable"]):
-                chart_type = "bar"
-                intent = "visualization"
-            elif any(word in query_lower for word in ["trend", "over time", "change"]):
-                chart_type = "line"
-                intent = "trend"
-            elif any(word in query_lower for word in ["correlation", "relationship", "vs"]):
-                chart_type = "scatter"
-                intent = "comparison"
-            elif any(word in query_lower for word in ["distribution", "breakdown", "share"]):
-                chart_type = "pie"
-                intent = "visualization"
-            else:
-                chart_type = "table"
-                intent = "aggregation"
-            
-            # Extract column names from query
-            columns_needed = []
-            for col in ["Sub-Category", "Customer Name", "Profit", "Sales", "Discount", "Category", "Region", "State", "Ship Mode"]:
-                if col.lower() in query_lower or col.replace("-", " ").lower() in query_lower:
-                    columns_needed.append(col)
-            
-            # Fallback plan based on query analysis
-            fallback_plan = {
-                "intent": intent,
-                "steps": ["Parse query", "Extract relevant data", "Aggregate results", "Create visualization"],
-                "chart_type": chart_type,
-                "columns_needed": columns_needed if columns_needed else ["Profit", "Sales"],
-                "reasoning": f"Fallback plan for: {query[:100]}",
-                "complexity": "medium"
-            }
+            # Manual plan creation from the dataset's own columns
+            fallback_plan = self.rule_planner.fallback_plan(query, profile.column_types)
             logger.log_planner_output(fallback_plan)
             return fallback_plan
         except Exception as e:
@@ -178,4 +153,89 @@ Return ONLY the JSON object now:"""
                 "complexity": "simple"
             }
             logger.log_planner_output(fallback_plan)
-            return fallback_plan
\ No newline at end of file
+            return fallback_plan
+    
+    def create_plan_and_code(self, query: str, profile: DatasetProfile,
+                             history: str = "") -> Tuple[Dict[str, Any], Optional[str]]:
+        """Fused mode: plan and pandas code from a single model call
+        
+        Returns (plan, code). code is None when the plan came from the cache or
+        the rule planner, or the model's code block was missing; the executor
+        then produces code itself as in the two-step mode.
+        """
+        local_plan = self._local_plan(query, profile)
+        if local_plan is not None:
+            return local_plan, None
+        
+        logger.log_planner_input(query, profile.schema, history)
+        
+        fused_prompt = f"""Plan the analysis for the query AND write the pandas code for it.
+
+DATASET INFO:
+- Shape: {profile.rows} rows, {len(profile.columns)} columns
+- Columns:
+{profile.describe()}
+
+SAMPLE DATA:
+{profile.sample_text}
+
+QUERY: {query}
+
+Return EXACTLY two fenced blocks and nothing else.
+
+1. The plan:
+```json
+{{
+  "intent": "visualization",
+  "steps": ["step 1", "step 2"],
+  "chart_type": "bar",
+  "columns_needed": ["col1", "col2"],
+  "reasoning": "brief explanation",
+  "complexity": "medium"
+}}
+```
+
+2. The code:
+```python
+result = df.groupby('Category')['Sales'].sum().reset_index()
+```
+
+Plan rules:
+- Top N → chart_type="bar"
+- Trend → chart_type="line"
+- Correlation → chart_type="scatter"
+- Distribution → chart_type="pie"
+
+Code rules:
+1. Use the variable name 'df' for the DataFrame and store the final result in 'result'
+2. Do not modify df; derive new columns on a copy or with df.assign(...)
+3. For bar/pie charts return an aggregated DataFrame: category column then value column (max 50 rows)
+4. For line trends return time period first, then one column per series
+5. For scatter plots return the two raw numeric columns with dropna(); do not sample, large charts are reduced afterwards
+6. For calculations return a single numeric value or small DataFrame
+7. Pass observed=True to groupby/pivot_table so category columns only yield values that occur
+
+Return the two blocks now:"""
+
+        try:
+            response = self.model.generate_content(fused_prompt)
+            text = response.text.strip()
+            
+            # Split the code block out before the JSON repair touches its quotes
+            code = None
+            code_match = re.search(r"```python(.*?)```", text, re.DOTALL)
+            if code_match:
+                code = code_match.group(1).strip() or None
+                text = text[:code_match.start()] + text[code_match.end():]
+            
+            plan = self._parse_plan_json(text)
+            if self.use_cache and self.cache:
+                self.cache.set_plan(query, profile.schema, plan, profile.column_names)
+            logger.log_planner_output(plan)
+            return plan, code
+            
+        except Exception as e:
+            logger.log_error("planner", f"Fused response parsing error: {e}", {"raw_text": text[:500] if 'text' in locals() else 'N/A'})
+            fallback_plan = self.rule_planner.fallback_plan(query, profile.column_types)
+            logger.log_planner_output(fallback_plan)
+            return fallback_plan, None
@@ -0,0 +1,33 @@
+"""
+Process-wide registry of agents
+Agents are created lazily per model and shared across requests and threads,
+so the planner's plan cache and the model clients survive between queries.
+"""
+import threading
+from typing import Dict, Tuple
+
+from agents.planner import PlannerAgent
+from agents.executor import ExecutorAgent
+from utils.model_config import ModelConfig
+
+_lock = threading.Lock()
+_agents: Dict[str, Tuple[PlannerAgent, ExecutorAgent]] = {}
+
+
+def get_agents(model_name: str) -> Tuple[PlannerAgent, ExecutorAgent]:
+    """Get the shared (planner, executor) pair for a model from AVAILABLE_MODELS"""
+    if model_name not in ModelConfig.AVAILABLE_MODELS:
+        raise ValueError(f"Unknown model: {model_name}")
+
+    with _lock:
+        agents = _agents.get(model_name)
+        if agents is None:
+            agents = (PlannerAgent(model_name=model_name), ExecutorAgent(model_name=model_name))
+            _agents[model_name] = agents
+        return agents
+
+
+def clear():
+    """Drop all shared agents (and with them the in-process plan caches)"""
+    with _lock:
+        _agents.clear()
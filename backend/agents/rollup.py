@@ -0,0 +1,227 @@
+"""
+Materialized rollups for the common aggregate questions
+After upload, the sum, count and mean of every measure are pre-aggregated by
+each low-cardinality dimension, by month of each date column, and by month
+and dimension together. Plans whose shape (see code_templates.plan_shape) is
+covered are answered from these tables in O(groups) instead of a row scan.
+Out-of-core datasets are rolled up chunk by chunk from mergeable partial
+aggregates (see partial_aggregate), the same ones agents.chunked uses.
+"""
+import os
+import pickle
+import threading
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import pandas as pd
+
+from agents.code_templates import plan_shape
+from agents.rule_planner import column_kind
+from utils.dataset_profile import DatasetProfile
+
+ROLLUP_SUFFIX = ".rollup.pkl"
+MONTH = "YearMonth"
+AGGREGATIONS = ["sum", "count", "mean"]
+PARTIAL_AGGREGATIONS = ["sum", "count"]
+ROWS = "|rows"
+
+# (date column or None, dimension or None) -> aggregated table
+TableKey = Tuple[Optional[str], Optional[str]]
+
+_lock = threading.Lock()
+# path -> (source mtime, cube)
+_cubes: Dict[str, Tuple[int, "RollupCube"]] = {}
+
+
+def rollups_enabled() -> bool:
+    return os.getenv("ROLLUPS", "true").lower() not in ("0", "false", "no")
+
+
+def _months(column: pd.Series) -> pd.Series:
+    """Month labels exactly as the monthly template derives them"""
+    return pd.to_datetime(column).dt.to_period('M').astype(str)
+
+
+def partial_aggregate(frame: pd.DataFrame, keys: List[str], measures: List[str],
+                      aggregations: List[str] = PARTIAL_AGGREGATIONS) -> pd.DataFrame:
+    """Row count plus "<measure>|<aggregation>" columns, indexed by keys
+
+    With the default sum and count, partials of different chunks combine
+    with merge_partials.
+    """
+    grouped = frame.groupby(keys, observed=True)
+    table = pd.DataFrame({ROWS: grouped.size()})
+    if measures:
+        values = grouped[measures].agg(aggregations)
+        values.columns = [f"{measure}|{aggregation}" for measure, aggregation in values.columns]
+        table = table.join(values)
+    return table
+
+
+def merge_partials(total: Optional[pd.DataFrame], partial: pd.DataFrame) -> pd.DataFrame:
+    if total is None:
+        return partial
+    levels = list(range(partial.index.nlevels))
+    return pd.concat([total, partial]).groupby(level=levels).sum()
+
+
+def finalize_partial(table: pd.DataFrame, measures: List[str]) -> pd.DataFrame:
+    """Merged partial as a rollup table, with means derived from sum and count"""
+    table = table.copy()
+    for measure in measures:
+        table[f"{measure}|mean"] = table[f"{measure}|sum"] / table[f"{measure}|count"]
+    return table.reset_index()
+
+
+def table_key(shape: Dict) -> TableKey:
+    """Rollup table holding the groups a plan shape needs"""
+    if shape["kind"] == "monthly":
+        return shape["date"], shape["series"]
+    return None, shape["dimension"]
+
+
+def shape_result(shape: Dict, table: pd.DataFrame) -> Tuple[pd.DataFrame, str]:
+    """(result, description) for a plan shape from the rollup table of table_key(shape)
+
+    Results have the same columns and order as the template code for the
+    shape produces from the full dataset.
+    """
+    measure = shape.get("measure")
+    if shape["kind"] == "monthly":
+        values = f"{measure}|{shape['aggregation']}"
+        if shape["series"]:
+            result = table.pivot(index=MONTH, columns=shape["series"], values=values).reset_index()
+            result.columns.name = None
+        else:
+            result = pd.DataFrame({MONTH: table[MONTH], measure: table[values]})
+        by = f"month of {shape['date']}" + (f" and {shape['series']}" if shape["series"] else "")
+        return result, f"{shape['aggregation']} of {measure} by {by}"
+
+    dimension = shape["dimension"]
+    if shape["kind"] == "value_counts":
+        result = pd.DataFrame({dimension: table[dimension], "count": table[ROWS]})
+        result = result.sort_values("count", ascending=shape["ascending"], kind="stable")
+        description = f"row count by {dimension}"
+    else:
+        result = pd.DataFrame({dimension: table[dimension], measure: table[f"{measure}|{shape['aggregation']}"]})
+        result = result.sort_values(measure, ascending=shape["ascending"])
+        description = f"{shape['aggregation']} of {measure} by {dimension}"
+    if shape["top_n"]:
+        result = result.head(shape["top_n"])
+    return result, description
+
+
+class RollupCube:
+    """Pre-aggregated tables for one dataset"""
+
+    def __init__(self, tables: Dict[TableKey, pd.DataFrame], measures: List[str]):
+        self.tables = tables
+        self.measures = measures
+
+    @staticmethod
+    def _columns(profile: DatasetProfile, max_cardinality: Optional[int]):
+        """(dimensions, measures, dates) to roll up"""
+        if max_cardinality is None:
+            max_cardinality = int(os.getenv("ROLLUP_MAX_CARDINALITY", "100"))
+        kinds = {c["name"]: column_kind(c["name"], c["dtype"]) for c in profile.columns}
+        dimensions = [c["name"] for c in profile.columns
+                      if kinds[c["name"]] == "dimension" and c["distinct"] <= max_cardinality]
+        measures = [name for name, kind in kinds.items() if kind == "numeric"]
+        dates = [name for name, kind in kinds.items() if kind == "date"]
+        return dimensions, measures, dates
+
+    @classmethod
+    def build(cls, df: pd.DataFrame, profile: DatasetProfile,
+              max_cardinality: Optional[int] = None) -> "RollupCube":
+        """Aggregate df by the dimensions its profile shows to be low-cardinality"""
+        dimensions, measures, dates = cls._columns(profile, max_cardinality)
+        tables: Dict[TableKey, pd.DataFrame] = {}
+        for dimension in dimensions:
+            tables[(None, dimension)] = partial_aggregate(df, [dimension], measures, AGGREGATIONS).reset_index()
+        for date in dates:
+            frame = df[dimensions + measures].assign(**{MONTH: _months(df[date])})
+            tables[(date, None)] = partial_aggregate(frame, [MONTH], measures, AGGREGATIONS).reset_index()
+            for dimension in dimensions:
+                tables[(date, dimension)] = partial_aggregate(frame, [MONTH, dimension], measures,
+                                                               AGGREGATIONS).reset_index()
+        return cls(tables, measures)
+
+    @classmethod
+    def build_chunked(cls, profile: DatasetProfile, batches: Callable[[List[str]], Iterator[pd.DataFrame]],
+                      max_cardinality: Optional[int] = None) -> "RollupCube":
+        """Same tables as build, from a dataset read chunk by chunk
+
+        batches(columns) yields the dataset's chunks restricted to columns.
+        Memory is bounded by one chunk plus the (low-cardinality) groups.
+        """
+        dimensions, measures, dates = cls._columns(profile, max_cardinality)
+        partials: Dict[TableKey, pd.DataFrame] = {}
+
+        def add(key: TableKey, frame: pd.DataFrame, keys: List[str]):
+            partials[key] = merge_partials(partials.get(key), partial_aggregate(frame, keys, measures))
+
+        for chunk in batches(dimensions + measures + dates):
+            for dimension in dimensions:
+                add((None, dimension), chunk, [dimension])
+            for date in dates:
+                frame = chunk[dimensions + measures].assign(**{MONTH: _months(chunk[date])})
+                add((date, None), frame, [MONTH])
+                for dimension in dimensions:
+                    add((date, dimension), frame, [MONTH, dimension])
+        return cls({key: finalize_partial(table, measures) for key, table in partials.items()}, measures)
+
+    def answer(self, plan: Dict, column_types: Dict[str, str]) -> Optional[Tuple[pd.DataFrame, str]]:
+        """(result, description) for plan from the rollups, or None if they don't cover it"""
+        shape = plan_shape(plan, column_types)
+        if shape is None or shape["kind"] == "scatter":
+            return None
+        if shape.get("measure") is not None and shape["measure"] not in self.measures:
+            return None
+        table = self.tables.get(table_key(shape))
+        if table is None:
+            return None
+        return shape_result(shape, table)
+
+    def get_stats(self):
+        return {
+            "tables": len(self.tables),
+            "groups": int(sum(len(table) for table in self.tables.values())),
+            "bytes": int(sum(table.memory_usage(deep=True).sum() for table in self.tables.values()))
+        }
+
+
+def rollup_path(filepath: str) -> str:
+    """Location of the rollup sidecar for an uploaded file"""
+    return filepath + ROLLUP_SUFFIX
+
+
+def save_rollups(filepath: str, cube: RollupCube):
+    """Write the rollup sidecar atomically and remember the cube in this process"""
+    target = rollup_path(filepath)
+    temp = f"{target}.{os.getpid()}.tmp"
+    with open(temp, "wb") as f:
+        pickle.dump(cube, f, protocol=5)
+    os.replace(temp, target)
+    with _lock:
+        _cubes[os.path.abspath(filepath)] = (os.stat(filepath).st_mtime_ns, cube)
+
+
+def load_rollups(filepath: str) -> Optional[RollupCube]:
+    """The dataset's rollups if they are built and not older than the file, else None"""
+    path = os.path.abspath(filepath)
+    mtime = os.stat(path).st_mtime_ns
+    with _lock:
+        cached = _cubes.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    sidecar = rollup_path(path)
+    if not os.path.exists(sidecar) or os.stat(sidecar).st_mtime_ns < mtime:
+        return None
+    try:
+        with open(sidecar, "rb") as f:
+            cube = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+        return None
+    with _lock:
+        _cubes[path] = (mtime, cube)
+    return cube
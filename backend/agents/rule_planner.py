@@ -0,0 +1,309 @@
+"""
+Local rule-based planner
+Plans simple "X by Y" style questions from the dataset schema without an LLM call.
+"""
+import re
+from functools import lru_cache
+from typing import Dict, Any, Iterable, List, Optional, Tuple
+
+from utils.query_normalizer import canonicalize_query, normalize_text
+
+# Words that signal filters or reasoning the rules can't express
+COMPLEX_MARKERS = [
+    "where", "only", "excluding", "except", "without", "between", "greater", "less",
+    "above", "below", "more than", "fewer than", "why", "how does", "unprofitable",
+    "negative", "positive", "compare", "percentage", "percent", "growth", "rate",
+    "correlat", "predict", "forecast", "after", "before", "during", "last", "this year",
+    "margin", "ratio"
+]
+# Aggregations the plans can't express; these would silently become sums
+UNSUPPORTED_AGGREGATION_WORDS = [
+    "max", "maximum", "min", "minimum", "median", "unique", "distinct", "std",
+    "standard deviation", "variance"
+]
+GROUP_WORDS = ["by", "per", "for each", "across", "in each"]
+TIME_WORDS = ["over time", "trend", "monthly", "per month", "by month", "each month",
+              "by year", "per year", "yearly", "timeline", "time series"]
+MEAN_WORDS = ["average", "avg", "mean"]
+COUNT_WORDS = ["count", "number of", "how many", "frequency"]
+SHARE_WORDS = ["share", "distribution", "breakdown", "proportion", "pie"]
+SCATTER_WORDS = ["vs", "versus", "against", "scatter", "relationship"]
+
+
+def _phrase_pattern(phrases: List[str]) -> "re.Pattern":
+    """One compiled pattern matching any of the phrases as whole words"""
+    alternatives = "|".join(re.escape(p) for p in sorted(phrases, key=len, reverse=True))
+    return re.compile(rf"(?<!\w)(?:{alternatives})(?!\w)")
+
+
+_COMPLEX = _phrase_pattern(COMPLEX_MARKERS)
+_TIME = _phrase_pattern(TIME_WORDS)
+_MEAN = _phrase_pattern(MEAN_WORDS)
+_COUNT = _phrase_pattern(COUNT_WORDS)
+_SHARE = _phrase_pattern(SHARE_WORDS)
+_SCATTER = _phrase_pattern(SCATTER_WORDS)
+_UNSUPPORTED_AGGREGATION = _phrase_pattern(UNSUPPORTED_AGGREGATION_WORDS)
+_TOP_N = re.compile(r"\b(top|bottom|highest|lowest|best|worst|largest|smallest)\s+(\d+)\b")
+_SUPERLATIVE = re.compile(r"\b(top|bottom|highest|lowest|best|worst|largest|smallest)\b")
+_YEAR = re.compile(r"\b(19|20)\d{2}\b")
+
+
+def detect_chart_type(query_lower: str) -> Tuple[str, str]:
+    """Keyword detection of (chart_type, intent) for a lowercased query"""
+    # Check for explicit chart type mentions first
+    if "bar chart" in query_lower or "bar graph" in query_lower:
+        return "bar", "visualization"
+    if "line chart" in query_lower or "line graph" in query_lower or "multi-line" in query_lower:
+        return "line", "trend"
+    if "scatter plot" in query_lower or "scatter chart" in query_lower:
+        return "scatter", "comparison"
+    if "pie chart" in query_lower or "pie graph" in query_lower:
+        return "pie", "visualization"
+    # Check for "chart" keyword without specific type - default to bar
+    if " chart" in query_lower or "visualize" in query_lower or "show" in query_lower or "display" in query_lower:
+        return "bar", "visualization"
+    # Check for intent keywords
+    if any(word in query_lower for word in ["top", "highest", "largest", "best", "lowest", "worst", "unprofitable"]):
+        return "bar", "visualization"
+    if any(word in query_lower for word in ["trend", "over time", "change"]):
+        return "line", "trend"
+    if any(word in query_lower for word in ["correlation", "relationship", "vs"]):
+        return "scatter", "comparison"
+    if any(word in query_lower for word in ["distribution", "breakdown", "share"]):
+        return "pie", "visualization"
+    return "table", "aggregation"
+
+
+@lru_cache(maxsize=32)
+def _column_patterns(columns: Tuple[str, ...]) -> List[Tuple[str, List["re.Pattern"]]]:
+    """Compiled name variants per column; longest names first so 'sub category' wins over 'category'"""
+    patterns = []
+    for column in sorted(columns, key=lambda c: -len(normalize_text(c))):
+        form = normalize_text(column)
+        words = form.split()
+        variants = [form, form + "s", form + "es"]
+        # "customers" -> "Customer Name", "products" -> "Product ID"
+        if len(words) == 2 and words[1] in ("name", "id"):
+            variants += [words[0], words[0] + "s"]
+        patterns.append((column, [re.compile(rf"(?<!\w){re.escape(v)}(?!\w)") for v in variants]))
+    return patterns
+
+
+@lru_cache(maxsize=32)
+def _value_pattern(values: Tuple[str, ...]) -> Optional["re.Pattern"]:
+    """Pattern matching any of the (normalized) column values as whole words"""
+    return _phrase_pattern(list(values)) if values else None
+
+
+def mentions_value(query: str, column_values: Dict[str, Iterable[Any]]) -> bool:
+    """Whether query names a value of a text column ("for Technology", "in California")"""
+    columns = {normalize_text(str(column)) for column in column_values}
+    forms = set()
+    for values in column_values.values():
+        for value in values:
+            form = normalize_text(str(value)) if isinstance(value, str) else ""
+            # Very short values ("A", "NY") and column names match too much ordinary text
+            if len(form) >= 3 and form not in columns:
+                forms.add(form)
+    pattern = _value_pattern(tuple(sorted(forms)))
+    return pattern is not None and pattern.search(normalize_text(query)) is not None
+
+
+def column_kind(column: str, dtype: str) -> str:
+    """Classify a column as 'date', 'numeric' (a measure) or 'dimension'"""
+    dtype = dtype.lower()
+    words = normalize_text(column).split()
+    if "datetime" in dtype or "date" in words:
+        return "date"
+    # Numeric identifiers (Row ID, Postal Code) are labels, not measures
+    if dtype.startswith(("int", "uint", "float")) and not set(words) & {"id", "code", "zip", "postal", "number"}:
+        return "numeric"
+    return "dimension"
+
+
+class RulePlanner:
+    """Deterministic planner for common question shapes, with a confidence score"""
+
+    def __init__(self, confidence_threshold: float = 0.8):
+        self.confidence_threshold = confidence_threshold
+
+    @staticmethod
+    def _column_mentions(text: str, columns: List[str]) -> List[Tuple[int, str]]:
+        """(position, column) for each column mentioned in the canonical query"""
+        mentions = []
+        taken: List[Tuple[int, int]] = []
+        for column, patterns in _column_patterns(tuple(columns)):
+            for pattern in patterns:
+                match = pattern.search(text)
+                if match is None:
+                    continue
+                span = (match.start(), match.end())
+                if any(span[0] < end and start < span[1] for start, end in taken):
+                    continue
+                taken.append(span)
+                mentions.append((match.start(), column))
+                break
+        return sorted(mentions)
+
+    @staticmethod
+    def _grouped_column(text: str, mentions: List[Tuple[int, str]], candidates: List[str]) -> Optional[str]:
+        """Candidate column that directly follows a grouping word ("by region")"""
+        for position, column in mentions:
+            if column not in candidates:
+                continue
+            before = text[:position].rstrip()
+            if any(before.endswith(f" {word}") or before == word for word in GROUP_WORDS):
+                return column
+        return None
+
+    def plan(self, query: str, column_types: Dict[str, str],
+             column_values: Optional[Dict[str, List[Any]]] = None) -> Tuple[Optional[Dict[str, Any]], float]:
+        """Build a plan for query, returning (plan, confidence) or (None, 0.0)
+
+        column_values (DatasetProfile.column_values) lets questions that name
+        a column value, i.e. filter on it, fall below the threshold.
+        """
+        columns = list(column_types)
+        text = canonicalize_query(query, columns)
+        query_lower = query.lower()
+        mentions = self._column_mentions(text, columns)
+        mentioned = [column for _, column in mentions]
+
+        kinds = {column: column_kind(column, str(column_types[column])) for column in columns}
+        measures = [c for c in mentioned if kinds[c] == "numeric"]
+        dimensions = [c for c in mentioned if kinds[c] == "dimension"]
+        dates = [c for c in mentioned if kinds[c] == "date"]
+        all_dates = [c for c in columns if kinds[c] == "date"]
+
+        chart_type, intent = detect_chart_type(query_lower)
+        explicit_chart = "chart" in query_lower or "graph" in query_lower or "plot" in query_lower
+
+        confidence = 1.0
+        if _COMPLEX.search(text) or _YEAR.search(text):
+            confidence -= 0.5
+        if _UNSUPPORTED_AGGREGATION.search(text):
+            confidence -= 0.5
+        # Filters on a value ("sales by region for Technology") aren't expressed in plans
+        if column_values and mentions_value(query, column_values):
+            confidence -= 0.5
+
+        top_match = _TOP_N.search(text)
+        top_n = int(top_match.group(2)) if top_match else None
+        superlative = top_match or _SUPERLATIVE.search(text)
+        sort = "asc" if superlative and superlative.group(1) in ("bottom", "lowest", "worst", "smallest") else "desc"
+        # "lowest discount by category" may mean the lowest single value, not the lowest total
+        if superlative and top_n is None:
+            confidence -= 0.3
+
+        if _MEAN.search(text):
+            aggregation = "mean"
+        elif _COUNT.search(text):
+            aggregation = "count"
+        else:
+            aggregation = "sum"
+
+        plan: Optional[Dict[str, Any]] = None
+
+        # Scatter: two numeric columns compared against each other
+        if len(measures) >= 2 and (chart_type == "scatter" or _SCATTER.search(text)):
+            x_col, y_col = measures[0], measures[1]
+            plan = {
+                "intent": "comparison",
+                "steps": [f"Select {x_col} and {y_col}", "Drop missing values", "Plot raw points"],
+                "chart_type": "scatter",
+                "columns_needed": [x_col, y_col],
+                "reasoning": f"Relationship between {x_col} and {y_col}"
+            }
+            if len(measures) > 2 or dimensions:
+                confidence -= 0.3
+
+        # Trend: a measure over a date column, optionally split by one dimension
+        elif measures and (dates or (all_dates and _TIME.search(text))):
+            date_col = dates[0] if dates else all_dates[0]
+            measure = measures[0]
+            series = dimensions[0] if dimensions else None
+            columns_needed = [date_col, measure] + ([series] if series else [])
+            plan = {
+                "intent": "trend",
+                "steps": [f"Group {measure} by month of {date_col}" + (f" and {series}" if series else ""),
+                          f"{aggregation.title()} {measure}", "Plot as line chart"],
+                "chart_type": "line",
+                "columns_needed": columns_needed,
+                "reasoning": f"{measure} over time" + (f" split by {series}" if series else ""),
+                "date_column": date_col,
+                "series": series
+            }
+            if len(measures) > 1 or len(dimensions) > 1:
+                confidence -= 0.3
+            if not dates and not _TIME.search(text):
+                confidence -= 0.2
+
+        # Aggregate: measure grouped by a dimension ("sales by region")
+        elif measures and dimensions:
+            group_by = self._grouped_column(text, mentions, dimensions) or dimensions[0]
+            measure = measures[0]
+            if not explicit_chart or chart_type not in ("bar", "pie"):
+                chart_type = "pie" if _SHARE.search(text) else "bar"
+            plan = {
+                "intent": "visualization",
+                "steps": [f"Group by {group_by}", f"{aggregation.title()} {measure}"]
+                         + ([f"Keep {'top' if sort == 'desc' else 'bottom'} {top_n}"] if top_n else [])
+                         + [f"Plot as {chart_type} chart"],
+                "chart_type": chart_type,
+                "columns_needed": [group_by, measure],
+                "reasoning": f"{aggregation.title()} of {measure} by {group_by}",
+                "group_by": group_by,
+                "measure": measure
+            }
+            if self._grouped_column(text, mentions, dimensions) is None:
+                confidence -= 0.1
+            if len(measures) > 1 or len(dimensions) > 1:
+                confidence -= 0.3
+
+        # Counts: how often each value of a dimension occurs
+        elif dimensions and not measures and (aggregation == "count" or _SHARE.search(text)):
+            group_by = self._grouped_column(text, mentions, dimensions) or dimensions[0]
+            aggregation = "count"
+            if not explicit_chart or chart_type not in ("bar", "pie"):
+                chart_type = "pie" if _SHARE.search(text) else "bar"
+            plan = {
+                "intent": "visualization",
+                "steps": [f"Count rows per {group_by}", f"Plot as {chart_type} chart"],
+                "chart_type": chart_type,
+                "columns_needed": [group_by],
+                "reasoning": f"Number of records per {group_by}",
+                "group_by": group_by
+            }
+            if len(dimensions) > 1:
+                confidence -= 0.3
+
+        if plan is None:
+            return None, 0.0
+
+        plan.update({
+            "complexity": "simple",
+            "aggregation": aggregation,
+            "top_n": top_n,
+            "sort": sort,
+            "planner": "rules",
+            "confidence": round(max(confidence, 0.0), 2)
+        })
+        return plan, plan["confidence"]
+
+    def fallback_plan(self, query: str, column_types: Dict[str, str]) -> Dict[str, Any]:
+        """Best-effort plan when the LLM plan can't be used, whatever the confidence"""
+        plan, _ = self.plan(query, column_types)
+        if plan is not None:
+            return plan
+
+        chart_type, intent = detect_chart_type(query.lower())
+        text = canonicalize_query(query, list(column_types))
+        columns_needed = [column for _, column in self._column_mentions(text, list(column_types))]
+        return {
+            "intent": intent,
+            "steps": ["Parse query", "Extract relevant data", "Aggregate results", "Create visualization"],
+            "chart_type": chart_type,
+            "columns_needed": columns_needed,
+            "reasoning": f"Fallback plan for: {query[:100]}",
+            "complexity": "medium"
+        }
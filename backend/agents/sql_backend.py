@@ -0,0 +1,226 @@
+"""
+SQL execution backend for the standard plan shapes
+A dataset can be stored a second time as a SQLite table (next to the upload,
+like the columnar copy). Plans whose shape code_templates.plan_shape
+recognizes are then compiled to one SQL query: grouping, aggregation,
+null filtering, ordering and LIMIT all run inside the engine over the stored
+table, so only the (small) result is ever materialized as a DataFrame and
+the dataset never has to be loaded into the worker. No indexes are built:
+aggregate plans read every row anyway, and an index scan would add a row
+lookup per entry. Results have the same columns and order as the template
+code produces. Scatter plans take two queries: one for the ranges and the
+sums the trendline is fitted from, then one for the points. Over the point
+budget that is a random sample of them, and a third query grid-bins all
+of them on the finest grid for the chart (downsample.coarsen merges the
+cells down to the budget).
+"""
+import os
+import sqlite3
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import pandas as pd
+
+from agents.code_templates import plan_shape
+from agents.rollup import MONTH
+from utils.dataset_profile import DatasetProfile
+from utils.downsample import cell_centroids, coarsen, grid_side, point_budget, trendline_from_sums
+
+SQL_SUFFIX = ".sqlite3"
+TABLE = "data"
+ENGINES = ("pandas", "sql")
+# Rows per executemany call while loading
+INSERT_BATCH_ROWS = 50_000
+
+# TOTAL is SUM that gives 0 rather than NULL for all-null groups, like pandas
+_SQL_AGGREGATIONS = {"sum": "TOTAL", "mean": "AVG", "count": "COUNT"}
+
+
+def default_engine() -> str:
+    engine = os.getenv("EXECUTION_ENGINE", "pandas").lower()
+    return engine if engine in ENGINES else "pandas"
+
+
+def _quote(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _sql_type(dtype: str) -> str:
+    if dtype.startswith(("int", "uint")):
+        return "INTEGER"
+    if dtype.startswith("float"):
+        return "REAL"
+    return "TEXT"
+
+
+def _rows(chunk: pd.DataFrame) -> Iterator[tuple]:
+    """chunk's rows as Python values SQLite accepts; dates as ISO text"""
+    converted = {}
+    for name, column in chunk.items():
+        if column.dtype.kind == "M":
+            column = column.dt.strftime("%Y-%m-%d %H:%M:%S")
+        column = column.astype(object)
+        converted[name] = column.where(column.notna(), None)
+    return zip(*converted.values())
+
+
+def sql_path(filepath: str) -> str:
+    """Location of the SQL copy of an uploaded file"""
+    return filepath + SQL_SUFFIX
+
+
+def build_sql_store(filepath: str, profile: DatasetProfile,
+                    batches: Callable[[Optional[List[str]]], Iterator[pd.DataFrame]]) -> "SqlStore":
+    """Load the dataset into its SQLite copy, chunk by chunk
+
+    batches(columns) yields the dataset's chunks (dataset_store.iter_batches).
+    The file is written under a temporary name and swapped in when complete.
+    """
+    target = sql_path(filepath)
+    temp = f"{target}.{os.getpid()}.tmp"
+    if os.path.exists(temp):
+        os.remove(temp)
+    names = profile.column_names
+    columns = ", ".join(f"{_quote(c['name'])} {_sql_type(c['dtype'])}" for c in profile.columns)
+    insert = f"INSERT INTO {TABLE} VALUES ({', '.join('?' * len(names))})"
+
+    connection = sqlite3.connect(temp)
+    try:
+        connection.execute("PRAGMA journal_mode = OFF")
+        connection.execute("PRAGMA synchronous = OFF")
+        connection.execute(f"CREATE TABLE {TABLE} ({columns})")
+        for chunk in batches(None):
+            for start in range(0, len(chunk), INSERT_BATCH_ROWS):
+                connection.executemany(insert, _rows(chunk[names].iloc[start:start + INSERT_BATCH_ROWS]))
+        connection.commit()
+    finally:
+        connection.close()
+    os.replace(temp, target)
+    return SqlStore(target)
+
+
+def load_sql_store(filepath: str) -> Optional["SqlStore"]:
+    """The dataset's SQL copy if it was built and is not older than the file, else None"""
+    path = sql_path(filepath)
+    if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(filepath):
+        return None
+    return SqlStore(path)
+
+
+def _grid_cell(column: str, low: float, high: float, side: int) -> str:
+    """SQL for the grid column (or row) of column's values, as downsample.grid_cells assigns it"""
+    scale = float(side / (high - low)) if high > low else 0.0
+    return f"MIN({side - 1}, CAST(({column} - {float(low)!r}) * {scale!r} AS INTEGER))"
+
+
+def compile_plan(plan: Dict[str, Any], column_types: Dict[str, str]) -> Optional[Tuple[Dict[str, Any], str]]:
+    """(shape, SQL) for plan, or None if its shape has no SQL form (then the
+    pandas path answers it)
+
+    For scatter shapes the SQL is the statistics query SqlStore.answer bins with.
+    """
+    shape = plan_shape(plan, column_types)
+    if shape is None:
+        return None
+    kind = shape["kind"]
+
+    if kind == "scatter":
+        x, y = _quote(shape["x"]), _quote(shape["y"])
+        sql = (f"SELECT COUNT(*), MIN({x}), MAX({x}), MIN({y}), MAX({y}), "
+               f"TOTAL({x}), TOTAL({y}), TOTAL(1.0 * {x} * {x}), TOTAL(1.0 * {x} * {y}) "
+               f"FROM {TABLE} WHERE {x} IS NOT NULL AND {y} IS NOT NULL")
+        return shape, sql
+
+    if kind == "monthly":
+        # Only parsed dates are stored as ISO text strftime understands; text like
+        # "11/8/2016" (OPTIMIZE_DTYPES=false, unparsed formats) gives NULL months
+        if not str(column_types[shape["date"]]).startswith("datetime"):
+            return None
+        date, measure = _quote(shape["date"]), _quote(shape["measure"])
+        month = f"strftime('%Y-%m', {date})"
+        value = f"{_SQL_AGGREGATIONS[shape['aggregation']]}({measure})"
+        keys = [f"{month} AS {MONTH}"]
+        where = [f"{date} IS NOT NULL"]
+        if shape["series"]:
+            keys.append(_quote(shape["series"]))
+            where.append(f"{_quote(shape['series'])} IS NOT NULL")
+        positions = ", ".join(str(i + 1) for i in range(len(keys)))
+        sql = (f"SELECT {', '.join(keys)}, {value} AS {measure} FROM {TABLE} "
+               f"WHERE {' AND '.join(where)} GROUP BY {positions} ORDER BY {positions}")
+        return shape, sql
+
+    dimension = _quote(shape["dimension"])
+    order = "ASC" if shape["ascending"] else "DESC"
+    if kind == "value_counts":
+        value, alias = "COUNT(*)", _quote("count")
+    else:
+        measure = _quote(shape["measure"])
+        value = f"{_SQL_AGGREGATIONS[shape['aggregation']]}({measure})"
+        alias = measure
+    sql = (f"SELECT {dimension}, {value} AS {alias} FROM {TABLE} WHERE {dimension} IS NOT NULL "
+           f"GROUP BY {dimension} ORDER BY 2 {order}, 1")
+    if shape["top_n"]:
+        sql += f" LIMIT {int(shape['top_n'])}"
+    return shape, sql
+
+
+class SqlStore:
+    """Read-only access to a dataset's SQLite copy"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        # Serve reads from a memory mapping and let large sorts use helper threads
+        connection.execute("PRAGMA mmap_size = 1073741824")
+        connection.execute(f"PRAGMA threads = {min(4, os.cpu_count() or 1)}")
+        return connection
+
+    def query(self, sql: str) -> pd.DataFrame:
+        connection = self._connect()
+        try:
+            return pd.read_sql_query(sql, connection)
+        finally:
+            connection.close()
+
+    def answer(self, plan: Dict[str, Any], column_types: Dict[str, str]) -> Optional[Tuple[pd.DataFrame, str, str]]:
+        """(result, description, SQL) for plan, or None if it has no SQL form"""
+        compiled = compile_plan(plan, column_types)
+        if compiled is None:
+            return None
+        shape, sql = compiled
+        if shape["kind"] == "scatter":
+            return self._scatter(shape, sql)
+        result = self.query(sql)
+        if shape["kind"] == "monthly":
+            if shape["series"]:
+                result = result.pivot(index=MONTH, columns=shape["series"], values=shape["measure"]).reset_index()
+                result.columns.name = None
+            by = f"month of {shape['date']}" + (f" and {shape['series']}" if shape["series"] else "")
+            return result, f"{shape['aggregation']} of {shape['measure']} by {by}", sql
+        if shape["kind"] == "value_counts":
+            return result, f"row count by {shape['dimension']}", sql
+        return result, f"{shape['aggregation']} of {shape['measure']} by {shape['dimension']}", sql
+
+    def _scatter(self, shape: Dict[str, Any], stats_sql: str) -> Tuple[pd.DataFrame, str, str]:
+        """Scatter points; over the point budget a random sample of them, with
+        the chart's points grid-binned in the engine (see downsample)"""
+        x, y = _quote(shape["x"]), _quote(shape["y"])
+        n, x_min, x_max, y_min, y_max, sx, sy, sxx, sxy = self.query(stats_sql).iloc[0]
+        budget = point_budget()
+        where = f"{x} IS NOT NULL AND {y} IS NOT NULL"
+        if n <= budget:
+            sql = f"SELECT {x}, {y} FROM {TABLE} WHERE {where}"
+            return self.query(sql), f"{shape['x']} vs {shape['y']}", f"{stats_sql};\n{sql}"
+
+        sample_sql = f"SELECT {x}, {y} FROM {TABLE} WHERE {where} ORDER BY random() LIMIT {budget}"
+        side = grid_side(budget)
+        cell = f"{_grid_cell(x, x_min, x_max, side)} * {side} + {_grid_cell(y, y_min, y_max, side)}"
+        cells_sql = (f"SELECT {cell} AS cell, TOTAL({x}) AS x, TOTAL({y}) AS y, COUNT(*) AS count "
+                     f"FROM {TABLE} WHERE {where} GROUP BY 1 ORDER BY 1")
+        result = self.query(sample_sql)
+        result.attrs["total_rows"] = int(n)
+        cells = coarsen(self.query(cells_sql).set_index("cell"), side, budget)
+        result.attrs["chart_points"] = cell_centroids(cells, shape["x"], shape["y"])
+        result.attrs["trendline"] = trendline_from_sums(n, sx, sy, sxx, sxy, x_min, x_max)
+        return result, f"{shape['x']} vs {shape['y']}, sampled", f"{stats_sql};\n{sample_sql};\n{cells_sql}"
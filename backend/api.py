@@ -1,33 +1,56 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
-import pandas as pd
 import os
-from agents.planner import PlannerAgent
-from agents.executor import ExecutorAgent
+from agents.registry import get_agents
+from agents.rollup import RollupCube, load_rollups, rollups_enabled, save_rollups
+from agents.sql_backend import ENGINES, build_sql_store, default_engine, load_sql_store, sql_path
 from utils.memory_manager import ConversationMemory
+from utils.dataset_cache import DatasetCache
+from utils.dataset_store import (ingest, content_hash, head_rows, is_out_of_core, iter_batches,
+                                 load_dataset, load_profile)
+from utils.cache import ResponseCache
+from utils.job_queue import JobQueue, JobCancelled, QueueFullError
+from utils.genai_client import get_limiter
+from utils.single_flight import SingleFlight
+from utils.sandbox import get_pool
+from utils.response_encoding import (MIN_COMPRESS_BYTES, compress, encode_chart, encode_response,
+                                     negotiate_encoding)
+import queue
+import threading
+from utils.query_normalizer import canonicalize_query
 from utils.logger import get_logger
 from utils.model_config import ModelConfig
 from dotenv import load_dotenv
-import json
 from werkzeug.utils import secure_filename
 import tempfile
+import time
 
 load_dotenv()
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for frontend access
 
-# Initialize agents
+# Agents are created lazily per model and shared across requests
 default_model = ModelConfig.get_default_model()
-planner = PlannerAgent(model_name=default_model)
-executor = ExecutorAgent(model_name=default_model)
 memory = ConversationMemory()
 logger = get_logger(enable_file_logging=True)
+dataset_cache = DatasetCache()
+response_cache = ResponseCache()
+# Identical concurrent queries share one run; across workers only when the
+# response cache they publish to is shared (SQLite)
+single_flight = SingleFlight(path=getattr(response_cache.backend, "path", None), poll_interval=0.25)
 
 # Store uploaded files temporarily
 UPLOAD_FOLDER = tempfile.gettempdir()
 ALLOWED_EXTENSIONS = {'csv', 'xlsx', 'xls'}
 
+# "two_step": planner call then code call; "fused": plan and code in one model call
+QUERY_MODES = ('two_step', 'fused')
+DEFAULT_QUERY_MODE = os.getenv('QUERY_MODE', 'two_step')
+# "figure": full Plotly figure JSON; "spec": compact chart spec the client renders
+CHART_FORMATS = ('figure', 'spec')
+DEFAULT_CHART_FORMAT = os.getenv('CHART_FORMAT', 'figure')
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
@@ -58,6 +81,86 @@ def get_models():
     models = ModelConfig.get_available_models()
     return jsonify({"models": models}), 200
 
+def _warm_sandbox(filepath):
+    """Load a fresh upload into every sandbox worker in the background"""
+    pool = get_pool()
+    if pool is None:
+        return
+
+    def warm():
+        try:
+            pool.preload(filepath)
+        except Exception as e:
+            logger.log_error("api", f"Error preloading sandbox: {str(e)}")
+
+    threading.Thread(target=warm, daemon=True).start()
+
+_background_builds = set()
+# (kind, path) -> mtime of the file a build failed on; not retried until it changes
+_failed_builds = {}
+_build_lock = threading.Lock()
+
+def _build_in_background(kind, filepath, build):
+    """Run build(path) for a dataset in a background thread, at most one
+    per dataset and kind at a time"""
+    path = os.path.abspath(filepath)
+    key = (kind, path)
+    mtime = os.stat(path).st_mtime_ns
+    with _build_lock:
+        if key in _background_builds or _failed_builds.get(key) == mtime:
+            return
+        _background_builds.add(key)
+        _failed_builds.pop(key, None)
+
+    def run():
+        try:
+            build(path)
+        except Exception as e:
+            logger.log_error("api", f"Error building {kind}: {str(e)}")
+            with _build_lock:
+                _failed_builds[key] = mtime
+        finally:
+            with _build_lock:
+                _background_builds.discard(key)
+
+    threading.Thread(target=run, daemon=True).start()
+
+def _build_rollups(filepath, df=None):
+    """Materialize a dataset's rollups in the background; until they land
+    its queries take the full-scan path"""
+    if not rollups_enabled():
+        return
+
+    def build(path):
+        mtime = os.stat(path).st_mtime_ns
+        profile = load_profile(path)
+        if is_out_of_core(path):
+            cube = RollupCube.build_chunked(profile, lambda columns: iter_batches(path, columns))
+        else:
+            cube = RollupCube.build(df if df is not None else dataset_cache.get(path), profile)
+        # Skip if the file was replaced meanwhile; its own build follows
+        if os.stat(path).st_mtime_ns == mtime:
+            save_rollups(path, cube)
+
+    _build_in_background("rollups", filepath, build)
+
+def _build_sql_store(filepath):
+    """Load a dataset into its SQLite copy in the background; until it
+    lands its queries run in pandas"""
+    def build(path):
+        mtime = os.stat(path).st_mtime_ns
+        build_sql_store(path, load_profile(path), lambda columns: iter_batches(path, columns))
+        # Built from a file that was replaced meanwhile; its own build follows
+        if os.stat(path).st_mtime_ns != mtime:
+            os.remove(sql_path(path))
+
+    _build_in_background("SQL store", filepath, build)
+
+def _preview_records(df):
+    """Rows for the upload preview; parsed dates are shown as plain strings"""
+    dates = df.select_dtypes(include=["datetime", "datetimetz"]).columns
+    return df.astype({col: str for col in dates}).to_dict(orient='records')
+
 @app.route('/api/upload', methods=['POST'])
 def upload_file():
     """Upload and preview data file"""
@@ -72,25 +175,47 @@ def upload_file():
     if not allowed_file(file.filename):
         return jsonify({"error": "Invalid file type. Only CSV and XLSX allowed"}), 400
     
+    engine = request.form.get('engine', default_engine())
+    if engine not in ENGINES:
+        return jsonify({"error": f"Unknown engine: {engine}. Use one of: {', '.join(ENGINES)}"}), 400
+    
     try:
         filename = secure_filename(file.filename)
         filepath = os.path.join(UPLOAD_FOLDER, filename)
+        # Drop any stale copy of a previous upload with the same name
+        previous_hash = content_hash(filepath) if os.path.exists(filepath) else None
+        dataset_cache.invalidate(filepath)
         file.save(filepath)
+        if previous_hash and previous_hash != content_hash(filepath):
+            response_cache.invalidate_dataset(previous_hash)
         
-        # Read file
-        if filename.endswith('.csv'):
-            df = pd.read_csv(filepath)
+        # Parse once and store a columnar copy; queries use memory-mapped
+        # views of it, shared by all workers, instead of the parsed frame.
+        # Out-of-core files are converted chunk by chunk and never loaded.
+        df, memory_report = ingest(filepath)
+        profile = load_profile(filepath)
+        if df is not None:
+            dataset_cache.put(filepath, load_dataset(filepath))
+            _warm_sandbox(filepath)
+            head = df.head(10)
         else:
-            df = pd.read_excel(filepath)
+            head = head_rows(filepath, 10)
+        _build_rollups(filepath, df)
+        if engine == 'sql':
+            _build_sql_store(filepath)
         
         # Get preview
         preview = {
             "filename": filename,
-            "rows": len(df),
-            "columns": len(df.columns),
-            "column_names": df.columns.tolist(),
-            "preview": df.head(10).to_dict(orient='records'),
-            "dtypes": df.dtypes.astype(str).to_dict(),
+            "rows": profile.rows,
+            "columns": len(profile.columns),
+            "column_names": profile.column_names,
+            "preview": _preview_records(head),
+            "dtypes": profile.column_types,
+            "memory": memory_report,
+            "profile": profile.to_dict(),
+            "out_of_core": df is None,
+            "engine": engine,
             "filepath": filepath  # Store for later use
         }
         
@@ -100,103 +225,282 @@ def upload_file():
         logger.log_error("upload", f"Error uploading file: {str(e)}")
         return jsonify({"error": f"Error processing file: {str(e)}"}), 500
 
-@app.route('/api/query', methods=['POST'])
-def process_query():
-    """Process user query with agents"""
-    data = request.get_json()
-    
+def _validate_query(data):
+    """Checks on a query request that need neither the dataset nor its profile
+
+    Returns None or (error body, status code).
+    """
     if not data or 'query' not in data:
-        return jsonify({"error": "No query provided"}), 400
+        return {"error": "No query provided"}, 400
+
+    filepath = data.get('filepath')
+    model = data.get('model', default_model)
+    mode = data.get('mode', DEFAULT_QUERY_MODE)
+    chart_format = data.get('chart_format', DEFAULT_CHART_FORMAT)
+
+    if not filepath or not os.path.exists(filepath):
+        return {"error": "No data file uploaded or file not found"}, 400
+
+    if model not in ModelConfig.AVAILABLE_MODELS:
+        return {"error": f"Unknown model: {model}"}, 400
+
+    if mode not in QUERY_MODES:
+        return {"error": f"Unknown mode: {mode}. Use one of: {', '.join(QUERY_MODES)}"}, 400
+
+    if chart_format not in CHART_FORMATS:
+        return {
+            "error": f"Unknown chart_format: {chart_format}. Use one of: {', '.join(CHART_FORMATS)}"
+        }, 400
+
+    # Reject low-intent or meaningless queries early
+    if is_low_intent_query(data.get('query')):
+        return {
+            "success": False,
+            "error": "Please ask a specific question about your data.",
+            "suggestions": [
+                "What are the total sales by category?",
+                "Show me the top 10 customers by profit",
+                "Create a scatter plot of discount vs profit",
+                "Which products are unprofitable?"
+            ]
+        }, 400
+    return None
+
+def _prepare_query(data):
+    """Validate a query request and load its dataset
     
+    Returns (context, None) or (None, (error body, status code)). A context
+    holding "cached" is a stored response that can be served as-is.
+    """
+    started = time.perf_counter()
+    error = _validate_query(data)
+    if error is not None:
+        return None, error
+
     query = data.get('query')
     filepath = data.get('filepath')
     model = data.get('model', default_model)
+    mode = data.get('mode', DEFAULT_QUERY_MODE)
+    chart_format = data.get('chart_format', DEFAULT_CHART_FORMAT)
+    context = {"query": query, "filepath": filepath, "model": model, "mode": mode,
+               "chart_format": chart_format, "started": started}
 
-    if not filepath or not os.path.exists(filepath):
-        return jsonify({"error": "No data file uploaded or file not found"}), 400
+    # Serve repeated questions on unchanged data straight from the cache
+    context["dataset_hash"] = content_hash(filepath)
+    cached_response = response_cache.get_response(query, context["dataset_hash"], model, chart_format)
+    if cached_response is not None:
+        memory.add_exchange(query, str(cached_response.get('result', '')))
+        context["cached"] = cached_response
+        return context, None
+
+    # Precomputed at upload: validation needs no DataFrame
+    profile = load_profile(filepath)
+
+    # Check if the query references data context
+    query_lower = query.lower().strip()
+    has_data_keyword = any(keyword in query_lower for keyword in DATA_KEYWORDS)
+    has_column_name = any(col.lower() in query_lower for col in profile.column_names)
+
+    if not has_data_keyword and not has_column_name and len(query.split()) < 4:
+        return None, ({
+            "success": False,
+            "error": "Please mention specific columns or metrics from your data.",
+            "available_columns": profile.column_names[:10],
+            "suggestions": [
+                "What is the total sales?",
+                "Show profit by region",
+                "List top customers"
+            ]
+        }, 400)
+
+    # Read data (parsed once per worker, reused across queries); out-of-core
+    # datasets stay on disk and are aggregated chunk by chunk
+    context["df"] = None if is_out_of_core(filepath) else dataset_cache.get(filepath)
+    context["profile"] = profile
+    context["rollups"] = load_rollups(filepath) if rollups_enabled() else None
+    if context["rollups"] is None:
+        _build_rollups(filepath)
+    # Present only for datasets uploaded with "engine": "sql"
+    context["sql_store"] = load_sql_store(filepath)
+    return context, None
+
+def _elapsed_ms(since: float) -> float:
+    return round((time.perf_counter() - since) * 1000, 1)
+
+def _plan_query(context):
+    """Step 1: create the plan (and, in fused mode, the code in the same call)"""
+    planner, _ = get_agents(context["model"])
+    history = memory.get_context_string()
+    if context["mode"] == 'fused':
+        return planner.create_plan_and_code(context["query"], context["profile"], history)
+    return planner.create_plan(context["query"], context["profile"], history), None
+
+def _chart_to_json(chart_data):
+    """Plotly figure or chart spec to its JSON text, serialized once (see utils.response_encoding)"""
+    try:
+        return encode_chart(chart_data)
+    except Exception as chart_err:
+        logger.log_error("api", f"Error converting chart: {str(chart_err)}")
+        return None
+
+def _json_response(payload, status=200, headers=None):
+    """Response for a body that may hold chart JSON text, compressed when the
+    client accepts gzip or brotli"""
+    body = encode_response(payload)
+    encoding = negotiate_encoding(request.headers.get('Accept-Encoding', '')) \
+        if len(body) >= MIN_COMPRESS_BYTES else None
+    response = Response(compress(body, encoding), status=status, mimetype='application/json', headers=headers)
+    response.vary.add('Accept-Encoding')
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    return response
+
+def _store_response(context, plan, result, chart_data):
+    """Remember the exchange and cache successful responses"""
+    memory.add_exchange(context["query"], str(result.get('data', '')))
+    response = {
+        "success": result.get('success', False),
+        "plan": plan,
+        "result": result.get('data'),  # executor returns 'data' not 'result'
+        "chart": chart_data,
+        "error": result.get('error'),
+        "model_used": context["model"]
+    }
+    if response["success"]:
+        try:
+            response_cache.set_response(context["query"], context["dataset_hash"], context["model"], response,
+                                        context["chart_format"])
+        except Exception as cache_err:
+            logger.log_error("api", f"Error caching response: {str(cache_err)}")
+    return response
+
+def _sse(event: str, payload) -> str:
+    """One Server-Sent Events message"""
+    return f"event: {event}\ndata: {encode_response(payload).decode()}\n\n"
+
+def _answer_query(context, is_cancelled=lambda: False, emit=lambda event, payload: None):
+    """Run planner and executor for a prepared request; returns the response body
+
+    emit(event, payload) is called with the "plan", "data" and "chart" stream
+    events as each stage finishes.
+    """
+    # Step 1: Create plan
+    planning_started = time.perf_counter()
+    plan, code = _plan_query(context)
+    timings = {"planning_ms": _elapsed_ms(planning_started)}
+    if is_cancelled():
+        raise JobCancelled()
+    emit("plan", {"plan": plan, "mode": context["mode"]})
+    
+    # Step 2: Execute plan
+    _, current_executor = get_agents(context["model"])
+    execution_started = time.perf_counter()
+    result = current_executor.run_code(plan, context["df"], code=code, filepath=context["filepath"],
+                                      profile=context["profile"], rollups=context["rollups"],
+                                      sql_store=context["sql_store"])
+    timings["execution_ms"] = _elapsed_ms(execution_started)
+    if is_cancelled():
+        raise JobCancelled()
     
+    # Step 3: Chart
+    chart_data = None
+    if result["success"]:
+        emit("data", {"result": result.get("data"), "code_source": result.get("code_source"),
+                      "execution_path": result.get("execution_path")})
+        chart_started = time.perf_counter()
+        chart_data = _chart_to_json(current_executor.build_chart(result.pop("result_df"), plan, context["df"],
+                                                                 context["chart_format"]))
+        timings["chart_ms"] = _elapsed_ms(chart_started)
+        emit("chart", {"chart": chart_data})
+        logger.log_executor_output({**result, "chart": chart_data})
+    
+    response = _store_response(context, plan, result, chart_data)
+    timings["total_ms"] = _elapsed_ms(context["started"])
+    return {
+        **response,
+        "cached": False,
+        "mode": context["mode"],
+        "code_source": result.get('code_source'),
+        "execution_path": result.get('execution_path'),
+        "timings": timings
+    }
+
+def _cached_answer(context):
+    timings = {"total_ms": _elapsed_ms(context["started"])}
+    return {**context["cached"], "cached": True, "mode": context["mode"], "timings": timings}
+
+def _coalesced_answer(context, is_cancelled=lambda: False, emit=lambda event, payload: None):
+    """_answer_query, shared with identical requests already in flight
+
+    Only a request that runs the query itself emits its stages; a coalesced
+    one gets the whole body at once.
+    """
+    key = (f"{canonicalize_query(context['query'])}||{context['dataset_hash']}||{context['model']}"
+           f"||{context['chart_format']}")
+
+    def lookup():
+        cached = response_cache.get_response(context["query"], context["dataset_hash"], context["model"],
+                                             context["chart_format"])
+        if cached is None:
+            return None
+        return _cached_answer({**context, "cached": cached})
+
+    body, coalesced = single_flight.do(key, lambda: _answer_query(context, is_cancelled, emit), lookup)
+    return {**body, "coalesced": True} if coalesced else body
+
+def _run_query_job(payload, is_cancelled):
+    """Job queue handler: the /api/query pipeline for a queued request"""
+    if is_cancelled():
+        raise JobCancelled()
+    context, error = _prepare_query(payload)
+    if error is not None:
+        return error
+    if "cached" in context:
+        return _cached_answer(context), 200
+    return _coalesced_answer(context, is_cancelled), 200
+
+job_queue = JobQueue(_run_query_job)
+
+def _client_id(data) -> str:
+    """Who a job belongs to, for per-client fairness"""
+    return str(request.headers.get('X-Client-Id') or data.get('client_id') or request.remote_addr or 'anonymous')
+
+def _job_links(job):
+    return {
+        **job,
+        "status_url": f"/api/jobs/{job['job_id']}",
+        "events_url": f"/api/jobs/{job['job_id']}/events"
+    }
+
+@app.route('/api/query', methods=['POST'])
+def process_query():
+    """Process user query with agents
+    
+    With "async": true (or a "Prefer: respond-async" header) the query is
+    queued and a job id is returned at once with 202; poll /api/jobs/<id>
+    or subscribe to /api/jobs/<id>/events for the result.
+    """
     try:
-        # Reject low-intent or meaningless queries early
-        if is_low_intent_query(query):
-            return jsonify({
-                "success": False,
-                "error": "Please ask a specific question about your data.",
-                "suggestions": [
-                    "What are the total sales by category?",
-                    "Show me the top 10 customers by profit",
-                    "Create a scatter plot of discount vs profit",
-                    "Which products are unprofitable?"
-                ]
-            }), 400
-
-        # Read data
-        if filepath.endswith('.csv'):
-            df = pd.read_csv(filepath)
-        else:
-            df = pd.read_excel(filepath)
-
-        # Check if the query references data context
-        query_lower = query.lower().strip()
-        has_data_keyword = any(keyword in query_lower for keyword in DATA_KEYWORDS)
-        has_column_name = any(col.lower() in query_lower for col in df.columns)
-
-        if not has_data_keyword and not has_column_name and len(query.split()) < 4:
-            return jsonify({
-                "success": False,
-                "error": "Please mention specific columns or metrics from your data.",
-                "available_columns": df.columns.tolist()[:10],
-                "suggestions": [
-                    "What is the total sales?",
-                    "Show profit by region",
-                    "List top customers"
-                ]
-            }), 400
-        
-        # Get conversation context
-        context = memory.get_context_string()
-        
-        # Create planner with specified model
-        current_planner = PlannerAgent(model_name=model)
-        current_executor = ExecutorAgent(model_name=model)
-        
-        # Step 1: Create plan
-        # User query: {query}
-        schema_info = f"Columns: {', '.join(df.columns.tolist())}"
-        plan = current_planner.create_plan(query, schema_info, context)
-        # Plan created: {plan}
-        
-        # Step 2: Execute plan
-        result = current_executor.execute_plan(plan, df)
-        # Execution result: {result.get('success', False)}
-        
-        # Store in memory
-        memory.add_exchange(query, str(result.get('data', '')))
-        
-        # Convert chart to JSON if it's a Plotly figure
-        chart_data = result.get('chart')
-        if chart_data is not None:
+        data = request.get_json()
+        if data and (data.get('async') or 'respond-async' in request.headers.get('Prefer', '')):
+            # Only the cheap checks here; loading and profiling the dataset is the job's
+            error = _validate_query(data)
+            if error is not None:
+                return jsonify(error[0]), error[1]
             try:
-                # Check if it's a Plotly figure and convert to JSON
-                if hasattr(chart_data, 'to_json'):
-                    import json as json_module
-                    chart_data = json_module.loads(chart_data.to_json())
-                elif hasattr(chart_data, 'to_dict'):
-                    chart_data = chart_data.to_dict()
-            except Exception as chart_err:
-                logger.log_error("api", f"Error converting chart: {str(chart_err)}")
-                chart_data = None
-        
-        # Prepare response
-        response = {
-            "success": result.get('success', False),
-            "plan": plan,
-            "result": result.get('data'),  # executor returns 'data' not 'result'
-            "chart": chart_data,
-            "error": result.get('error'),
-            "model_used": model
-        }
+                job = job_queue.submit(data, _client_id(data))
+            except QueueFullError as e:
+                return jsonify({"success": False, "error": str(e)}), 429, {"Retry-After": "5"}
+            return jsonify(_job_links(job)), 202
+
+        context, error = _prepare_query(data)
+        if error is not None:
+            return jsonify(error[0]), error[1]
+
+        if "cached" in context:
+            return _json_response(_cached_answer(context))
         
-        return jsonify(response), 200
+        return _json_response(_coalesced_answer(context))
         
     except Exception as e:
         logger.log_error("api", f"Error processing query: {str(e)}")
@@ -205,6 +509,139 @@ def process_query():
             "error": f"Error processing query: {str(e)}"
         }), 500
 
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Job status, with the query response once it has finished"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return _json_response(_job_links(job))
+
+@app.route('/api/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    """Cancel a queued job, or stop a running one after its current stage"""
+    job = job_queue.cancel(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return _json_response(_job_links(job))
+
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """Server-Sent Events: a "status" event per state change, ending with the finished job"""
+    if job_queue.get(job_id) is None:
+        return jsonify({"error": "Job not found"}), 404
+
+    def generate():
+        last_status = None
+        last_sent = time.monotonic()
+        while True:
+            job = job_queue.get(job_id)
+            if job is None:
+                yield _sse("error", {"error": "Job not found"})
+                return
+            if job["status"] != last_status:
+                last_status = job["status"]
+                last_sent = time.monotonic()
+                yield _sse("status", job)
+                if last_status in ("succeeded", "failed", "cancelled"):
+                    return
+            elif time.monotonic() - last_sent > 15:
+                # Comment line keeps proxies from closing an idle stream
+                last_sent = time.monotonic()
+                yield ": keep-alive\n\n"
+            time.sleep(0.25)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
+@app.route('/api/query/stream', methods=['POST'])
+def stream_query():
+    """Process user query, streaming each stage as Server-Sent Events
+    
+    Events, in order: "plan" ({plan, mode}), "data" ({result, code_source, execution_path}),
+    "chart" ({chart}) and "done" ({success, cached, coalesced, timings}). Failures are
+    sent as an "error" event ({error}) and end the stream. Identical queries
+    in flight are coalesced as for /api/query; a follower gets every stage
+    once the leader's answer is ready.
+    """
+    try:
+        context, error = _prepare_query(request.get_json())
+    except Exception as e:
+        logger.log_error("api", f"Error processing query: {str(e)}")
+        return jsonify({"success": False, "error": f"Error processing query: {str(e)}"}), 500
+    if error is not None:
+        return jsonify(error[0]), error[1]
+
+    def generate():
+        try:
+            if "cached" in context:
+                cached = context["cached"]
+                yield _sse("plan", {"plan": cached.get("plan"), "mode": context["mode"]})
+                yield _sse("data", {"result": cached.get("result"), "code_source": "response_cache"})
+                yield _sse("chart", {"chart": cached.get("chart")})
+                yield _sse("done", {"success": True, "cached": True,
+                                    "timings": {"total_ms": _elapsed_ms(context["started"])}})
+                return
+
+            # single_flight.do blocks until the answer is ready, so it runs on its
+            # own thread and the stages it emits are relayed from a queue. A
+            # client that disconnects leaves it running for its followers.
+            events = queue.Queue()
+
+            def answer():
+                try:
+                    body = _coalesced_answer(context, emit=lambda event, payload: events.put((event, payload)))
+                    events.put(("answer", body))
+                except Exception as e:
+                    logger.log_error("api", f"Error streaming query: {str(e)}")
+                    events.put(("error", {"error": f"Error processing query: {str(e)}"}))
+
+            threading.Thread(target=answer, daemon=True).start()
+            while True:
+                event, payload = events.get()
+                if event != "answer":
+                    yield _sse(event, payload)
+                    if event == "error":
+                        return
+                    continue
+                body = payload
+                if not body["success"]:
+                    yield _sse("error", {"error": body.get("result")})
+                    return
+                if body.get("coalesced"):
+                    yield _sse("plan", {"plan": body.get("plan"), "mode": context["mode"]})
+                    yield _sse("data", {"result": body.get("result"), "code_source": body.get("code_source"),
+                                        "execution_path": body.get("execution_path")})
+                    yield _sse("chart", {"chart": body.get("chart")})
+                yield _sse("done", {"success": True, "cached": body.get("cached", False),
+                                    "coalesced": body.get("coalesced", False), "timings": body.get("timings")})
+                return
+
+        except Exception as e:
+            logger.log_error("api", f"Error streaming query: {str(e)}")
+            yield _sse("error", {"error": f"Error processing query: {str(e)}"})
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"  # don't let reverse proxies hold events back
+    })
+
+@app.route('/api/cache/stats', methods=['GET'])
+def get_cache_stats():
+    """Get dataset cache (this worker) and plan cache statistics"""
+    planner, _ = get_agents(default_model)
+    return jsonify({
+        "datasets": dataset_cache.get_stats(),
+        "plans": planner.cache.get_stats() if planner.cache else None,
+        "responses": response_cache.get_stats(),
+        "jobs": job_queue.get_stats(),
+        "rate_limits": get_limiter().get_stats(),
+        "single_flight": single_flight.get_stats(),
+        "sandbox": get_pool().get_stats() if get_pool() else None
+    }), 200
+
 @app.route('/api/memory/clear', methods=['POST'])
 def clear_memory():
     """Clear conversation memory"""
@@ -1,19 +1,27 @@
 import streamlit as st
 import pandas as pd
+import os
+import shutil
+import tempfile
 import time
-from agents.planner import PlannerAgent
-from agents.executor import ExecutorAgent
+from agents.registry import get_agents
 from utils.memory_manager import ConversationMemory
 from utils.logger import get_logger
 from utils.model_config import ModelConfig
+from utils.dtype_optimizer import optimize_dtypes
+from utils.dataset_profile import DatasetProfile
+from utils.dataset_store import OUT_OF_CORE_MB, MB, head_rows, ingest, iter_batches, load_profile
+from agents.rollup import RollupCube, rollups_enabled
+
+# Streamlit's own cap (server.maxUploadSize, 200MB by default) applies too
+MAX_FILE_SIZE_MB = float(os.getenv("MAX_FILE_SIZE_MB", "10"))
 
 st.set_page_config(page_title="Intelligent Data Room", page_icon="", layout="wide")
 
 # Initialize
 if 'planner' not in st.session_state:
     default_model = ModelConfig.get_default_model()
-    st.session_state.planner = PlannerAgent(model_name=default_model)
-    st.session_state.executor = ExecutorAgent(model_name=default_model)
+    st.session_state.planner, st.session_state.executor = get_agents(default_model)
     st.session_state.memory = ConversationMemory()
     st.session_state.messages = []
     st.session_state.logger = get_logger(enable_file_logging=True)
@@ -38,8 +46,7 @@ with st.sidebar:
     # Update model if changed
     if selected_model != st.session_state.get('current_model'):
         with st.spinner("Switching model..."):
-            st.session_state.planner = PlannerAgent(model_name=selected_model)
-            st.session_state.executor = ExecutorAgent(model_name=selected_model)
+            st.session_state.planner, st.session_state.executor = get_agents(selected_model)
             st.session_state.current_model = selected_model
             st.success(f" Switched to {ModelConfig.get_model_info(selected_model)['name']}")
             st.rerun()
@@ -51,24 +58,62 @@ with st.sidebar:
     
     st.divider()
     st.header(" Upload Data")
-    uploaded = st.file_uploader("CSV/XLSX (Max 10MB)", type=['csv', 'xlsx'])
+    uploaded = st.file_uploader(f"CSV/XLSX (Max {MAX_FILE_SIZE_MB:g}MB)", type=['csv', 'xlsx'])
     
     if uploaded:
-        # File size validation (10MB = 10 * 1024 * 1024 bytes)
-        MAX_FILE_SIZE = 10 * 1024 * 1024
-        
-        if uploaded.size > MAX_FILE_SIZE:
-            st.error(f" File size ({uploaded.size / 1024 / 1024:.2f}MB) exceeds 10MB limit")
-        else:
+        if uploaded.size > MAX_FILE_SIZE_MB * MB:
+            st.error(f" File size ({uploaded.size / MB:.2f}MB) exceeds {MAX_FILE_SIZE_MB:g}MB limit")
+        elif st.session_state.get('upload_id') != uploaded.file_id:
+            # Parsed once per upload, not on every rerun
             try:
-                df = pd.read_csv(uploaded) if uploaded.name.endswith('.csv') else pd.read_excel(uploaded)
-                st.session_state.data = df
-                st.success(f" {len(df)} rows loaded ({uploaded.size / 1024:.2f}KB)")
-                with st.expander("Preview"):
-                    st.dataframe(df.head())
-                    st.caption(f"Columns: {', '.join(df.columns.tolist()[:5])}{'...' if len(df.columns) > 5 else ''}")
+                if uploaded.name.endswith('.csv') and uploaded.size > OUT_OF_CORE_MB * MB:
+                    # Too large to load: stream to disk, ingest and query it in chunks
+                    filepath = os.path.join(tempfile.gettempdir(), f"idr_{uploaded.file_id}.csv")
+                    with open(filepath, 'wb') as f:
+                        shutil.copyfileobj(uploaded, f)
+                    _, memory_report = ingest(filepath)
+                    profile = load_profile(filepath)
+                    st.session_state.data = None
+                    st.session_state.filepath = filepath
+                    st.session_state.profile = profile
+                    st.session_state.rollups = (
+                        RollupCube.build_chunked(profile, lambda columns: iter_batches(filepath, columns))
+                        if rollups_enabled() else None
+                    )
+                    st.session_state.upload_summary = (
+                        f" {profile.rows} rows ingested ({uploaded.size / MB:.2f}MB)",
+                        f"Queried in {memory_report['chunks']} chunks; "
+                        "only aggregate questions are supported for files this large",
+                        head_rows(filepath, 5)
+                    )
+                else:
+                    df = pd.read_csv(uploaded) if uploaded.name.endswith('.csv') else pd.read_excel(uploaded)
+                    df, memory_report = optimize_dtypes(df)
+                    st.session_state.data = df
+                    st.session_state.filepath = None
+                    # Same profile (and schema string) the API computes at upload
+                    st.session_state.profile = DatasetProfile.from_frame(df)
+                    st.session_state.rollups = (
+                        RollupCube.build(df, st.session_state.profile) if rollups_enabled() else None
+                    )
+                    st.session_state.upload_summary = (
+                        f" {len(df)} rows loaded ({uploaded.size / 1024:.2f}KB)",
+                        f"In memory: {memory_report['memory_before_bytes'] / 1024:.0f}KB → "
+                        f"{memory_report['memory_after_bytes'] / 1024:.0f}KB after dtype optimization",
+                        df.head()
+                    )
+                st.session_state.upload_id = uploaded.file_id
             except Exception as e:
                 st.error(f" Error loading file: {e}")
+        
+        if st.session_state.get('upload_id') == uploaded.file_id:
+            message, details, preview = st.session_state.upload_summary
+            columns = st.session_state.profile.column_names
+            st.success(message)
+            st.caption(details)
+            with st.expander("Preview"):
+                st.dataframe(preview)
+                st.caption(f"Columns: {', '.join(columns[:5])}{'...' if len(columns) > 5 else ''}")
     
     # Rate limit info
     st.divider()
@@ -127,7 +172,7 @@ else:
                         'category', 'region', 'state', 'segment', 'discount', 'quantity', 'ship']
         
         has_data_keyword = any(keyword in query_lower for keyword in data_keywords)
-        has_column_name = any(col.lower() in query_lower for col in st.session_state.data.columns)
+        has_column_name = any(col.lower() in query_lower for col in st.session_state.profile.column_names)
         
         if not has_data_keyword and not has_column_name and len(query.split()) < 4:
             st.session_state.messages.append({"role": "user", "content": query})
@@ -138,7 +183,7 @@ else:
                 st.warning("️ I'm not sure what you're asking about. Please mention specific columns or metrics.")
                 st.info(f"""
 **Available columns in your data:**
-{', '.join(st.session_state.data.columns.tolist()[:10])}
+{', '.join(st.session_state.profile.column_names[:10])}
 
 **Example questions:**
 - "What is the total sales?"
@@ -162,15 +207,18 @@ else:
             start_time = time.time()
             
             with st.spinner(" Planning..."):
-                schema = st.session_state.data.dtypes.to_string()
                 history = st.session_state.memory.get_context_string()
-                plan = st.session_state.planner.create_plan(query, schema, history)
+                plan = st.session_state.planner.create_plan(query, st.session_state.profile, history)
                 
                 with st.expander(" View Plan"):
                     st.json(plan)
             
             with st.spinner("️ Executing..."):
-                result = st.session_state.executor.execute_plan(plan, st.session_state.data)
+                result = st.session_state.executor.execute_plan(
+                    plan, st.session_state.data, filepath=st.session_state.filepath,
+                    profile=st.session_state.profile,
+                    rollups=st.session_state.rollups
+                )
                 execution_time = time.time() - start_time
                 
                 # Log summary
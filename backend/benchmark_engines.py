@@ -0,0 +1,109 @@
+"""
+Benchmark: pandas template code vs the SQL engine on the same plans
+
+    python benchmark_engines.py [--file data.csv] [--scale 10] [--repeat 5]
+
+--scale stacks the file that many times to get a larger dataset. Each plan
+comes from the rule planner, runs both ways and reports the median time and
+whether the two results agree.
+"""
+import argparse
+import os
+import shutil
+import statistics
+import tempfile
+import time
+
+import pandas as pd
+
+from agents.code_templates import generate_template_code
+from agents.rule_planner import RulePlanner
+from agents.sql_backend import build_sql_store
+from utils.dataset_store import ingest, iter_batches, load_dataset, load_profile
+
+QUERIES = [
+    "total sales by category",
+    "top 5 states by profit",
+    "average discount by segment",
+    "number of orders by ship mode",
+    "sales over time",
+    "average profit over time by region",
+    "sales vs profit",
+]
+
+
+def _median_ms(run, repeat: int):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = run()
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings), result
+
+
+def _same(a: pd.DataFrame, b: pd.DataFrame) -> bool:
+    a, b = a.reset_index(drop=True), b.reset_index(drop=True)
+    if list(a.columns) != list(b.columns) or len(a) != len(b):
+        return False
+    for column in a.columns:
+        if a[column].dtype.kind in "fi" and b[column].dtype.kind in "fi":
+            x, y = a[column].astype(float), b[column].astype(float)
+            if not ((x - y).abs() <= 1e-3 * (1 + y.abs())).all():
+                return False
+        elif list(a[column].astype(str)) != list(b[column].astype(str)):
+            return False
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--file", default=os.path.join(os.path.dirname(__file__), "data", "Sample Superstore.csv"))
+    parser.add_argument("--scale", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="idr_bench_")
+    try:
+        filepath = os.path.join(workdir, "bench.csv")
+        if args.scale > 1:
+            source = pd.read_csv(args.file)
+            pd.concat([source] * args.scale, ignore_index=True).to_csv(filepath, index=False)
+        else:
+            shutil.copy(args.file, filepath)
+
+        started = time.perf_counter()
+        ingest(filepath)
+        profile = load_profile(filepath)
+        print(f"Ingest: {(time.perf_counter() - started) * 1000:.0f} ms, {profile.rows} rows")
+        started = time.perf_counter()
+        store = build_sql_store(filepath, profile, lambda columns: iter_batches(filepath, columns))
+        print(f"SQL store build: {(time.perf_counter() - started) * 1000:.0f} ms, "
+              f"{os.path.getsize(store.path) / 1024 / 1024:.1f} MB")
+
+        df = load_dataset(filepath)
+        # The pandas path needs the whole frame in the worker; the SQL path only its result
+        print(f"pandas frame in memory: {df.memory_usage(deep=True).sum() / 1024 / 1024:.1f} MB\n")
+        planner = RulePlanner()
+        print(f"{'query':<40} {'pandas ms':>10} {'sql ms':>10} {'speedup':>8}  same")
+        for query in QUERIES:
+            plan, _ = planner.plan(query, profile.column_types)
+            code = generate_template_code(plan, profile.column_types) if plan else None
+            if code is None:
+                print(f"{query:<40} (no template plan)")
+                continue
+
+            def run_pandas():
+                namespace = {"df": df, "pd": pd}
+                exec(code, namespace)
+                return namespace["result"]
+
+            pandas_ms, expected = _median_ms(run_pandas, args.repeat)
+            sql_ms, answered = _median_ms(lambda: store.answer(plan, profile.column_types), args.repeat)
+            same = _same(answered[0], expected)
+            print(f"{query:<40} {pandas_ms:>10.1f} {sql_ms:>10.1f} {pandas_ms / sql_ms:>7.1f}x  {same}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
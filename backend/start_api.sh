@@ -30,8 +30,11 @@ echo "  GET  /health           - Health check"
 echo "  GET  /api/models       - List models"
 echo "  POST /api/upload       - Upload data file"
 echo "  POST /api/query        - Process query"
+echo "  POST /api/query/stream - Process query, streamed as Server-Sent Events"
+echo "  GET  /api/jobs/<id>    - Async query job status (DELETE cancels, /events streams)"
 echo "  POST /api/memory/clear - Clear memory"
 echo "  GET  /api/memory       - Get memory"
+echo "  GET  /api/cache/stats  - Cache statistics"
 echo ""
 echo "Press Ctrl+C to stop"
 echo "================================"
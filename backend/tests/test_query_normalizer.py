@@ -0,0 +1,57 @@
+import random
+import time
+
+from utils.query_normalizer import QuerySimilarityIndex, canonicalize_query
+
+INDEX_SIZE = 30_000
+METRICS = ["sales", "profit", "quantity", "discount", "orders", "returns", "cost", "units shipped"]
+DIMENSIONS = ["region", "category", "sub category", "segment", "state", "city", "customer",
+              "product", "ship mode", "month", "year", "country"]
+OPENINGS = ["show", "total", "average", "top {n}", "bottom {n}", "count of", "sum of", "trend of"]
+
+
+def _queries(rng: random.Random, count: int):
+    queries = set()
+    while len(queries) < count:
+        opening = rng.choice(OPENINGS).format(n=rng.randint(1, 50))
+        queries.add(canonicalize_query(
+            f"{opening} {rng.choice(METRICS)} by {rng.choice(DIMENSIONS)} "
+            f"for {rng.choice(DIMENSIONS)} {rng.randint(1, 400)}"))
+    return list(queries)
+
+
+def _mean_lookup_ms(index: QuerySimilarityIndex, queries) -> float:
+    started = time.perf_counter()
+    for query in queries:
+        index.find(query)
+    return (time.perf_counter() - started) * 1000 / len(queries)
+
+
+def test_matches_near_duplicates_only():
+    index = QuerySimilarityIndex()
+    for key, query in enumerate(["top 10 customers by profit", "profitable products by region",
+                                 "sales in east region", "total sales by region"]):
+        index.add(str(key), canonicalize_query(query))
+
+    assert index.find(canonicalize_query("Top 10 customers by Profit?"))[0] == "0"
+    assert index.find(canonicalize_query("total sales by regions"))[0] == "3"
+    assert index.find(canonicalize_query("top 5 customers by profit")) is None
+    assert index.find(canonicalize_query("unprofitable products by region")) is None
+    assert index.find(canonicalize_query("sales in west region")) is None
+
+    index.remove("3")
+    assert index.find(canonicalize_query("total sales by regions")) is None
+
+
+def test_lookup_is_sub_millisecond_at_scale():
+    rng = random.Random(0)
+    queries = _queries(rng, INDEX_SIZE + 1000)
+    indexed, unseen = queries[:INDEX_SIZE], queries[INDEX_SIZE:]
+    index = QuerySimilarityIndex()
+    for key, query in enumerate(indexed):
+        index.add(str(key), query)
+
+    hits = rng.sample(indexed, 500)
+    assert all(index.find(query) is not None for query in hits)
+    assert _mean_lookup_ms(index, hits) < 1.0
+    assert _mean_lookup_ms(index, unseen) < 1.0
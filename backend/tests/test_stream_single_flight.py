@@ -0,0 +1,79 @@
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+
+# api builds its caches and job queue at import time
+_state = tempfile.mkdtemp()
+os.environ["CACHE_PATH"] = os.path.join(_state, "cache.sqlite3")
+os.environ["JOBS_PATH"] = os.path.join(_state, "jobs.sqlite3")
+os.environ["SANDBOX_WORKERS"] = "0"
+os.environ.setdefault("GEMINI_API_KEY", "test")
+
+import api  # noqa: E402
+from agents.registry import get_agents  # noqa: E402
+
+DATASET = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "Sample Superstore.csv")
+PLAN = ('{"intent": "visualization", "steps": ["group by Category", "sum Sales"], "chart_type": "bar", '
+        '"columns_needed": ["Category", "Sales"], "reasoning": "test"}')
+
+
+class _Response:
+    def __init__(self, text):
+        self.text = text
+
+
+class GatedModel:
+    """Stands in for Gemini: answers with PLAN once the gate opens, counting calls"""
+
+    def __init__(self, gate):
+        self.gate = gate
+        self.calls = 0
+
+    def generate_content(self, prompt):
+        self.calls += 1
+        self.gate.wait(5)
+        return _Response(PLAN)
+
+
+def _events(response):
+    blocks = response.get_data(as_text=True).strip().split("\n\n")
+    return [(block.split("\n", 1)[0][len("event: "):], json.loads(block.split("data: ", 1)[1])) for block in blocks]
+
+
+def test_concurrent_stream_requests_make_one_llm_call():
+    client = api.app.test_client()
+    with open(DATASET, "rb") as f:
+        upload = client.post("/api/upload", data={"file": (io.BytesIO(f.read()), "stream_sf.csv")})
+    filepath = upload.json["filepath"]
+
+    gate = threading.Event()
+    model = GatedModel(gate)
+    planner, executor = get_agents(api.default_model)
+    planner.model = executor.model = model
+    coalesced_before = api.single_flight.get_stats()["coalesced"]
+
+    queries = ["Which categories sell the most?", "which categories sell the most",
+               "WHICH CATEGORIES SELL THE MOST", "which  categories sell the most ?"]
+    streams = [None] * len(queries)
+
+    def stream(i):
+        # The events are produced as the body is read
+        streams[i] = _events(client.post("/api/query/stream", json={"query": queries[i], "filepath": filepath}))
+
+    threads = [threading.Thread(target=stream, args=(i,)) for i in range(len(queries))]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.5)
+    gate.set()
+    for thread in threads:
+        thread.join()
+
+    assert model.calls == 1
+    for events in streams:
+        assert [event for event, _ in events] == ["plan", "data", "chart", "done"]
+        assert events[-1][1]["success"]
+    assert sum(events[-1][1]["coalesced"] for events in streams) == len(queries) - 1
+    assert api.single_flight.get_stats()["coalesced"] - coalesced_before == len(queries) - 1
@@ -2,9 +2,10 @@
 Utils package for Intelligent Data Room
 Contains utility modules for caching, logging, memory management, and model configuration.
 """
-from utils.cache import QueryCache
+from utils.cache import QueryCache, CodeCache, ResponseCache
+from utils.dataset_cache import DatasetCache
 from utils.logger import AgentLogger, get_logger
 from utils.memory_manager import ConversationMemory
 from utils.model_config import ModelConfig
 
-__all__ = ['QueryCache', 'AgentLogger', 'get_logger', 'ConversationMemory', 'ModelConfig']
+__all__ = ['QueryCache', 'CodeCache', 'ResponseCache', 'DatasetCache', 'AgentLogger', 'get_logger', 'ConversationMemory', 'ModelConfig']
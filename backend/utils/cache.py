@@ -1,46 +1,469 @@
 """
 Simple cache to reduce API calls
+Entries live in a pluggable backend: an in-process LRU dict, or a SQLite file
+shared by all workers on the host that survives restarts.
 """
 import hashlib
 import json
-from typing import Dict, Any, Optional
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Any, Iterable, Optional, Tuple
+
+from utils.query_normalizer import QuerySimilarityIndex, canonicalize_query
+
+
+DEFAULT_CACHE_PATH = os.path.join(tempfile.gettempdir(), "idr_cache.sqlite3")
+
+
+class MemoryCacheBackend:
+    """In-process LRU store with per-entry TTL and entry/byte limits"""
+
+    def __init__(self, max_entries: int = 50, max_bytes: Optional[int] = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # namespace -> key -> (value_json, size, expires_at, tag)
+        self.entries: Dict[str, "OrderedDict[str, Tuple[str, int, Optional[float], Optional[str]]]"] = {}
+        self.stats: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.RLock()
+
+    def _count(self, namespace: str, counter: str, amount: int = 1):
+        stats = self.stats.setdefault(namespace, {"hits": 0, "misses": 0, "evictions": 0})
+        stats[counter] += amount
+
+    def get(self, namespace: str, key: str) -> Optional[Any]:
+        with self._lock:
+            entries = self.entries.get(namespace, OrderedDict())
+            entry = entries.get(key)
+            if entry is not None and entry[2] is not None and entry[2] <= time.time():
+                del entries[key]
+                entry = None
+            if entry is None:
+                self._count(namespace, "misses")
+                return None
+            entries.move_to_end(key)
+            self._count(namespace, "hits")
+            return json.loads(entry[0])
+
+    def set(self, namespace: str, key: str, value: Any, ttl: Optional[float] = None,
+            tag: Optional[str] = None):
+        encoded = json.dumps(value)
+        expires_at = time.time() + ttl if ttl else None
+        with self._lock:
+            entries = self.entries.setdefault(namespace, OrderedDict())
+            entries.pop(key, None)
+            entries[key] = (encoded, len(encoded), expires_at, tag)
+            self._evict(namespace, entries)
+
+    def _evict(self, namespace: str, entries: "OrderedDict[str, Tuple[str, int, Optional[float], Optional[str]]]"):
+        now = time.time()
+        for key in [k for k, e in entries.items() if e[2] is not None and e[2] <= now]:
+            del entries[key]
+
+        total = sum(e[1] for e in entries.values())
+        while entries and (len(entries) > self.max_entries or
+                           (self.max_bytes is not None and total > self.max_bytes)):
+            _, evicted = entries.popitem(last=False)
+            total -= evicted[1]
+            self._count(namespace, "evictions")
+
+    def delete(self, namespace: str, key: str):
+        with self._lock:
+            self.entries.get(namespace, OrderedDict()).pop(key, None)
+
+    def delete_tag(self, namespace: str, tag: str):
+        with self._lock:
+            entries = self.entries.get(namespace, OrderedDict())
+            for key in [k for k, e in entries.items() if e[3] == tag]:
+                del entries[key]
+
+    def clear(self, namespace: str):
+        with self._lock:
+            self.entries.pop(namespace, None)
+
+    def get_stats(self, namespace: str) -> Dict[str, int]:
+        with self._lock:
+            entries = self.entries.get(namespace, OrderedDict())
+            stats = self.stats.get(namespace, {"hits": 0, "misses": 0, "evictions": 0})
+            return {
+                "size": len(entries),
+                "bytes": sum(e[1] for e in entries.values()),
+                **stats
+            }
+
+
+class SQLiteCacheBackend:
+    """SQLite-backed LRU store shared across processes on the same host"""
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, max_entries: int = 50,
+                 max_bytes: Optional[int] = None):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._init_schema()
+
+    def _connect(self) -> sqlite3.Connection:
+        """One connection per thread (and per process after a fork)"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        """Write transaction; BEGIN IMMEDIATE serializes writers across workers"""
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _init_schema(self):
+        conn = self._connect()
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS cache_entries (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL,
+                expires_at REAL,
+                tag TEXT,
+                PRIMARY KEY (namespace, key)
+            );
+            CREATE INDEX IF NOT EXISTS idx_cache_entries_lru
+                ON cache_entries (namespace, last_access);
+            CREATE TABLE IF NOT EXISTS cache_stats (
+                namespace TEXT PRIMARY KEY,
+                hits INTEGER NOT NULL DEFAULT 0,
+                misses INTEGER NOT NULL DEFAULT 0,
+                evictions INTEGER NOT NULL DEFAULT 0
+            );
+        """)
+        # Cache files created before tags existed
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(cache_entries)")]
+        if "tag" not in columns:
+            conn.execute("ALTER TABLE cache_entries ADD COLUMN tag TEXT")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_entries_tag ON cache_entries (namespace, tag)")
+
+    def _count(self, conn: sqlite3.Connection, namespace: str, counter: str, amount: int = 1):
+        conn.execute("INSERT OR IGNORE INTO cache_stats (namespace) VALUES (?)", (namespace,))
+        conn.execute(f"UPDATE cache_stats SET {counter} = {counter} + ? WHERE namespace = ?",
+                     (amount, namespace))
+
+    def get(self, namespace: str, key: str) -> Optional[Any]:
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT value, expires_at FROM cache_entries WHERE namespace = ? AND key = ?",
+                (namespace, key)
+            ).fetchone()
+            if row is not None and row[1] is not None and row[1] <= now:
+                conn.execute("DELETE FROM cache_entries WHERE namespace = ? AND key = ?", (namespace, key))
+                row = None
+            if row is None:
+                self._count(conn, namespace, "misses")
+                return None
+            conn.execute(
+                "UPDATE cache_entries SET last_access = ? WHERE namespace = ? AND key = ?",
+                (now, namespace, key)
+            )
+            self._count(conn, namespace, "hits")
+        return json.loads(row[0])
+
+    def set(self, namespace: str, key: str, value: Any, ttl: Optional[float] = None,
+            tag: Optional[str] = None):
+        encoded = json.dumps(value)
+        now = time.time()
+        expires_at = now + ttl if ttl else None
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO cache_entries "
+                "(namespace, key, value, size, last_access, expires_at, tag) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (namespace, key, encoded, len(encoded), now, expires_at, tag)
+            )
+            self._evict(conn, namespace, now)
+
+    def _evict(self, conn: sqlite3.Connection, namespace: str, now: float):
+        conn.execute(
+            "DELETE FROM cache_entries WHERE namespace = ? AND expires_at IS NOT NULL AND expires_at <= ?",
+            (namespace, now)
+        )
+        count, total = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache_entries WHERE namespace = ?",
+            (namespace,)
+        ).fetchone()
+
+        over_count = count > self.max_entries
+        over_bytes = self.max_bytes is not None and total > self.max_bytes
+        if not over_count and not over_bytes:
+            return
+
+        # Walk from least recently used until both limits are satisfied
+        victims = []
+        for key, size in conn.execute(
+            "SELECT key, size FROM cache_entries WHERE namespace = ? ORDER BY last_access ASC",
+            (namespace,)
+        ):
+            if count <= self.max_entries and (self.max_bytes is None or total <= self.max_bytes):
+                break
+            victims.append((namespace, key))
+            count -= 1
+            total -= size
+
+        conn.executemany("DELETE FROM cache_entries WHERE namespace = ? AND key = ?", victims)
+        self._count(conn, namespace, "evictions", len(victims))
+
+    def delete(self, namespace: str, key: str):
+        conn = self._connect()
+        conn.execute("DELETE FROM cache_entries WHERE namespace = ? AND key = ?", (namespace, key))
+
+    def delete_tag(self, namespace: str, tag: str):
+        conn = self._connect()
+        conn.execute("DELETE FROM cache_entries WHERE namespace = ? AND tag = ?", (namespace, tag))
+
+    def clear(self, namespace: str):
+        conn = self._connect()
+        conn.execute("DELETE FROM cache_entries WHERE namespace = ?", (namespace,))
+
+    def get_stats(self, namespace: str) -> Dict[str, int]:
+        conn = self._connect()
+        size, total = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache_entries WHERE namespace = ?",
+            (namespace,)
+        ).fetchone()
+        row = conn.execute(
+            "SELECT hits, misses, evictions FROM cache_stats WHERE namespace = ?", (namespace,)
+        ).fetchone() or (0, 0, 0)
+        return {
+            "size": size,
+            "bytes": total,
+            "hits": row[0],
+            "misses": row[1],
+            "evictions": row[2]
+        }
+
+
+def create_backend(max_entries: int, max_bytes: Optional[int] = None):
+    """Build the backend selected by CACHE_BACKEND (sqlite by default)"""
+    backend = os.getenv("CACHE_BACKEND", "sqlite").lower()
+    if backend == "memory":
+        return MemoryCacheBackend(max_entries=max_entries, max_bytes=max_bytes)
+    if backend != "sqlite":
+        raise ValueError(f"Unknown CACHE_BACKEND: {backend}")
+    path = os.getenv("CACHE_PATH", DEFAULT_CACHE_PATH)
+    return SQLiteCacheBackend(path=path, max_entries=max_entries, max_bytes=max_bytes)
 
 
 class QueryCache:
-    """Cache for query results to reduce API calls"""
-    
-    def __init__(self, max_size: int = 50):
-        self.cache: Dict[str, Any] = {}
+    """Cache for query results to reduce API calls
+
+    Queries are canonicalized before hashing, and a miss falls back to the
+    most similar cached query for the same schema when it scores at least
+    similarity_threshold (1.0 disables near-duplicate matching). The
+    similarity index is per process; exact matches are shared by all
+    workers through the backend.
+    """
+
+    namespace = "plans"
+
+    def __init__(self, max_size: int = 50, max_bytes: Optional[int] = 1024 * 1024,
+                 ttl: Optional[float] = None, backend=None,
+                 similarity_threshold: Optional[float] = None):
         self.max_size = max_size
-    
-    def _get_key(self, query: str, schema: str) -> str:
-        """Generate cache key from query and schema"""
-        combined = f"{query}||{schema}"
+        self.max_bytes = max_bytes
+        self.ttl = ttl if ttl is not None else float(os.getenv("CACHE_TTL_SECONDS", "86400"))
+        self.backend = backend or create_backend(max_entries=max_size, max_bytes=max_bytes)
+        if similarity_threshold is None:
+            similarity_threshold = float(os.getenv("QUERY_SIMILARITY_THRESHOLD", "0.85"))
+        self.similarity_threshold = similarity_threshold
+        self.indexes: Dict[str, QuerySimilarityIndex] = {}
+        self.near_duplicate_hits = 0
+        self._lock = threading.Lock()
+
+    def _get_key(self, canonical_query: str, schema: str) -> str:
+        """Generate cache key from canonical query and schema"""
+        combined = f"{canonical_query}||{schema}"
         return hashlib.md5(combined.encode()).hexdigest()
-    
-    def get_plan(self, query: str, schema: str) -> Optional[Dict[str, Any]]:
-        """Get cached plan if exists"""
-        key = self._get_key(query, schema)
-        return self.cache.get(key)
-    
-    def set_plan(self, query: str, schema: str, plan: Dict[str, Any]):
-        """Cache a plan"""
-        key = self._get_key(query, schema)
-        
-        # Implement simple LRU by removing oldest if full
-        if len(self.cache) >= self.max_size:
-            # Remove first item (oldest)
-            self.cache.pop(next(iter(self.cache)))
-        
-        self.cache[key] = plan
-    
+
+    def _index(self, schema: str) -> QuerySimilarityIndex:
+        """Similarity index of the queries cached for one schema"""
+        schema_key = hashlib.md5(schema.encode()).hexdigest()
+        with self._lock:
+            index = self.indexes.get(schema_key)
+            if index is None:
+                index = QuerySimilarityIndex(threshold=self.similarity_threshold)
+                self.indexes[schema_key] = index
+            return index
+
+    def get_plan(self, query: str, schema: str,
+                 columns: Optional[Iterable[str]] = None) -> Optional[Dict[str, Any]]:
+        """Get cached plan for the query or a near-duplicate of it"""
+        canonical = canonicalize_query(query, columns)
+        key = self._get_key(canonical, schema)
+        plan = self.backend.get(self.namespace, key)
+        if plan is not None:
+            self._index(schema).add(key, canonical)
+            return plan
+
+        if self.similarity_threshold >= 1.0:
+            return None
+        index = self._index(schema)
+        match = index.find(canonical)
+        if match is None:
+            return None
+        plan = self.backend.get(self.namespace, match[0])
+        if plan is None:
+            # Evicted or expired since it was indexed
+            index.remove(match[0])
+            return None
+        with self._lock:
+            self.near_duplicate_hits += 1
+        return plan
+
+    def set_plan(self, query: str, schema: str, plan: Dict[str, Any],
+                 columns: Optional[Iterable[str]] = None):
+        """Cache a plan (least recently used entries are evicted when full)"""
+        canonical = canonicalize_query(query, columns)
+        key = self._get_key(canonical, schema)
+        self.backend.set(self.namespace, key, plan, ttl=self.ttl)
+        self._index(schema).add(key, canonical)
+
     def clear(self):
         """Clear all cached plans"""
-        self.cache.clear()
-    
-    def get_stats(self) -> Dict[str, int]:
+        self.backend.clear(self.namespace)
+        with self._lock:
+            self.indexes.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get cache statistics"""
+        stats = self.backend.get_stats(self.namespace)
+        return {
+            **stats,
+            "near_duplicate_hits": self.near_duplicate_hits,
+            "similarity_threshold": self.similarity_threshold,
+            "max_size": self.max_size,
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl,
+            "backend": type(self.backend).__name__
+        }
+
+
+class CodeCache:
+    """Cache of generated pandas code keyed by normalized plan and schema"""
+
+    namespace = "code"
+
+    def __init__(self, max_size: int = 200, max_bytes: Optional[int] = 4 * 1024 * 1024,
+                 ttl: Optional[float] = None, backend=None):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.ttl = ttl if ttl is not None else float(os.getenv("CACHE_TTL_SECONDS", "86400"))
+        self.backend = backend or create_backend(max_entries=max_size, max_bytes=max_bytes)
+
+    @staticmethod
+    def _normalize_plan(plan: Dict[str, Any]) -> Dict[str, Any]:
+        """Keep only the plan fields that determine the generated code"""
+        def clean(value: Any) -> str:
+            return " ".join(str(value).lower().split())
+
+        return {
+            "intent": clean(plan.get("intent", "")),
+            "chart_type": clean(plan.get("chart_type", "")),
+            # Column order matters (x before y), so it is preserved
+            "columns_needed": [str(c).strip() for c in plan.get("columns_needed", [])],
+            "steps": [clean(step) for step in plan.get("steps", [])]
+        }
+
+    def _get_key(self, plan: Dict[str, Any], schema_fingerprint: str) -> str:
+        """Generate cache key from normalized plan and schema fingerprint"""
+        combined = json.dumps(self._normalize_plan(plan), sort_keys=True) + "||" + schema_fingerprint
+        return hashlib.md5(combined.encode()).hexdigest()
+
+    def get_code(self, plan: Dict[str, Any], schema_fingerprint: str) -> Optional[str]:
+        """Get cached code for plan if exists"""
+        return self.backend.get(self.namespace, self._get_key(plan, schema_fingerprint))
+
+    def set_code(self, plan: Dict[str, Any], schema_fingerprint: str, code: str):
+        """Cache code that executed successfully for plan"""
+        self.backend.set(self.namespace, self._get_key(plan, schema_fingerprint), code, ttl=self.ttl)
+
+    def evict_code(self, plan: Dict[str, Any], schema_fingerprint: str):
+        """Drop cached code for plan (e.g. after it failed to execute)"""
+        self.backend.delete(self.namespace, self._get_key(plan, schema_fingerprint))
+
+    def clear(self):
+        """Clear all cached code"""
+        self.backend.clear(self.namespace)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get cache statistics"""
+        return {
+            **self.backend.get_stats(self.namespace),
+            "max_size": self.max_size,
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl,
+            "backend": type(self.backend).__name__
+        }
+
+
+class ResponseCache:
+    """Cache of final /api/query payloads keyed by query, dataset content and model"""
+
+    namespace = "responses"
+
+    def __init__(self, max_size: int = 500, max_bytes: Optional[int] = 64 * 1024 * 1024,
+                 ttl: Optional[float] = None, backend=None):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.ttl = ttl if ttl is not None else float(os.getenv("CACHE_TTL_SECONDS", "86400"))
+        self.backend = backend or create_backend(max_entries=max_size, max_bytes=max_bytes)
+
+    def _get_key(self, query: str, dataset_hash: str, model: str, chart_format: str = "figure") -> str:
+        """Generate cache key from canonical query, dataset hash, model and chart format"""
+        combined = f"{canonicalize_query(query)}||{dataset_hash}||{model}"
+        if chart_format != "figure":
+            combined += f"||{chart_format}"
+        return hashlib.md5(combined.encode()).hexdigest()
+
+    def get_response(self, query: str, dataset_hash: str, model: str,
+                     chart_format: str = "figure") -> Optional[Dict[str, Any]]:
+        """Get cached response payload if exists"""
+        return self.backend.get(self.namespace, self._get_key(query, dataset_hash, model, chart_format))
+
+    def set_response(self, query: str, dataset_hash: str, model: str, payload: Dict[str, Any],
+                     chart_format: str = "figure"):
+        """Cache a response payload, tagged with its dataset for invalidation"""
+        key = self._get_key(query, dataset_hash, model, chart_format)
+        self.backend.set(self.namespace, key, payload, ttl=self.ttl, tag=dataset_hash)
+
+    def invalidate_dataset(self, dataset_hash: str):
+        """Drop every cached response computed on a dataset"""
+        self.backend.delete_tag(self.namespace, dataset_hash)
+
+    def clear(self):
+        """Clear all cached responses"""
+        self.backend.clear(self.namespace)
+
+    def get_stats(self) -> Dict[str, Any]:
         """Get cache statistics"""
         return {
-            "size": len(self.cache),
-            "max_size": self.max_size
+            **self.backend.get_stats(self.namespace),
+            "max_size": self.max_size,
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl,
+            "backend": type(self.backend).__name__
         }
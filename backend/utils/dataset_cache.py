@@ -0,0 +1,110 @@
+"""
+Per-worker cache of parsed DataFrames to avoid re-reading uploads on every query
+Only memory private to this process counts against the budget; columns that are
+views over a memory-mapped file are shared with the other workers.
+"""
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+import pandas as pd
+
+from utils.dataset_store import load_dataset, private_memory_bytes
+
+
+class DatasetCache:
+    """LRU cache of parsed datasets keyed by path, size and mtime"""
+
+    def __init__(self, max_memory_mb: Optional[float] = None):
+        if max_memory_mb is None:
+            max_memory_mb = float(os.getenv("DATASET_CACHE_MB", "512"))
+        self.max_bytes = int(max_memory_mb * 1024 * 1024)
+        self.entries: "OrderedDict[str, dict]" = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _signature(filepath: str) -> Tuple[int, int]:
+        """File size and mtime, used to detect a changed file at the same path"""
+        stat = os.stat(filepath)
+        return stat.st_size, stat.st_mtime_ns
+
+    def get(self, filepath: str) -> pd.DataFrame:
+        """Return the parsed DataFrame for filepath, loading it on a miss"""
+        path = os.path.abspath(filepath)
+        signature = self._signature(path)
+
+        with self._lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry["signature"] == signature:
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return entry["df"]
+            if entry is not None:
+                # File changed on disk since it was cached
+                self._remove(path)
+            self.misses += 1
+
+        # Parse outside the lock so other datasets stay readable meanwhile
+        df = load_dataset(path)
+        self.put(path, df, signature)
+        return df
+
+    def put(self, filepath: str, df: pd.DataFrame, signature: Optional[Tuple[int, int]] = None):
+        """Store an already parsed DataFrame (e.g. right after upload)"""
+        path = os.path.abspath(filepath)
+        if signature is None:
+            signature = self._signature(path)
+        size = private_memory_bytes(df)
+        mapped = max(int(df.memory_usage(deep=True).sum()) - size, 0)
+
+        with self._lock:
+            if path in self.entries:
+                self._remove(path)
+
+            if size > self.max_bytes:
+                # Larger than the whole budget: serve it but don't keep it
+                print(f"[DATASET CACHE]  {os.path.basename(path)} exceeds memory budget, not cached")
+                return
+
+            while self.entries and self.total_bytes + size > self.max_bytes:
+                oldest = next(iter(self.entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+            self.entries[path] = {"df": df, "signature": signature, "bytes": size, "mapped_bytes": mapped}
+            self.total_bytes += size
+
+    def invalidate(self, filepath: str):
+        """Drop a cached dataset, e.g. when the file is re-uploaded"""
+        path = os.path.abspath(filepath)
+        with self._lock:
+            if path in self.entries:
+                self._remove(path)
+
+    def _remove(self, path: str):
+        entry = self.entries.pop(path)
+        self.total_bytes -= entry["bytes"]
+
+    def clear(self):
+        """Clear all cached datasets"""
+        with self._lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def get_stats(self) -> Dict[str, int]:
+        """Get cache statistics"""
+        with self._lock:
+            return {
+                "size": len(self.entries),
+                "memory_bytes": self.total_bytes,
+                "mapped_bytes": sum(entry["mapped_bytes"] for entry in self.entries.values()),
+                "max_memory_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
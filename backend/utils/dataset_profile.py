@@ -0,0 +1,202 @@
+"""
+Dataset profile computed once per upload
+Holds what prompts and request validation need about a dataset (canonical
+schema, fingerprint, per-column cardinality, ranges and null counts, a few
+sample rows) so none of it is recomputed from the DataFrame per query.
+Profiles are plain JSON and stored next to the upload. ProfileBuilder
+merges per-chunk statistics, so datasets read in chunks are profiled
+without ever being loaded whole.
+"""
+import hashlib
+import math
+from typing import Any, Dict, List, Optional
+
+import pandas as pd
+
+PROFILE_VERSION = 2
+SAMPLE_ROWS = 3
+# Text columns with at most this many distinct values list them all in prompts
+MAX_LISTED_VALUES = 12
+# ... and keep them all in the profile, so the rule planner can spot filters on them
+MAX_STORED_VALUES = 1000
+# Distinct values counted exactly per column; above this only "at least" is known
+MAX_TRACKED_DISTINCT = 10000
+
+
+def _json_value(value: Any) -> Any:
+    """Plain JSON value for a pandas/numpy scalar"""
+    if value is None or value is pd.NaT:
+        return None
+    if isinstance(value, pd.Timestamp):
+        return value.isoformat()
+    if hasattr(value, "item"):
+        value = value.item()
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    if isinstance(value, (bool, int, float, str)):
+        return value
+    return str(value)
+
+
+class _ColumnStats:
+    """Running statistics for one column, merged chunk by chunk"""
+
+    def __init__(self, name: str, dtype: str, kind: str):
+        self.name = name
+        self.dtype = dtype
+        self.kind = kind
+        self.nulls = 0
+        self.rows = 0
+        self.min: Any = None
+        self.max: Any = None
+        # Value counts until the column proves high-cardinality; then only a snapshot of the top values
+        self.counts: Optional[pd.Series] = pd.Series(dtype="int64")
+        self.distinct = 0
+        self.top_values: List[Any] = []
+
+    def update(self, column: pd.Series):
+        self.rows += len(column)
+        self.nulls += int(column.isna().sum())
+        if self.kind in "iufM" and column.notna().any():
+            low, high = column.min(), column.max()
+            self.min = low if self.min is None else min(self.min, low)
+            self.max = high if self.max is None else max(self.max, high)
+        if self.counts is None:
+            return
+        observed = column.value_counts()
+        # Categoricals also report unused categories
+        counts = self.counts.add(observed[observed > 0], fill_value=0)
+        if len(counts) > MAX_TRACKED_DISTINCT:
+            self.top_values = list(counts.nlargest(3).index)
+            self.distinct = len(counts)
+            self.counts = None
+        else:
+            self.counts = counts
+
+    def to_dict(self) -> Dict[str, Any]:
+        exact = self.counts is not None
+        profile = {
+            "name": self.name,
+            "dtype": self.dtype,
+            "nulls": self.nulls,
+            "distinct": len(self.counts) if exact else self.distinct,
+        }
+        if not exact:
+            profile["distinct_capped"] = True
+        if self.kind in "iufM" and self.min is not None:
+            profile["min"] = _json_value(self.min)
+            profile["max"] = _json_value(self.max)
+            return profile
+        listed = exact and self.kind != "b"
+        if listed and len(self.counts) <= MAX_STORED_VALUES:
+            profile["values"] = [_json_value(v) for v in self.counts.index]
+        if not listed or len(self.counts) > MAX_LISTED_VALUES:
+            top = self.counts.nlargest(3).index if exact else self.top_values
+            profile["top_values"] = [_json_value(v) for v in top]
+        return profile
+
+
+class ProfileBuilder:
+    """Builds a DatasetProfile from a dataset read in chunks"""
+
+    def __init__(self):
+        self.rows = 0
+        self.columns: Dict[str, _ColumnStats] = {}
+        self.sample: List[Dict[str, Any]] = []
+
+    def update(self, chunk: pd.DataFrame):
+        if not self.columns:
+            for name, column in chunk.items():
+                self.columns[str(name)] = _ColumnStats(str(name), str(column.dtype), column.dtype.kind)
+        if len(self.sample) < SAMPLE_ROWS:
+            self.sample += [
+                {str(k): _json_value(v) for k, v in row.items()}
+                for row in chunk.head(SAMPLE_ROWS - len(self.sample)).to_dict(orient="records")
+            ]
+        self.rows += len(chunk)
+        for name, column in chunk.items():
+            self.columns[str(name)].update(column)
+
+    def build(self) -> "DatasetProfile":
+        return DatasetProfile(self.rows, [stats.to_dict() for stats in self.columns.values()], self.sample)
+
+
+class DatasetProfile:
+    """Canonical description of a dataset's schema and contents"""
+
+    def __init__(self, rows: int, columns: List[Dict[str, Any]], sample: List[Dict[str, Any]]):
+        self.rows = rows
+        self.columns = columns
+        self.sample = sample
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame) -> "DatasetProfile":
+        builder = ProfileBuilder()
+        builder.update(df)
+        return builder.build()
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> Optional["DatasetProfile"]:
+        """Profile from its stored form; None if it was written by another version"""
+        if data.get("version") != PROFILE_VERSION:
+            return None
+        return cls(data["rows"], data["columns"], data["sample"])
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "version": PROFILE_VERSION,
+            "rows": self.rows,
+            "schema": self.schema,
+            "fingerprint": self.fingerprint,
+            "columns": self.columns,
+            "sample": self.sample
+        }
+
+    @property
+    def column_names(self) -> List[str]:
+        return [c["name"] for c in self.columns]
+
+    @property
+    def column_types(self) -> Dict[str, str]:
+        """column -> dtype string, as the rule planner and templates expect"""
+        return {c["name"]: c["dtype"] for c in self.columns}
+
+    @property
+    def column_values(self) -> Dict[str, List[Any]]:
+        """column -> its distinct values, for text columns with at most MAX_STORED_VALUES"""
+        return {c["name"]: c["values"] for c in self.columns if "values" in c}
+
+    @property
+    def shape(self):
+        return self.rows, len(self.columns)
+
+    @property
+    def schema(self) -> str:
+        """Canonical schema string; the plan cache keys on it"""
+        return "Columns: " + ", ".join(f"{c['name']} ({c['dtype']})" for c in self.columns)
+
+    @property
+    def fingerprint(self) -> str:
+        """Hash of column names and dtypes; generated code is reused only on the same one"""
+        schema = "|".join(f"{c['name']}:{c['dtype']}" for c in self.columns)
+        return hashlib.md5(schema.encode()).hexdigest()
+
+    @property
+    def sample_text(self) -> str:
+        return pd.DataFrame(self.sample, columns=self.column_names).to_string()
+
+    def describe(self) -> str:
+        """One line per column with its type, range or values, for prompts"""
+        lines = []
+        for c in self.columns:
+            details = [c["dtype"], f"{c['distinct']}{'+' if c.get('distinct_capped') else ''} distinct"]
+            if "min" in c:
+                details.append(f"{c['min']} to {c['max']}")
+            if "values" in c and len(c["values"]) <= MAX_LISTED_VALUES:
+                details.append("values: " + ", ".join(str(v) for v in c["values"]))
+            elif "top_values" in c:
+                details.append("e.g. " + ", ".join(str(v) for v in c["top_values"]))
+            if c["nulls"]:
+                details.append(f"{c['nulls']} missing")
+            lines.append(f"- {c['name']} ({'; '.join(details)})")
+        return "\n".join(lines)
@@ -0,0 +1,364 @@
+"""
+Columnar on-disk storage for uploaded datasets
+Uploads are converted once to Arrow IPC (Feather) so later loads skip text parsing.
+The file is written as a single uncompressed record batch with large_string
+text columns, so loading it memory-maps the file and wraps its buffers without
+copying: every worker process reads the same page-cache pages.
+Dtypes are optimized before the copy is written (see utils.dtype_optimizer),
+so categories, parsed dates and narrowed numbers are stored as such.
+A JSON profile of the dataset (utils.dataset_profile) is written alongside.
+
+CSVs above OUT_OF_CORE_MB are never loaded whole: they are streamed block by
+block into a multi-batch Arrow file and profiled incrementally, and queries
+read them back one record batch at a time (iter_batches).
+"""
+import hashlib
+import json
+import os
+import threading
+import weakref
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.feather as feather
+
+from utils.dataset_profile import DatasetProfile, ProfileBuilder
+from utils.dtype_optimizer import DATE_SAMPLE_SIZE, infer_date_format, optimize_dtypes
+from utils.logger import get_logger
+
+logger = get_logger()
+
+COLUMNAR_SUFFIX = ".feather"
+PROFILE_SUFFIX = ".profile.json"
+OPTIMIZE_DTYPES = os.getenv("OPTIMIZE_DTYPES", "true").lower() not in ("0", "false", "no")
+OUT_OF_CORE_MB = float(os.getenv("OUT_OF_CORE_MB", "256"))
+INGEST_CHUNK_MB = float(os.getenv("INGEST_CHUNK_MB", "64"))
+MB = 1024 * 1024
+
+# Arrow types that load as pandas views over the mapped buffers
+_ZERO_COPY_TYPES = {pa.large_string(): pd.StringDtype("pyarrow")}
+
+# id(frame) -> bytes of it that live in a file mapping, for frames from load_dataset
+_mapped_sizes: Dict[int, int] = {}
+
+_hash_lock = threading.Lock()
+_content_hashes: Dict[Tuple[str, int, int], str] = {}
+_profile_lock = threading.Lock()
+# path -> (source mtime, profile)
+_profiles: Dict[str, Tuple[int, DatasetProfile]] = {}
+
+
+def read_data_file(filepath: str) -> pd.DataFrame:
+    """Parse an uploaded CSV/XLSX file into a DataFrame"""
+    if filepath.endswith('.csv'):
+        return pd.read_csv(filepath)
+    return pd.read_excel(filepath)
+
+
+def is_out_of_core(filepath: str) -> bool:
+    """Whether a dataset is ingested and queried in chunks instead of loaded whole"""
+    return filepath.endswith('.csv') and os.path.getsize(filepath) > OUT_OF_CORE_MB * MB
+
+
+def parse_dataset(filepath: str) -> Tuple[pd.DataFrame, Dict[str, Any]]:
+    """Parse an uploaded file and optimize its dtypes; returns (df, memory report)"""
+    df = read_data_file(filepath)
+    if not OPTIMIZE_DTYPES:
+        size = int(df.memory_usage(deep=True).sum())
+        return df, {"memory_before_bytes": size, "memory_after_bytes": size,
+                    "reduction_ratio": 1.0, "conversions": {}}
+    return optimize_dtypes(df)
+
+
+def columnar_path(filepath: str) -> str:
+    """Location of the columnar copy for an uploaded file"""
+    return filepath + COLUMNAR_SUFFIX
+
+
+def profile_path(filepath: str) -> str:
+    """Location of the profile sidecar for an uploaded file"""
+    return filepath + PROFILE_SUFFIX
+
+
+def _fresh(path: str, filepath: str) -> Optional[str]:
+    """path if it exists and is not older than the source file"""
+    if not os.path.exists(path):
+        return None
+    if os.path.getmtime(path) < os.path.getmtime(filepath):
+        return None
+    return path
+
+
+def _fresh_columnar_path(filepath: str) -> Optional[str]:
+    return _fresh(columnar_path(filepath), filepath)
+
+
+def _mappable_table(df: pd.DataFrame) -> pa.Table:
+    """Arrow table laid out for zero-copy loading"""
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    # pandas' pyarrow strings are large_string; storing that type avoids a cast (copy) on load
+    fields = [field.with_type(pa.large_string()) if pa.types.is_string(field.type) else field
+              for field in table.schema]
+    return table.cast(pa.schema(fields, metadata=table.schema.metadata)).combine_chunks()
+
+
+def _csv_convert_options(filepath: str, read_options: pacsv.ReadOptions,
+                         relaxed: bool = False) -> Tuple[pacsv.ConvertOptions, Dict[str, str]]:
+    """Column types for a streamed CSV, pinned from its first block
+
+    Text is read as large_string (zero-copy on load) and text that looks like
+    dates as timestamps parsed with the inferred format. relaxed keeps dates
+    as text and reads integers as floats, for files whose later blocks don't
+    fit what the first one suggested.
+    """
+    reader = pacsv.open_csv(filepath, read_options=read_options)
+    schema = reader.schema
+    try:
+        first = reader.read_next_batch()
+        sample = first.slice(0, DATE_SAMPLE_SIZE).to_pandas()
+    except StopIteration:
+        sample = None
+    finally:
+        reader.close()
+
+    column_types: Dict[str, pa.DataType] = {}
+    formats: List[str] = []
+    conversions: Dict[str, str] = {}
+    for field in schema:
+        if pa.types.is_string(field.type) or pa.types.is_null(field.type):
+            fmt = None if relaxed or sample is None else infer_date_format(sample[field.name])
+            if fmt is not None:
+                column_types[field.name] = pa.timestamp("ns")
+                conversions[field.name] = "string -> datetime64[ns]"
+                if fmt not in formats:
+                    formats.append(fmt)
+            else:
+                column_types[field.name] = pa.large_string()
+        elif relaxed and pa.types.is_integer(field.type):
+            column_types[field.name] = pa.float64()
+        else:
+            column_types[field.name] = field.type
+    return pacsv.ConvertOptions(column_types=column_types, timestamp_parsers=formats or None), conversions
+
+
+def _write_chunks(filepath: str, target: str, read_options: pacsv.ReadOptions,
+                  convert_options: pacsv.ConvertOptions) -> Tuple[ProfileBuilder, int, int]:
+    """Stream a CSV into an Arrow file one block at a time; returns (profile, chunks, peak chunk bytes)"""
+    builder = ProfileBuilder()
+    chunks = peak = 0
+    reader = pacsv.open_csv(filepath, read_options=read_options, convert_options=convert_options)
+    with pa.OSFile(target, "wb") as sink, pa.ipc.new_file(sink, reader.schema) as writer:
+        for batch in reader:
+            writer.write_batch(batch)
+            chunk = batch.to_pandas(types_mapper=_ZERO_COPY_TYPES.get)
+            builder.update(chunk)
+            chunks += 1
+            peak = max(peak, batch.nbytes + int(chunk.memory_usage(deep=True).sum()))
+    return builder, chunks, peak
+
+
+def _ingest_chunked(filepath: str) -> Dict[str, Any]:
+    """Out-of-core ingest: columnar copy and profile built block by block"""
+    target = columnar_path(filepath)
+    temp = f"{target}.{os.getpid()}.tmp"
+    read_options = pacsv.ReadOptions(block_size=int(INGEST_CHUNK_MB * MB))
+    try:
+        convert_options, conversions = _csv_convert_options(filepath, read_options)
+        try:
+            builder, chunks, peak = _write_chunks(filepath, temp, read_options, convert_options)
+        except pa.ArrowInvalid as e:
+            logger.log_error("dataset_store", f"Pinned CSV types failed, retrying relaxed: {e}",
+                             {"file": os.path.basename(filepath)})
+            convert_options, conversions = _csv_convert_options(filepath, read_options, relaxed=True)
+            builder, chunks, peak = _write_chunks(filepath, temp, read_options, convert_options)
+        os.replace(temp, target)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+    save_profile(filepath, builder.build())
+    return {
+        "memory_before_bytes": None,
+        "memory_after_bytes": None,
+        "reduction_ratio": None,
+        "conversions": conversions,
+        "out_of_core": True,
+        "chunks": chunks,
+        "peak_chunk_bytes": peak
+    }
+
+
+def ingest(filepath: str) -> Tuple[Optional[pd.DataFrame], Dict[str, Any]]:
+    """Parse an uploaded file once and write its columnar copy next to it
+
+    Returns the parsed frame and the dtype optimizer's memory report. Out-of-
+    core datasets are never materialized: the frame is None and the report
+    describes the chunked ingest instead.
+    """
+    if is_out_of_core(filepath):
+        return None, _ingest_chunked(filepath)
+
+    df, report = parse_dataset(filepath)
+    target = columnar_path(filepath)
+    # Never rewrite the copy in place: frames loaded from it (in any process)
+    # map its pages, and truncating the file under them is a SIGBUS
+    temp = f"{target}.{os.getpid()}.tmp"
+    try:
+        # Uncompressed, one record batch: columns map to contiguous buffers
+        feather.write_feather(_mappable_table(df), temp, compression="uncompressed",
+                              chunksize=max(len(df), 1))
+        os.replace(temp, target)
+    except Exception as e:
+        # e.g. mixed-type object columns Arrow can't represent; keep raw file
+        logger.log_error("dataset_store", f"Columnar conversion failed: {e}", {"file": os.path.basename(filepath)})
+        # Unlinking leaves existing mappings valid
+        if os.path.exists(target):
+            os.remove(target)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+    save_profile(filepath, DatasetProfile.from_frame(df))
+    return df, report
+
+
+def load_dataset(filepath: str) -> pd.DataFrame:
+    """Load a dataset, preferring its memory-mapped columnar copy
+    
+    Frames loaded from the columnar copy are read-only views: numeric columns
+    without nulls and text columns point into the mapped file.
+    """
+    path = _fresh_columnar_path(filepath)
+    if path is None:
+        return parse_dataset(filepath)[0]
+
+    region = pa.memory_map(path).read_buffer()
+    table = pa.ipc.open_file(region).read_all()
+    df = table.to_pandas(split_blocks=True, types_mapper=_ZERO_COPY_TYPES.get)
+    _mapped_sizes[id(df)] = _mapped_bytes(df, region)
+    weakref.finalize(df, _mapped_sizes.pop, id(df), None)
+    return df
+
+
+def iter_batches(filepath: str, columns: Optional[List[str]] = None) -> Iterator[pd.DataFrame]:
+    """The dataset as a sequence of frames, one per stored record batch
+
+    Only the requested columns are converted, so memory stays bounded by
+    one batch however large the file is.
+    """
+    path = _fresh_columnar_path(filepath)
+    if path is None:
+        # No columnar copy (conversion failed): parse the source in pieces
+        if filepath.endswith('.csv'):
+            yield from pd.read_csv(filepath, usecols=columns, chunksize=1_000_000)
+        else:
+            yield read_data_file(filepath)[columns] if columns else read_data_file(filepath)
+        return
+
+    with pa.memory_map(path) as source:
+        reader = pa.ipc.open_file(source)
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i)
+            if columns is not None:
+                batch = batch.select(columns)
+            yield batch.to_pandas(types_mapper=_ZERO_COPY_TYPES.get)
+
+
+def head_rows(filepath: str, n: int) -> pd.DataFrame:
+    """First n rows without loading the dataset"""
+    path = _fresh_columnar_path(filepath)
+    if path is None:
+        return pd.read_csv(filepath, nrows=n) if filepath.endswith('.csv') else read_data_file(filepath).head(n)
+    with pa.memory_map(path) as source:
+        reader = pa.ipc.open_file(source)
+        if reader.num_record_batches == 0:
+            return reader.schema.empty_table().to_pandas()
+        return reader.get_batch(0).slice(0, n).to_pandas(types_mapper=_ZERO_COPY_TYPES.get)
+
+
+def save_profile(filepath: str, profile: DatasetProfile):
+    """Write the profile sidecar and remember it in this process"""
+    with open(profile_path(filepath), "w") as f:
+        json.dump(profile.to_dict(), f)
+    with _profile_lock:
+        _profiles[os.path.abspath(filepath)] = (os.stat(filepath).st_mtime_ns, profile)
+
+
+def load_profile(filepath: str) -> DatasetProfile:
+    """Profile of a dataset: memoized, else read from its sidecar, else rebuilt"""
+    path = os.path.abspath(filepath)
+    mtime = os.stat(path).st_mtime_ns
+    with _profile_lock:
+        cached = _profiles.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    profile = None
+    sidecar = _fresh(profile_path(path), path)
+    if sidecar is not None:
+        try:
+            with open(sidecar) as f:
+                profile = DatasetProfile.from_dict(json.load(f))
+        except (OSError, ValueError, KeyError):
+            profile = None
+    if profile is None:
+        # Uploaded before profiles existed, or the sidecar is stale
+        if is_out_of_core(path):
+            builder = ProfileBuilder()
+            for chunk in iter_batches(path):
+                builder.update(chunk)
+            profile = builder.build()
+        else:
+            profile = DatasetProfile.from_frame(load_dataset(path))
+        save_profile(path, profile)
+        return profile
+
+    with _profile_lock:
+        _profiles[path] = (mtime, profile)
+    return profile
+
+
+def _mapped_bytes(df: pd.DataFrame, region: pa.Buffer) -> int:
+    """Bytes of df's columns whose data points into region"""
+    start, end = region.address, region.address + region.size
+    total = 0
+    for _, column in df.items():
+        values = column.array
+        if isinstance(values, pd.arrays.ArrowStringArray):
+            buffers = [buffer for chunk in values.__arrow_array__().chunks
+                       for buffer in chunk.buffers() if buffer is not None]
+            if buffers and all(start <= buffer.address < end for buffer in buffers):
+                total += int(column.memory_usage(deep=True, index=False))
+        elif column.dtype.kind in "biufcmM":
+            array = column.to_numpy(copy=False)
+            if start <= array.__array_interface__["data"][0] < end:
+                total += array.nbytes
+    return total
+
+
+def private_memory_bytes(df: pd.DataFrame) -> int:
+    """Bytes of df held in process memory rather than in a shared file mapping"""
+    return max(int(df.memory_usage(deep=True).sum()) - _mapped_sizes.get(id(df), 0), 0)
+
+
+def content_hash(filepath: str) -> str:
+    """SHA-256 of the file's bytes, memoized per path, size and mtime"""
+    stat = os.stat(filepath)
+    signature = (os.path.abspath(filepath), stat.st_size, stat.st_mtime_ns)
+    with _hash_lock:
+        cached = _content_hashes.get(signature)
+    if cached is not None:
+        return cached
+
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    value = digest.hexdigest()
+
+    with _hash_lock:
+        # Forget hashes of earlier versions of the same file
+        for stale in [k for k in _content_hashes if k[0] == signature[0]]:
+            del _content_hashes[stale]
+        _content_hashes[signature] = value
+    return value
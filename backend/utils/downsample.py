@@ -0,0 +1,156 @@
+"""
+Point reduction for large charts
+Line series are thinned with LTTB (largest-triangle-three-buckets), which
+keeps the points that give the curve its shape. Scatter points are binned
+into a grid and each non-empty cell is drawn at its centroid, so outliers
+and dense regions survive where random sampling would drop them. The grid
+starts finer than the budget and is coarsened only while too many cells
+are occupied, so clustered data keeps its detail. Both stay within
+CHART_POINT_BUDGET points. Trendlines are least-squares fits over
+all points, made before any reduction.
+
+Only charts are reduced, never a query's result. Where the points are too
+many to hold (SQL engine, chunked scans) the result is a random sample of
+them, and the chart's binned points and trendline are computed from all of
+them upstream (attrs["chart_points"] and attrs["trendline"]).
+"""
+import math
+import os
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+# (x min, x max, y min, y max)
+Bounds = Tuple[float, float, float, float]
+# The finest grid has this many times more cells per axis than the budget allows
+REFINE = 8
+
+
+def point_budget() -> int:
+    return max(int(os.getenv("CHART_POINT_BUDGET", "5000")), 10)
+
+
+def grid_side(budget: int) -> int:
+    """Cells per axis of the finest grid binning starts from"""
+    return max(math.isqrt(budget), 1) * REFINE
+
+
+def _positions(values: pd.Series) -> np.ndarray:
+    """x values LTTB can measure distances on; row order for text labels"""
+    if values.dtype.kind in "iuf":
+        return values.to_numpy(dtype=float)
+    if values.dtype.kind == "M":
+        return values.astype("int64").to_numpy(dtype=float)
+    return np.arange(len(values), dtype=float)
+
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """Indices of the n_out points LTTB keeps from a series sorted by x"""
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    y = np.nan_to_num(y)
+    selected = np.empty(n_out, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    every = (n - 2) / (n_out - 2)
+    a = 0
+    for i in range(n_out - 2):
+        start, end = int(i * every) + 1, int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+        if end >= next_end:
+            next_x, next_y = x[n - 1], y[n - 1]
+        else:
+            next_x, next_y = x[end:next_end].mean(), y[end:next_end].mean()
+        # Keep the bucket's point spanning the largest triangle with the
+        # last kept point and the next bucket's average
+        area = np.abs((x[a] - next_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (next_y - y[a]))
+        a = start + int(np.argmax(area))
+        selected[i + 1] = a
+    return selected
+
+
+def lttb_frame(data: pd.DataFrame, budget: int) -> pd.DataFrame:
+    """Rows of a line chart frame (x first, one column per series) kept by
+    LTTB on each series, budget shared between the series"""
+    series = list(data.columns[1:])
+    if len(data) <= budget or not series:
+        return data
+    x = _positions(data.iloc[:, 0])
+    per_series = max(budget // len(series), 3)
+    keep = np.unique(np.concatenate([
+        lttb_indices(x, pd.to_numeric(data[column], errors="coerce").to_numpy(dtype=float), per_series)
+        for column in series
+    ]))
+    return data.iloc[keep]
+
+
+def grid_cells(x: np.ndarray, y: np.ndarray, bounds: Bounds, side: int) -> pd.DataFrame:
+    """Per non-empty grid cell (column * side + row): point count and sums of x and y
+
+    Cells of different chunks binned on the same bounds add up.
+    """
+    x_min, x_max, y_min, y_max = bounds
+    x_scale = side / (x_max - x_min) if x_max > x_min else 0.0
+    y_scale = side / (y_max - y_min) if y_max > y_min else 0.0
+    column = np.clip(((x - x_min) * x_scale).astype(np.int64), 0, side - 1)
+    row = np.clip(((y - y_min) * y_scale).astype(np.int64), 0, side - 1)
+    cells = pd.DataFrame({"x": x, "y": y, "count": 1}, index=column * side + row)
+    return cells.groupby(level=0).sum()
+
+
+def coarsen(cells: pd.DataFrame, side: int, budget: int) -> pd.DataFrame:
+    """Merge 2x2 blocks of grid_cells cells until at most budget are occupied"""
+    while len(cells) > budget and side > 1:
+        column, row = cells.index // side, cells.index % side
+        side = (side + 1) // 2
+        cells = cells.groupby((column // 2) * side + row // 2).sum()
+    return cells
+
+
+def cell_centroids(cells: pd.DataFrame, x_name: str, y_name: str) -> pd.DataFrame:
+    """One point per cell at the mean of the points in it"""
+    return pd.DataFrame({
+        x_name: cells["x"].to_numpy() / cells["count"].to_numpy(),
+        y_name: cells["y"].to_numpy() / cells["count"].to_numpy()
+    })
+
+
+def grid_bin(points: pd.DataFrame, budget: int) -> pd.DataFrame:
+    """Scatter points (x and y columns, no missing values) reduced to at most budget cell centroids"""
+    if len(points) <= budget:
+        return points
+    x = points.iloc[:, 0].to_numpy(dtype=float)
+    y = points.iloc[:, 1].to_numpy(dtype=float)
+    bounds = (x.min(), x.max(), y.min(), y.max())
+    side = grid_side(budget)
+    cells = coarsen(grid_cells(x, y, bounds, side), side, budget)
+    return cell_centroids(cells, points.columns[0], points.columns[1])
+
+
+def trendline(slope: float, intercept: float, x_min: float, x_max: float) -> Dict[str, List[float]]:
+    """Ends of a fitted line across the x range, as charts draw it"""
+    ends = [float(x_min), float(x_max)]
+    return {"x": ends, "y": [slope * end + intercept for end in ends]}
+
+
+def least_squares(points: pd.DataFrame) -> Optional[Dict[str, List[float]]]:
+    """Trendline of y on x (first two columns) fitted over all points"""
+    x = points.iloc[:, 0].to_numpy(dtype=float)
+    y = points.iloc[:, 1].to_numpy(dtype=float)
+    finite = np.isfinite(x) & np.isfinite(y)
+    x, y = x[finite], y[finite]
+    if len(x) < 2 or x.min() == x.max():
+        return None
+    (slope, intercept), *_ = np.linalg.lstsq(np.column_stack([x, np.ones_like(x)]), y, rcond=None)
+    return trendline(slope, intercept, x.min(), x.max())
+
+
+def trendline_from_sums(n: float, sx: float, sy: float, sxx: float, sxy: float,
+                        x_min: float, x_max: float) -> Optional[Dict[str, List[float]]]:
+    """Least-squares trendline from running sums, for data never held at once"""
+    denominator = n * sxx - sx * sx
+    if n < 2 or denominator <= 0:
+        return None
+    slope = (n * sxy - sx * sy) / denominator
+    return trendline(slope, (sy - slope * sx) / n, x_min, x_max)
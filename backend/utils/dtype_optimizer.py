@@ -0,0 +1,84 @@
+"""
+Ingest-time dtype optimization
+Shrinks freshly parsed datasets: low-cardinality text becomes category, date
+strings are parsed once with an inferred explicit format, and floats are
+downcast where no value changes. Integers stay 64-bit: narrower ones
+overflow silently in generated arithmetic (df['Row ID'] ** 3).
+"""
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from pandas.tseries.api import guess_datetime_format
+
+# Text columns become category only with at most this many distinct values,
+# and at most this share of the rows: names, cities and IDs stay text, since
+# categoricals reject common string idioms (concatenation, assigning new labels)
+CATEGORY_MAX_DISTINCT = 50
+CATEGORY_RATIO = 0.05
+DATE_SAMPLE_SIZE = 200
+
+
+def infer_date_format(values: pd.Series) -> Optional[str]:
+    """Explicit strptime format shared by a sample of values, if they look like dates"""
+    sample = values.dropna()
+    if sample.empty:
+        return None
+    sample = sample.head(DATE_SAMPLE_SIZE).astype(str)
+    fmt = guess_datetime_format(sample.iloc[0])
+    # Needs at least a year and a month, so codes like "CA-2016-152156" stay text
+    if fmt is None or not any(d in fmt for d in ("%Y", "%y")) or not any(d in fmt for d in ("%m", "%b", "%B")):
+        return None
+    try:
+        pd.to_datetime(sample, format=fmt)
+    except (ValueError, TypeError):
+        return None
+    return fmt
+
+
+def _downcast_float(column: pd.Series) -> Optional[pd.Series]:
+    if column.dtype.itemsize <= 4:
+        return None
+    narrowed = column.astype(np.float32)
+    # Only when every value (NaN included) survives the round trip exactly
+    if np.array_equal(narrowed.to_numpy(dtype=np.float64), column.to_numpy(), equal_nan=True):
+        return narrowed
+    return None
+
+
+def optimize_dtypes(df: pd.DataFrame) -> Tuple[pd.DataFrame, Dict[str, Any]]:
+    """Return (optimized frame, report with memory before/after and per-column changes)"""
+    before = int(df.memory_usage(deep=True).sum())
+    columns: Dict[str, pd.Series] = {}
+    changes: Dict[str, str] = {}
+
+    for name, column in df.items():
+        converted = None
+        if column.dtype == object:
+            fmt = infer_date_format(column)
+            if fmt is not None:
+                try:
+                    converted = pd.to_datetime(column, format=fmt)
+                except (ValueError, TypeError):
+                    converted = None
+            if converted is None and len(column):
+                distinct = column.nunique(dropna=True)
+                if distinct <= CATEGORY_MAX_DISTINCT and distinct <= CATEGORY_RATIO * len(column):
+                    converted = column.astype("category")
+        elif pd.api.types.is_float_dtype(column.dtype):
+            converted = _downcast_float(column)
+
+        if converted is not None:
+            changes[str(name)] = f"{column.dtype} -> {converted.dtype}"
+            column = converted
+        columns[name] = column
+
+    optimized = pd.DataFrame(columns, index=df.index)
+    after = int(optimized.memory_usage(deep=True).sum())
+    report = {
+        "memory_before_bytes": before,
+        "memory_after_bytes": after,
+        "reduction_ratio": round(before / after, 2) if after else None,
+        "conversions": changes
+    }
+    return optimized, report
@@ -0,0 +1,101 @@
+"""
+Shared Gemini client setup
+Configures the SDK once per process and reuses model handles so every agent
+talks through the same underlying channel. Calls are spread over all
+configured API keys (GEMINI_API_KEY, GEMINI_API_KEY_2, ...) within each
+model's RPM/RPD limits.
+"""
+import os
+import random
+import re
+import threading
+from typing import Dict, List, Optional
+
+import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
+from google.generativeai import client as genai_client
+from dotenv import load_dotenv
+
+from utils.rate_limiter import RateLimiter, RateLimitExceeded, key_id, load_api_keys
+
+load_dotenv()
+
+_lock = threading.Lock()
+_configured = False
+_models: Dict[str, "RateLimitedModel"] = {}
+_limiter: Optional[RateLimiter] = None
+_key_clients: Dict[str, object] = {}
+
+MAX_RETRIES = int(os.getenv("RATE_LIMIT_RETRIES", "3"))
+_RETRY_DELAY = re.compile(r"retry_delay\s*{[^}]*seconds:\s*(\d+)|retry in ([0-9.]+)s", re.IGNORECASE)
+
+
+def configure():
+    """Configure the Gemini SDK once; later calls are no-ops"""
+    global _configured, _limiter
+    with _lock:
+        if not _configured:
+            keys = load_api_keys()
+            genai.configure(api_key=keys[0])
+            for api_key in keys:
+                # A client per key; GenerativeModel otherwise shares the global one
+                manager = genai_client._ClientManager()
+                manager.configure(api_key=api_key)
+                _key_clients[key_id(api_key)] = manager.get_default_client("generative")
+            _limiter = RateLimiter(list(_key_clients))
+            _configured = True
+
+
+def get_limiter() -> RateLimiter:
+    configure()
+    return _limiter
+
+
+def _retry_after(error: Exception, attempt: int) -> float:
+    """Server-suggested delay from a 429, else exponential backoff with jitter"""
+    match = _RETRY_DELAY.search(str(error))
+    if match:
+        return float(match.group(1) or match.group(2))
+    return min(60.0, 2 ** attempt) + random.uniform(0, 1)
+
+
+class RateLimitedModel:
+    """GenerativeModel stand-in that picks an API key per call"""
+
+    def __init__(self, model_name: str, limiter: RateLimiter, key_clients: Dict[str, object]):
+        self.model_name = model_name
+        self.limiter = limiter
+        self.models: Dict[str, genai.GenerativeModel] = {}
+        for kid, key_client in key_clients.items():
+            model = genai.GenerativeModel(model_name)
+            model._client = key_client
+            self.models[kid] = model
+
+    @property
+    def key_ids(self) -> List[str]:
+        return list(self.models)
+
+    def generate_content(self, *args, **kwargs):
+        """generate_content on the key with the most headroom, retrying 429s"""
+        for attempt in range(MAX_RETRIES + 1):
+            kid = self.limiter.acquire(self.model_name)
+            try:
+                return self.models[kid].generate_content(*args, **kwargs)
+            except (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests) as e:
+                delay = _retry_after(e, attempt)
+                print(f"[RATE LIMIT]  429 for {self.model_name} on key {kid}, backing off {delay:.1f}s")
+                self.limiter.penalize(kid, self.model_name, delay)
+                if attempt == MAX_RETRIES:
+                    raise RateLimitExceeded(f"Rate limit reached for {self.model_name}: {e}") from e
+                # The next acquire moves to another key, or waits out the cooldown
+
+
+def get_model(model_name: str) -> RateLimitedModel:
+    """Get the shared rate-limited model handle for model_name"""
+    configure()
+    with _lock:
+        model = _models.get(model_name)
+        if model is None:
+            model = RateLimitedModel(model_name, _limiter, _key_clients)
+            _models[model_name] = model
+        return model
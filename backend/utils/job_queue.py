@@ -0,0 +1,236 @@
+"""
+Background job queue for long-running queries
+Jobs live in a SQLite file shared by all API workers, so any worker can answer
+status polls; each worker process runs a small thread pool that claims queued
+jobs, picking clients with the fewest running jobs first.
+"""
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Optional, Tuple
+
+
+DEFAULT_JOBS_PATH = os.path.join(tempfile.gettempdir(), "idr_jobs.sqlite3")
+TERMINAL_STATUSES = ("succeeded", "failed", "cancelled")
+
+
+class QueueFullError(Exception):
+    """Raised when a job can't be accepted; the API answers 429"""
+
+
+class JobCancelled(Exception):
+    """Raised by a handler that noticed its job was cancelled"""
+
+
+# handler(payload, is_cancelled) -> (response body, HTTP status code)
+JobHandler = Callable[[Dict[str, Any], Callable[[], bool]], Tuple[Dict[str, Any], int]]
+
+
+class JobQueue:
+    """Bounded, per-client fair job queue with cancellation"""
+
+    def __init__(self, handler: JobHandler, path: Optional[str] = None, workers: Optional[int] = None,
+                 max_queued: Optional[int] = None, max_per_client: Optional[int] = None,
+                 job_timeout: Optional[float] = None, retention: Optional[float] = None,
+                 poll_interval: float = 0.5):
+        self.handler = handler
+        self.path = path or os.getenv("JOBS_PATH", DEFAULT_JOBS_PATH)
+        self.workers = workers if workers is not None else int(os.getenv("JOB_WORKERS", "2"))
+        self.max_queued = max_queued if max_queued is not None else int(os.getenv("MAX_QUEUED_JOBS", "20"))
+        self.max_per_client = (max_per_client if max_per_client is not None
+                               else int(os.getenv("MAX_JOBS_PER_CLIENT", "5")))
+        self.job_timeout = job_timeout if job_timeout is not None else float(os.getenv("JOB_TIMEOUT_SECONDS", "300"))
+        self.retention = retention if retention is not None else float(os.getenv("JOB_RETENTION_SECONDS", "3600"))
+        self.poll_interval = poll_interval
+        self._local = threading.local()
+        self._wakeup = threading.Event()
+        self._threads_pid: Optional[int] = None
+        self._threads_lock = threading.Lock()
+        self._init_schema()
+
+    def _connect(self) -> sqlite3.Connection:
+        """One connection per thread (and per process after a fork)"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        """Write transaction; BEGIN IMMEDIATE serializes writers across workers"""
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _init_schema(self):
+        self._connect().executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                client_id TEXT NOT NULL,
+                status TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                result TEXT,
+                status_code INTEGER,
+                error TEXT,
+                cancel_requested INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at);
+            CREATE INDEX IF NOT EXISTS idx_jobs_client ON jobs (client_id, status);
+        """)
+
+    @staticmethod
+    def _record(row: sqlite3.Row) -> Dict[str, Any]:
+        record = {
+            "job_id": row["id"],
+            "status": row["status"],
+            "created_at": row["created_at"],
+            "started_at": row["started_at"],
+            "finished_at": row["finished_at"],
+            "cancel_requested": bool(row["cancel_requested"])
+        }
+        if row["status"] in TERMINAL_STATUSES:
+            record["result"] = json.loads(row["result"]) if row["result"] else None
+            record["status_code"] = row["status_code"]
+            record["error"] = row["error"]
+        return record
+
+    def _expire(self, conn: sqlite3.Connection, now: float):
+        """Fail jobs whose worker died mid-run and drop old finished jobs"""
+        conn.execute(
+            "UPDATE jobs SET status = 'failed', error = 'Job timed out', status_code = 504, finished_at = ? "
+            "WHERE status = 'running' AND started_at < ?",
+            (now, now - self.job_timeout)
+        )
+        conn.execute(
+            f"DELETE FROM jobs WHERE status IN {TERMINAL_STATUSES} AND finished_at < ?",
+            (now - self.retention,)
+        )
+
+    def submit(self, payload: Dict[str, Any], client_id: str) -> Dict[str, Any]:
+        """Queue a job, raising QueueFullError when the queue or the client's share is full"""
+        now = time.time()
+        job_id = uuid.uuid4().hex
+        with self._transaction() as conn:
+            self._expire(conn, now)
+            queued = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+            if queued >= self.max_queued:
+                raise QueueFullError(f"Job queue is full ({queued} waiting)")
+            active = conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE client_id = ? AND status IN ('queued', 'running')",
+                (client_id,)
+            ).fetchone()[0]
+            if active >= self.max_per_client:
+                raise QueueFullError(f"Too many jobs in progress for this client ({active})")
+            conn.execute(
+                "INSERT INTO jobs (id, client_id, status, payload, created_at) VALUES (?, ?, 'queued', ?, ?)",
+                (job_id, client_id, json.dumps(payload), now)
+            )
+        self._ensure_workers()
+        self._wakeup.set()
+        return self.get(job_id)
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Current state of a job, with its result once finished"""
+        row = self._connect().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._record(row) if row else None
+
+    def cancel(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Cancel a queued job now, or ask a running one to stop at its next stage"""
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'cancelled', finished_at = ? WHERE id = ? AND status = 'queued'",
+                (time.time(), job_id)
+            )
+            conn.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status = 'running'", (job_id,))
+        return self.get(job_id)
+
+    def is_cancelled(self, job_id: str) -> bool:
+        row = self._connect().execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return bool(row and row[0])
+
+    def _ensure_workers(self):
+        """Start this process's worker threads (lazily, so they never cross a fork)"""
+        with self._threads_lock:
+            if self._threads_pid == os.getpid():
+                return
+            self._threads_pid = os.getpid()
+            for i in range(self.workers):
+                threading.Thread(target=self._work, name=f"job-worker-{i}", daemon=True).start()
+
+    def _claim(self) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """Take the next job: clients with the fewest running jobs first, then oldest"""
+        now = time.time()
+        with self._transaction() as conn:
+            self._expire(conn, now)
+            row = conn.execute("""
+                SELECT id, payload FROM jobs AS j
+                WHERE status = 'queued'
+                ORDER BY (SELECT COUNT(*) FROM jobs AS r
+                          WHERE r.client_id = j.client_id AND r.status = 'running'),
+                         created_at
+                LIMIT 1
+            """).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE jobs SET status = 'running', started_at = ? WHERE id = ?", (now, row["id"]))
+        return row["id"], json.loads(row["payload"])
+
+    def _finish(self, job_id: str, status: str, result: Optional[Dict[str, Any]] = None,
+                status_code: Optional[int] = None, error: Optional[str] = None):
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, status_code = ?, error = ?, finished_at = ? "
+                "WHERE id = ? AND status = 'running'",
+                (status, json.dumps(result, default=str) if result is not None else None,
+                 status_code, error, time.time(), job_id)
+            )
+
+    def _work(self):
+        while True:
+            try:
+                job = self._claim()
+            except sqlite3.Error as e:
+                print(f"[JOBS]  Claim failed: {e}")
+                job = None
+            if job is None:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+
+            job_id, payload = job
+            try:
+                body, status_code = self.handler(payload, lambda: self.is_cancelled(job_id))
+                status = "succeeded" if status_code < 400 else "failed"
+                self._finish(job_id, status, body, status_code, body.get("error") if status == "failed" else None)
+            except JobCancelled:
+                self._finish(job_id, "cancelled")
+            except Exception as e:
+                self._finish(job_id, "failed", None, 500, str(e))
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Job counts by status and the queue limits"""
+        rows = self._connect().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return {
+            "counts": {row[0]: row[1] for row in rows},
+            "workers_per_process": self.workers,
+            "max_queued": self.max_queued,
+            "max_per_client": self.max_per_client
+        }
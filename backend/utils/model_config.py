@@ -18,28 +18,36 @@ class ModelConfig:
             "name": "Gemini 2.5 Flash",
             "description": "Fast, efficient (Free: 5 RPM, 20 RPD)",
             "api_key_env": "GEMINI_API_KEY",
-            "limits": "5 RPM / 20 RPD"
+            "limits": "5 RPM / 20 RPD",
+            "rpm": 5,
+            "rpd": 20
         },
         "gemini-2.5-pro": {
             "provider": "gemini",
             "name": "Gemini 2.5 Pro",
             "description": "More capable, slower (Free: 2 RPM, 10 RPD)",
             "api_key_env": "GEMINI_API_KEY",
-            "limits": "2 RPM / 10 RPD"
+            "limits": "2 RPM / 10 RPD",
+            "rpm": 2,
+            "rpd": 10
         },
         "gemini-2.0-flash": {
             "provider": "gemini",
             "name": "Gemini 2.0 Flash",
             "description": "Previous generation, stable",
             "api_key_env": "GEMINI_API_KEY",
-            "limits": "5 RPM / 20 RPD"
+            "limits": "5 RPM / 20 RPD",
+            "rpm": 5,
+            "rpd": 20
         },
         "gemini-2.5-flash-lite": {
             "provider": "gemini",
             "name": "Gemini 2.5 Flash Lite",
             "description": "Ultra-fast, basic tasks",
             "api_key_env": "GEMINI_API_KEY",
-            "limits": "10 RPM / 40 RPD"
+            "limits": "10 RPM / 40 RPD",
+            "rpm": 10,
+            "rpd": 40
         },
     }
     
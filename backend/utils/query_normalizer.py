@@ -0,0 +1,171 @@
+"""
+Query canonicalization and near-duplicate matching for cache lookups
+Runs fully offline: queries are compared with character n-gram TF-IDF vectors.
+"""
+import re
+import threading
+import zlib
+from typing import Dict, FrozenSet, Iterable, Optional, Tuple
+
+import numpy as np
+
+# Common synonyms, applied only when the target column exists in the dataset
+QUERY_ALIASES = {
+    "revenue": "sales",
+    "turnover": "sales",
+    "earnings": "profit",
+    "qty": "quantity",
+    "units": "quantity",
+    "shipping mode": "ship mode",
+    "client": "customer",
+    "clients": "customer",
+}
+
+_PUNCTUATION = re.compile(r"[^\w\s]")
+_SEPARATORS = re.compile(r"[-_/]")
+_NUMBERS = re.compile(r"\d+(?:\.\d+)?")
+# Numbers and content words of a query; near-duplicates must agree on both
+Signature = Tuple[Tuple[str, ...], FrozenSet[str]]
+# Words near-duplicate questions may add or drop without changing what they ask
+FILLER_WORDS = frozenset("""
+    a an the of to me my i we you can could would please what which is are was were do does
+    show display give get list tell find see view create make draw plot visualize
+    chart graph all total by per for each in across with and
+""".split())
+
+
+def normalize_text(text: str) -> str:
+    """Lowercase and replace separators/punctuation with single spaces"""
+    text = _SEPARATORS.sub(" ", text.lower())
+    text = _PUNCTUATION.sub(" ", text)
+    return " ".join(text.split())
+
+
+def canonicalize_query(query: str, columns: Optional[Iterable[str]] = None) -> str:
+    """Lowercase, strip punctuation/whitespace and map column-name aliases"""
+    text = f" {normalize_text(query)} "
+
+    column_forms = {normalize_text(str(col)) for col in (columns or [])}
+
+    # "subcategory" / "sub_category" -> "sub category"
+    for form in column_forms:
+        compact = form.replace(" ", "")
+        if compact != form:
+            text = text.replace(f" {compact} ", f" {form} ")
+
+    for alias, target in QUERY_ALIASES.items():
+        if columns is None or target in column_forms:
+            text = re.sub(rf"\b{alias}\b", target, text)
+
+    return " ".join(text.split())
+
+
+def _numbers(text: str) -> Tuple[str, ...]:
+    return tuple(_NUMBERS.findall(text))
+
+
+def _content_words(text: str) -> FrozenSet[str]:
+    """Words of a canonical query that carry meaning, plurals folded ("regions" -> "region")"""
+    return frozenset(word[:-1] if len(word) > 3 and word.endswith("s") else word
+                     for word in text.split() if word not in FILLER_WORDS)
+
+
+def _signature(text: str) -> Signature:
+    """What two near-duplicate queries must agree on: their numbers and content words"""
+    return _numbers(text), _content_words(text)
+
+
+class QuerySimilarityIndex:
+    """Character n-gram TF-IDF index over cached queries
+
+    Vectors are hashed into a fixed feature space and L2-normalized. A query
+    only ever matches one with the same numbers and content words ("top 5"
+    never reuses "top 10", "east" never reuses "west"), so queries are
+    bucketed by that signature: a lookup scores just its own bucket, in one
+    vectorized pass, and a query with an unseen signature misses without
+    scoring anything. Document frequencies are updated on every insert and
+    removal, so IDF weights are always current and nothing is rebuilt.
+    """
+
+    def __init__(self, threshold: float = 0.85, ngram_range: Tuple[int, int] = (3, 5),
+                 n_features: int = 2 ** 18):
+        self.threshold = threshold
+        self.ngram_range = ngram_range
+        self.n_features = n_features
+        # key -> (signature, hashed n-gram ids, sublinear term frequencies)
+        self.entries: Dict[str, Tuple[Signature, np.ndarray, np.ndarray]] = {}
+        # signature -> keys with that signature, in insertion order
+        self.buckets: Dict[Signature, Dict[str, None]] = {}
+        self._doc_freq = np.zeros(n_features, dtype=np.int64)
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def _ngrams(self, text: str) -> Tuple[np.ndarray, np.ndarray]:
+        padded = f" {text} "
+        low, high = self.ngram_range
+        hashed = [
+            zlib.crc32(padded[i:i + n].encode()) % self.n_features
+            for n in range(low, high + 1)
+            for i in range(len(padded) - n + 1)
+        ]
+        features, counts = np.unique(np.asarray(hashed, dtype=np.int64), return_counts=True)
+        return features, (1.0 + np.log(counts)).astype(np.float32)
+
+    def _idf(self, features: np.ndarray) -> np.ndarray:
+        return (np.log((1 + len(self.entries)) / (1 + self._doc_freq[features])) + 1.0).astype(np.float32)
+
+    def add(self, key: str, text: str):
+        """Index a cached query under its cache key"""
+        with self._lock:
+            if key in self.entries:
+                return
+            signature = _signature(text)
+            features, tf = self._ngrams(text)
+            self.entries[key] = (signature, features, tf)
+            self.buckets.setdefault(signature, {})[key] = None
+            self._doc_freq[features] += 1
+
+    def remove(self, key: str):
+        """Forget a key (e.g. its cache entry was evicted)"""
+        with self._lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return
+            signature, features, _ = entry
+            bucket = self.buckets[signature]
+            del bucket[key]
+            if not bucket:
+                del self.buckets[signature]
+            self._doc_freq[features] -= 1
+
+    def find(self, text: str) -> Optional[Tuple[str, float]]:
+        """Most similar indexed query above the threshold, as (key, score)"""
+        with self._lock:
+            bucket = self.buckets.get(_signature(text))
+            if not bucket:
+                return None
+            features, tf = self._ngrams(text)
+            weights = tf * self._idf(features)
+            weights /= np.linalg.norm(weights)
+
+            # Every query of the bucket as one flat run of (row, n-gram, weight)
+            keys = list(bucket)
+            docs = [self.entries[key] for key in keys]
+            lengths = np.fromiter((len(doc[1]) for doc in docs), dtype=np.int64, count=len(docs))
+            rows = np.repeat(np.arange(len(docs)), lengths)
+            doc_features = np.concatenate([doc[1] for doc in docs])
+            doc_weights = np.concatenate([doc[2] for doc in docs]) * self._idf(doc_features)
+            norms = np.sqrt(np.bincount(rows, weights=doc_weights ** 2, minlength=len(docs)))
+
+            # features is sorted, so each stored n-gram maps to its query weight by bisection
+            positions = np.minimum(np.searchsorted(features, doc_features), len(features) - 1)
+            matched = features[positions] == doc_features
+            dots = np.bincount(rows, weights=np.where(matched, doc_weights * weights[positions], 0.0),
+                               minlength=len(docs))
+            scores = dots / np.maximum(norms, 1e-12)
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                return None
+            return keys[best], float(scores[best])
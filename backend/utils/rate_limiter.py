@@ -0,0 +1,192 @@
+"""
+Client-side rate limiting for Gemini calls
+One token bucket per (API key, model), refilled at the model's RPM and capped
+by its RPD. State lives in SQLite so every API worker on the host draws from
+the same budget.
+"""
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import List, Optional, Tuple
+from zoneinfo import ZoneInfo
+
+from utils.model_config import ModelConfig
+
+
+DEFAULT_RATE_LIMIT_PATH = os.path.join(tempfile.gettempdir(), "idr_ratelimit.sqlite3")
+# Gemini daily quotas reset at midnight Pacific time
+QUOTA_TIMEZONE = ZoneInfo("America/Los_Angeles")
+
+
+class RateLimitExceeded(Exception):
+    """No key has headroom for the model within the allowed wait"""
+
+
+def load_api_keys() -> List[Optional[str]]:
+    """GEMINI_API_KEY plus GEMINI_API_KEY_2, _3, ... as configured"""
+    keys = [os.getenv("GEMINI_API_KEY")]
+    suffix = 2
+    while os.getenv(f"GEMINI_API_KEY_{suffix}"):
+        keys.append(os.getenv(f"GEMINI_API_KEY_{suffix}"))
+        suffix += 1
+    keys = [key for key in keys if key]
+    # No key at all: let the SDK fall back to its own environment lookup
+    return keys or [None]
+
+
+def key_id(api_key: Optional[str]) -> str:
+    """Stable identifier for a key that doesn't expose it"""
+    if not api_key:
+        return "default"
+    return hashlib.sha256(api_key.encode()).hexdigest()[:12]
+
+
+class RateLimiter:
+    """Token buckets per (key, model) shared across processes through SQLite"""
+
+    def __init__(self, key_ids: List[str], path: Optional[str] = None, max_wait: Optional[float] = None):
+        self.key_ids = key_ids
+        self.path = path or os.getenv("RATE_LIMIT_PATH", DEFAULT_RATE_LIMIT_PATH)
+        self.max_wait = max_wait if max_wait is not None else float(os.getenv("RATE_LIMIT_MAX_WAIT", "30"))
+        self._local = threading.local()
+        self._init_schema()
+
+    def _connect(self) -> sqlite3.Connection:
+        """One connection per thread (and per process after a fork)"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        """Write transaction; BEGIN IMMEDIATE serializes writers across workers"""
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _init_schema(self):
+        self._connect().executescript("""
+            CREATE TABLE IF NOT EXISTS rate_buckets (
+                key_id TEXT NOT NULL,
+                model TEXT NOT NULL,
+                tokens REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                cooldown_until REAL NOT NULL DEFAULT 0,
+                day TEXT NOT NULL,
+                used_today INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (key_id, model)
+            );
+        """)
+
+    @staticmethod
+    def limits(model: str) -> Tuple[float, Optional[int]]:
+        """(requests per minute, requests per day or None) for model"""
+        info = ModelConfig.get_model_info(model)
+        return float(info.get("rpm", 5)), info.get("rpd")
+
+    def _buckets(self, conn: sqlite3.Connection, model: str, now: float):
+        """Refilled bucket state per key, as (key_id, tokens, cooldown_until, used_today)"""
+        rpm, _ = self.limits(model)
+        today = datetime.fromtimestamp(now, QUOTA_TIMEZONE).date().isoformat()
+        rows = {
+            row[0]: row[1:]
+            for row in conn.execute(
+                "SELECT key_id, tokens, updated_at, cooldown_until, day, used_today "
+                "FROM rate_buckets WHERE model = ?", (model,)
+            )
+        }
+        buckets = []
+        for kid in self.key_ids:
+            if kid not in rows:
+                # New buckets start full
+                conn.execute(
+                    "INSERT INTO rate_buckets (key_id, model, tokens, updated_at, day) VALUES (?, ?, ?, ?, ?)",
+                    (kid, model, rpm, now, today)
+                )
+                buckets.append((kid, rpm, 0.0, 0))
+                continue
+            tokens, updated_at, cooldown_until, day, used_today = rows[kid]
+            tokens = min(rpm, tokens + (now - updated_at) * rpm / 60.0)
+            buckets.append((kid, tokens, cooldown_until, used_today if day == today else 0))
+        return buckets, today
+
+    def _try_acquire(self, model: str) -> Tuple[Optional[str], float]:
+        """Take a token from the key with the most headroom; else (None, seconds to wait)"""
+        rpm, rpd = self.limits(model)
+        now = time.time()
+        with self._transaction() as conn:
+            buckets, today = self._buckets(conn, model, now)
+            ready = [
+                (tokens, (rpd or 0) - used, kid)
+                for kid, tokens, cooldown_until, used in buckets
+                if tokens >= 1 and cooldown_until <= now and (rpd is None or used < rpd)
+            ]
+            if ready:
+                tokens, _, kid = max(ready)
+                used = next(b[3] for b in buckets if b[0] == kid)
+                conn.execute(
+                    "UPDATE rate_buckets SET tokens = ?, updated_at = ?, day = ?, used_today = ? "
+                    "WHERE key_id = ? AND model = ?",
+                    (tokens - 1, now, today, used + 1, kid, model)
+                )
+                return kid, 0.0
+
+            waits = [
+                max(cooldown_until - now, (1 - tokens) * 60.0 / rpm, 0.0)
+                for _, tokens, cooldown_until, used in buckets
+                if rpd is None or used < rpd
+            ]
+        if not waits:
+            raise RateLimitExceeded(f"Daily rate limit reached for {model} on all API keys")
+        return None, min(waits)
+
+    def acquire(self, model: str) -> str:
+        """Block until a key has headroom for model (up to max_wait) and return its id"""
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            kid, wait = self._try_acquire(model)
+            if kid is not None:
+                return kid
+            remaining = deadline - time.monotonic()
+            if wait > remaining:
+                raise RateLimitExceeded(
+                    f"Rate limit reached for {model} on all API keys, retry in {wait:.0f}s"
+                )
+            time.sleep(wait + 0.05)
+
+    def penalize(self, kid: str, model: str, retry_after: float):
+        """Back a key off after the server answered 429"""
+        now = time.time()
+        with self._transaction() as conn:
+            self._buckets(conn, model, now)
+            conn.execute(
+                "UPDATE rate_buckets SET tokens = 0, updated_at = ?, cooldown_until = ? "
+                "WHERE key_id = ? AND model = ?",
+                (now, now + retry_after, kid, model)
+            )
+
+    def get_stats(self):
+        """Remaining tokens and daily usage per key and model"""
+        rows = self._connect().execute(
+            "SELECT key_id, model, tokens, cooldown_until, day, used_today FROM rate_buckets"
+        ).fetchall()
+        return [
+            {"key": kid, "model": model, "tokens": round(tokens, 2), "cooldown_until": cooldown_until,
+             "day": day, "used_today": used_today}
+            for kid, model, tokens, cooldown_until, day, used_today in rows
+        ]
@@ -0,0 +1,113 @@
+"""
+Single-pass serialization of query responses
+A chart is serialized once, straight from the Plotly figure or chart spec
+(ExecutorAgent._chart_spec): numeric arrays become base64 typed arrays
+({"dtype": "f8", "bdata": ...}, which plotly.js decodes natively) instead
+of long decimal lists. From then on a response's
+"chart" is that JSON text, in the response cache and in job results too, and
+encode_response splices it into bodies verbatim instead of parsing and
+re-encoding it. Bodies can then be compressed for clients that accept it.
+"""
+import base64
+import gzip
+import json
+import secrets
+from typing import Any, Optional
+
+import numpy as np
+from plotly.utils import PlotlyJSONEncoder
+
+try:
+    import brotli
+except ImportError:  # optional: gzip only
+    brotli = None
+
+# Smaller bodies aren't worth the compression CPU
+MIN_COMPRESS_BYTES = 1024
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+
+
+def _typed_array(values: np.ndarray) -> Any:
+    """plotly.js typed array spec for a 1-D numeric array; other arrays pass through"""
+    if values.ndim != 1 or values.dtype.kind not in "iuf":
+        return values
+    if values.dtype.itemsize == 8 and values.dtype.kind in "iu":
+        # plotly.js has no 64-bit integer arrays
+        fits = len(values) == 0 or (values.min() >= np.iinfo(np.int32).min and values.max() <= np.iinfo(np.int32).max)
+        values = values.astype("<i4" if fits else "<f8")
+    values = np.ascontiguousarray(values, dtype=values.dtype.newbyteorder("<"))
+    return {
+        "dtype": f"{values.dtype.kind}{values.dtype.itemsize}",
+        "bdata": base64.b64encode(values.tobytes()).decode("ascii")
+    }
+
+
+def _with_typed_arrays(value: Any) -> Any:
+    if isinstance(value, dict):
+        return {k: _with_typed_arrays(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_with_typed_arrays(v) for v in value]
+    if isinstance(value, np.ndarray):
+        return _typed_array(value)
+    return value
+
+
+def encode_chart(chart) -> Optional[str]:
+    """JSON text for a Plotly figure or a chart spec dict, with numeric arrays as typed arrays"""
+    if chart is None:
+        return None
+    data = chart.to_plotly_json() if hasattr(chart, "to_plotly_json") else chart
+    return json.dumps(_with_typed_arrays(data), cls=PlotlyJSONEncoder, separators=(",", ":"))
+
+
+def encode_response(payload: Any) -> bytes:
+    """JSON body for payload; "chart" values that are JSON text are embedded as-is"""
+    token = secrets.token_hex(8)
+    charts = []
+
+    def embed(value):
+        if isinstance(value, dict):
+            embedded = {}
+            for k, v in value.items():
+                if k == "chart" and isinstance(v, str):
+                    charts.append(v)
+                    embedded[k] = f"{token}:{len(charts) - 1}"
+                else:
+                    embedded[k] = embed(v)
+            return embedded
+        if isinstance(value, list):
+            return [embed(v) for v in value]
+        return value
+
+    body = json.dumps(embed(payload), default=str, separators=(",", ":"))
+    for i, chart in enumerate(charts):
+        body = body.replace(f'"{token}:{i}"', chart, 1)
+    return body.encode("utf-8")
+
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    """"br" or "gzip" if the Accept-Encoding header allows it, preferring brotli"""
+    accepted = {}
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip()] = quality
+    if brotli is not None and accepted.get("br", 0) > 0:
+        return "br"
+    if accepted.get("gzip", 0) > 0:
+        return "gzip"
+    return None
+
+
+def compress(body: bytes, encoding: Optional[str]) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=GZIP_LEVEL)
+    return body
@@ -0,0 +1,296 @@
+"""
+Sandboxed execution of generated pandas code
+A pool of pre-started worker processes keeps recently used datasets loaded
+and runs code under a wall-clock deadline and a memory cap. The cap counts
+memory private to the worker, not the memory-mapped dataset pages every
+worker shares; an RLIMIT_DATA set inside the worker stops allocations too
+fast for the parent's polling.
+Results come back as pickle protocol 5 with out-of-band buffers, so column
+data is sent as raw bytes instead of being copied into the pickle stream.
+A worker that overruns is killed and replaced before the next request.
+"""
+import multiprocessing
+import os
+import pickle
+import queue
+import threading
+import time
+from typing import Any, List, Optional
+
+try:
+    import resource
+except ImportError:  # not on Windows: polling only
+    resource = None
+
+import pandas as pd
+
+# Same isolation as in-process execution: writes never reach the cached frame
+pd.set_option("mode.copy_on_write", True)
+
+
+class SandboxError(Exception):
+    """Generated code could not be run to completion in the sandbox"""
+
+
+class SandboxTimeout(SandboxError):
+    """Code exceeded its wall-clock deadline"""
+
+
+class SandboxMemoryError(SandboxError):
+    """Code pushed the worker over its memory limit"""
+
+
+# RLIMIT_DATA counts reserved (virtual) memory, so it sits above the polled cap
+DATA_LIMIT_FACTOR = 1.5
+
+
+def _worker_main(conn, dataset_cache_mb: float, data_limit_bytes: Optional[int] = None):
+    """Worker loop: ('load', path) warms a dataset, ('run', path, code) executes code on it"""
+    from utils.dataset_cache import DatasetCache
+
+    if resource is not None and data_limit_bytes:
+        # Allocations past it raise MemoryError here instead of exhausting the host
+        resource.setrlimit(resource.RLIMIT_DATA, (data_limit_bytes, data_limit_bytes))
+    datasets = DatasetCache(max_memory_mb=dataset_cache_mb)
+    conn.send(("ready",))
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            return
+
+        try:
+            if message[0] == "load":
+                datasets.get(message[1])
+                conn.send(("ok", 0))
+                continue
+
+            _, filepath, code = message
+            # New frame object so column changes stay local (copy-on-write shares the data)
+            exec_globals = {"df": datasets.get(filepath).copy(deep=False), "pd": pd, "result": None}
+            exec(code, exec_globals)
+            buffers: List[pickle.PickleBuffer] = []
+            payload = pickle.dumps(exec_globals.get("result"), protocol=5, buffer_callback=buffers.append)
+        except Exception as e:
+            conn.send(("error", type(e).__name__, str(e)))
+            continue
+
+        conn.send(("ok", len(buffers)))
+        conn.send_bytes(payload)
+        for buffer in buffers:
+            conn.send_bytes(buffer.raw())
+
+
+def _context():
+    """forkserver where available: workers fork from a clean server that has
+    already imported pandas, so replacements start fast and inherit no
+    threads or locks from the API process; spawn elsewhere"""
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["utils.sandbox", "utils.dataset_cache"])
+        return context
+    return multiprocessing.get_context("spawn")
+
+
+def _private_bytes(pid: int) -> Optional[int]:
+    """Memory pid allocated itself (anonymous pages, resident or swapped), or None where /proc isn't available
+
+    Memory-mapped dataset pages are file pages shared through the page cache,
+    so they don't count. (Private_Dirty would count them while a freshly
+    written dataset is still waiting for writeback.)
+    """
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            return sum(int(line.split()[1]) * 1024 for line in f
+                       if line.startswith(("Anonymous:", "Swap:")))
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        # Older kernels: resident minus file-backed pages
+        with open(f"/proc/{pid}/statm") as f:
+            fields = f.read().split()
+        return (int(fields[1]) - int(fields[2])) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class _Worker:
+    def __init__(self, context, dataset_cache_mb: float, data_limit_bytes: Optional[int]):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn, dataset_cache_mb, data_limit_bytes),
+                                       daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.ready = False
+
+    def kill(self):
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join(timeout=5)
+        self.conn.close()
+
+
+class SandboxPool:
+    """Fixed-size pool of sandbox processes"""
+
+    STARTUP_TIMEOUT = 60.0
+
+    def __init__(self, size: int, timeout: float = 30.0, memory_mb: float = 1024.0,
+                 dataset_cache_mb: float = 256.0):
+        self.size = size
+        self.timeout = timeout
+        self.memory_bytes = int(memory_mb * 1024 * 1024)
+        self.data_limit_bytes = int(self.memory_bytes * DATA_LIMIT_FACTOR)
+        self.dataset_cache_mb = dataset_cache_mb
+        self.context = _context()
+        self.idle: "queue.Queue[_Worker]" = queue.Queue()
+        self.runs = 0
+        self.timeouts = 0
+        self.memory_kills = 0
+        self.crashes = 0
+        self.replacements = 0
+        self._stats_lock = threading.Lock()
+        self._preload_lock = threading.Lock()
+        # Started now so interpreter and pandas imports are done before the first query
+        for _ in range(size):
+            self.idle.put(self._new_worker())
+
+    def _new_worker(self) -> _Worker:
+        return _Worker(self.context, self.dataset_cache_mb, self.data_limit_bytes)
+
+    def _count(self, counter: str):
+        with self._stats_lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _replace(self, worker: _Worker):
+        worker.kill()
+        self._count("replacements")
+        self.idle.put(self._new_worker())
+
+    def _wait(self, worker: _Worker, deadline: Optional[float]):
+        """Block until the worker replies, enforcing deadline and memory cap"""
+        while not worker.conn.poll(0.05):
+            if not worker.process.is_alive():
+                self._count("crashes")
+                raise SandboxError("Sandbox worker exited unexpectedly")
+            if deadline is not None and time.monotonic() > deadline:
+                self._count("timeouts")
+                raise SandboxTimeout(f"Code took longer than {self.timeout:.0f}s and was stopped")
+            used = _private_bytes(worker.process.pid)
+            if used is not None and used > self.memory_bytes:
+                self._memory_exceeded()
+
+    def _memory_exceeded(self):
+        self._count("memory_kills")
+        raise SandboxMemoryError(f"Code used more than {self.memory_bytes // (1024 * 1024)} MB and was stopped")
+
+    def _ensure_ready(self, worker: _Worker):
+        if worker.ready:
+            return
+        if not worker.conn.poll(self.STARTUP_TIMEOUT):
+            raise SandboxError("Sandbox worker failed to start")
+        worker.conn.recv()
+        worker.ready = True
+
+    def _call(self, message: tuple) -> Any:
+        return self._exchange(self.idle.get(), message)
+
+    def _exchange(self, worker: _Worker, message: tuple) -> Any:
+        """Send message to a worker taken from the idle queue and return its reply;
+        the worker goes back to the queue, or is replaced if it misbehaved"""
+        healthy = False
+        try:
+            self._ensure_ready(worker)
+            worker.conn.send(message)
+            deadline = time.monotonic() + self.timeout if message[0] == "run" else None
+            self._wait(worker, deadline)
+            header = worker.conn.recv()
+            if header[0] == "error" and header[1] == "MemoryError":
+                # Hit RLIMIT_DATA; replaced, as its heap may be left fragmented
+                self._memory_exceeded()
+            if header[0] == "error":
+                healthy = True
+                # Same type name and message the in-process exec would show
+                raise SandboxError(f"{header[1]}: {header[2]}")
+            if message[0] == "load":
+                healthy = True
+                return None
+            payload = worker.conn.recv_bytes()
+            buffers = [worker.conn.recv_bytes() for _ in range(header[1])]
+            healthy = True
+            return pickle.loads(payload, buffers=buffers)
+        except (EOFError, OSError) as e:
+            self._count("crashes")
+            raise SandboxError(f"Sandbox worker exited unexpectedly ({type(e).__name__})") from e
+        finally:
+            if healthy:
+                self.idle.put(worker)
+            else:
+                self._replace(worker)
+
+    def run(self, filepath: str, code: str) -> Any:
+        """Execute code with `df` bound to the dataset at filepath; returns `result`"""
+        self._count("runs")
+        return self._call(("run", os.path.abspath(filepath), code))
+
+    def preload(self, filepath: str):
+        """Load a dataset into every worker ahead of its first query
+
+        All workers are taken at once (waiting for busy ones), so each gets it.
+        """
+        message = ("load", os.path.abspath(filepath))
+        with self._preload_lock:
+            workers = [self.idle.get() for _ in range(self.size)]
+        errors: List[Exception] = []
+
+        def load(worker: _Worker):
+            try:
+                self._exchange(worker, message)
+            except SandboxError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=load, args=(worker,), daemon=True) for worker in workers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+    def get_stats(self):
+        with self._stats_lock:
+            return {
+                "workers": self.size,
+                "idle": self.idle.qsize(),
+                "timeout_seconds": self.timeout,
+                "memory_limit_bytes": self.memory_bytes,
+                "data_limit_bytes": self.data_limit_bytes if resource is not None else None,
+                "runs": self.runs,
+                "timeouts": self.timeouts,
+                "memory_kills": self.memory_kills,
+                "crashes": self.crashes,
+                "replacements": self.replacements
+            }
+
+
+_pool: Optional[SandboxPool] = None
+_pool_pid: Optional[int] = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> Optional[SandboxPool]:
+    """This process's sandbox pool, or None when SANDBOX_WORKERS=0"""
+    global _pool, _pool_pid
+    size = int(os.getenv("SANDBOX_WORKERS", "2"))
+    if size <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = SandboxPool(
+                size=size,
+                timeout=float(os.getenv("SANDBOX_TIMEOUT_SECONDS", "30")),
+                memory_mb=float(os.getenv("SANDBOX_MEMORY_MB", "1024")),
+                dataset_cache_mb=float(os.getenv("SANDBOX_DATASET_CACHE_MB", "256"))
+            )
+            _pool_pid = os.getpid()
+        return _pool
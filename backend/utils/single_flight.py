@@ -0,0 +1,148 @@
+"""
+Single-flight coalescing of identical in-flight work
+Concurrent callers with the same key share one computation. Within a process
+followers wait on the leader's result directly; across processes a lease row
+in SQLite marks the leader and followers poll a lookup (e.g. the shared
+response cache) until its result lands.
+"""
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """Run fn once per key at a time; duplicates get the same result"""
+
+    def __init__(self, path: Optional[str] = None, timeout: Optional[float] = None, poll_interval: float = 0.1):
+        # path=None coalesces within this process only
+        self.path = path
+        self.timeout = timeout if timeout is not None else float(os.getenv("SINGLE_FLIGHT_TIMEOUT", "120"))
+        self.poll_interval = poll_interval
+        self.flights: Dict[str, _Flight] = {}
+        self.leaders = 0
+        self.coalesced = 0
+        self.coalesced_remote = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        if self.path:
+            self._connect().execute("""
+                CREATE TABLE IF NOT EXISTS inflight (
+                    key TEXT PRIMARY KEY,
+                    owner TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            """)
+
+    def _connect(self) -> sqlite3.Connection:
+        """One connection per thread (and per process after a fork)"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _owner(self) -> str:
+        return f"{os.getpid()}:{id(self)}"
+
+    def _claim(self, key: str) -> bool:
+        """Take the cross-process lease for key unless a live leader holds it"""
+        if not self.path:
+            return True
+        now = time.time()
+        conn = self._connect()
+        conn.execute("DELETE FROM inflight WHERE key = ? AND expires_at < ?", (key, now))
+        cursor = conn.execute(
+            "INSERT OR IGNORE INTO inflight (key, owner, expires_at) VALUES (?, ?, ?)",
+            (key, self._owner(), now + self.timeout)
+        )
+        return cursor.rowcount == 1
+
+    def _release(self, key: str):
+        if self.path:
+            self._connect().execute("DELETE FROM inflight WHERE key = ? AND owner = ?", (key, self._owner()))
+
+    def _leased(self, key: str) -> bool:
+        row = self._connect().execute(
+            "SELECT 1 FROM inflight WHERE key = ? AND expires_at >= ?", (key, time.time())
+        ).fetchone()
+        return row is not None
+
+    def _wait_remote(self, key: str, lookup: Callable[[], Any]) -> Any:
+        """Poll lookup while another process leads; None if it gave up without a result"""
+        deadline = time.monotonic() + self.timeout
+        while time.monotonic() < deadline:
+            result = lookup()
+            if result is not None:
+                return result
+            if not self._leased(key):
+                # Leader finished (or died) without storing anything
+                return lookup()
+            time.sleep(self.poll_interval)
+        return None
+
+    def do(self, key: str, fn: Callable[[], Any],
+           lookup: Optional[Callable[[], Any]] = None) -> Tuple[Any, bool]:
+        """Return (result, coalesced); fn runs only if no identical call is in flight
+
+        lookup fetches the result a leader in another process has published;
+        without it only callers in this process are coalesced.
+        """
+        with self._lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = _Flight()
+
+        if not leader:
+            if flight.done.wait(self.timeout) and flight.error is None:
+                with self._lock:
+                    self.coalesced += 1
+                return flight.result, True
+            # Leader failed or timed out: compute independently
+            return fn(), False
+
+        try:
+            if lookup is not None and not self._claim(key):
+                result = self._wait_remote(key, lookup)
+                if result is not None:
+                    with self._lock:
+                        self.coalesced_remote += 1
+                    flight.result = result
+                    return result, True
+                self._claim(key)
+
+            with self._lock:
+                self.leaders += 1
+            try:
+                flight.result = fn()
+            finally:
+                self._release(key)
+            return flight.result, False
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            flight.done.set()
+            with self._lock:
+                self.flights.pop(key, None)
+
+    def get_stats(self) -> Dict[str, int]:
+        """Coalescing counters for this process"""
+        with self._lock:
+            return {
+                "in_flight": len(self.flights),
+                "leaders": self.leaders,
+                "coalesced": self.coalesced,
+                "coalesced_remote": self.coalesced_remote
+            }
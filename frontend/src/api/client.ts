@@ -6,3 +6,78 @@ export const buildApiUrl = (path: string) => {
   const cleanedPath = path.startsWith("/") ? path : `/${path}`
   return `${base}${cleanedPath}`
 }
+
+export type QueryStreamPayload = Record<string, unknown>
+
+export interface QueryStreamHandlers {
+  onPlan?: (payload: QueryStreamPayload) => void
+  onData?: (payload: QueryStreamPayload) => void
+  onChart?: (payload: QueryStreamPayload) => void
+  onDone?: (payload: QueryStreamPayload) => void
+}
+
+// Parse one SSE message ("event: x\ndata: {...}") into its name and JSON payload.
+const parseEvent = (block: string) => {
+  let event = "message"
+  const dataLines: string[] = []
+  for (const line of block.split("\n")) {
+    if (line.startsWith("event:")) event = line.slice(6).trim()
+    else if (line.startsWith("data:")) dataLines.push(line.slice(5).trimStart())
+  }
+  if (!dataLines.length) return null
+  return { event, payload: JSON.parse(dataLines.join("\n")) as QueryStreamPayload }
+}
+
+// POST a query to /api/query/stream and call the handlers as each stage arrives.
+// Rejects with the backend's message on a failed request or an "error" event.
+export const streamQuery = async (
+  body: Record<string, unknown>,
+  handlers: QueryStreamHandlers,
+  signal?: AbortSignal
+) => {
+  const response = await fetch(buildApiUrl("/api/query/stream"), {
+    method: "POST",
+    headers: { "Content-Type": "application/json", Accept: "text/event-stream" },
+    body: JSON.stringify(body),
+    signal
+  })
+
+  if (!response.ok || !response.body) {
+    let message = `Request failed (${response.status})`
+    try {
+      const data = (await response.json()) as { error?: string }
+      if (data.error) message = data.error
+    } catch {
+      // keep the status-based message
+    }
+    throw new Error(message)
+  }
+
+  const dispatch = (block: string) => {
+    const parsed = parseEvent(block)
+    if (!parsed) return
+    const { event, payload } = parsed
+    if (event === "error") throw new Error(String(payload.error ?? "The request failed."))
+    if (event === "plan") handlers.onPlan?.(payload)
+    else if (event === "data") handlers.onData?.(payload)
+    else if (event === "chart") handlers.onChart?.(payload)
+    else if (event === "done") handlers.onDone?.(payload)
+  }
+
+  const reader = response.body.getReader()
+  const decoder = new TextDecoder()
+  let buffer = ""
+  for (;;) {
+    const { value, done } = await reader.read()
+    if (done) break
+    buffer += decoder.decode(value, { stream: true })
+    let boundary = buffer.indexOf("\n\n")
+    while (boundary !== -1) {
+      dispatch(buffer.slice(0, boundary))
+      buffer = buffer.slice(boundary + 2)
+      boundary = buffer.indexOf("\n\n")
+    }
+  }
+  buffer += decoder.decode()
+  if (buffer.trim()) dispatch(buffer)
+}
@@ -1,5 +1,5 @@
 import Plot from "react-plotly.js"
-import type { Config, Layout, PlotData, Frame } from "plotly.js"
+import type { Config, Layout, LayoutAxis, PlotData, Frame } from "plotly.js"
 
 type PlotlyFigure = {
   data?: PlotData[]
@@ -8,20 +8,116 @@ type PlotlyFigure = {
   config?: Partial<Config>
 }
 
-const ChartRenderer = ({ figure }: { figure?: PlotlyFigure | null }) => {
-  if (!figure || !figure.data) return null
+// Compact chart from the backend (chart_format "spec"): columns plus how to draw them.
+// Numeric columns arrive as typed arrays ({dtype, bdata}), which plotly.js decodes itself.
+type ChartSpec = {
+  format: "spec"
+  type: "bar" | "line" | "scatter" | "pie"
+  template: string
+  title: string
+  height: number
+  x: string
+  y: string[]
+  x_title: string
+  y_title: string
+  columns: Record<string, unknown>
+  trendline?: { x: number[]; y: number[] }
+}
+
+const PLOTLY_COLORWAY = [
+  "#636efa", "#EF553B", "#00cc96", "#ab63fa", "#FFA15A",
+  "#19d3f3", "#FF6692", "#B6E880", "#FF97FF", "#FECB52"
+]
+
+const WHITE_AXIS: Partial<LayoutAxis> = {
+  gridcolor: "#EBF0F8",
+  linecolor: "#EBF0F8",
+  zerolinecolor: "#EBF0F8",
+  zerolinewidth: 2,
+  ticks: "",
+  automargin: true
+}
+
+// plotly.js ships no named templates; these mirror the parts of plotly.py's that charts use.
+const TEMPLATES: Record<string, Partial<Layout>> = {
+  plotly_white: {
+    colorway: PLOTLY_COLORWAY,
+    font: { color: "#2a3f5f" },
+    paper_bgcolor: "white",
+    plot_bgcolor: "white",
+    hoverlabel: { align: "left" },
+    xaxis: WHITE_AXIS,
+    yaxis: WHITE_AXIS
+  }
+}
+
+const isSpec = (figure: unknown): figure is ChartSpec =>
+  !!figure && typeof figure === "object" && (figure as { format?: unknown }).format === "spec"
+
+const specTraces = (spec: ChartSpec): Partial<PlotData>[] => {
+  // Typed array specs are valid trace data for plotly.js, not for its typings
+  const column = (name: string) => spec.columns[name] as PlotData["x"]
+  const x = column(spec.x)
+  const y = column(spec.y[0])
+
+  switch (spec.type) {
+    case "bar":
+      return [{ type: "bar", x, y, name: "", showlegend: false }]
+    case "line":
+      if (spec.y.length > 1) {
+        return spec.y.map((name) => ({
+          type: "scatter", mode: "lines+markers", x, y: column(name), name, line: { width: 2 }
+        }))
+      }
+      return [{ type: "scatter", mode: "lines+markers", x, y, name: "", showlegend: false }]
+    case "scatter": {
+      const traces: Partial<PlotData>[] = [
+        { type: "scatter", mode: "markers", x, y, opacity: 0.6, marker: { size: 5 }, name: "", showlegend: false }
+      ]
+      if (spec.trendline) {
+        traces.push({
+          type: "scatter", mode: "lines", x: spec.trendline.x, y: spec.trendline.y,
+          name: "OLS trendline", showlegend: false, line: { color: PLOTLY_COLORWAY[0] }
+        })
+      }
+      return traces
+    }
+    case "pie":
+      return [{ type: "pie", labels: x as PlotData["labels"], values: y as PlotData["values"] }]
+  }
+}
+
+const specToFigure = (spec: ChartSpec): PlotlyFigure => {
+  const template = TEMPLATES[spec.template] ?? {}
+  return {
+    data: specTraces(spec) as PlotData[],
+    layout: {
+      ...template,
+      title: { text: spec.title, x: 0.05 },
+      height: spec.height,
+      showlegend: true,
+      hovermode: spec.type === "line" && spec.y.length > 1 ? "x unified" : "closest",
+      xaxis: { ...template.xaxis, title: { text: spec.x_title } },
+      yaxis: { ...template.yaxis, title: { text: spec.y_title } }
+    }
+  }
+}
+
+const ChartRenderer = ({ figure }: { figure?: PlotlyFigure | ChartSpec | null }) => {
+  const resolved = isSpec(figure) ? specToFigure(figure) : figure
+  if (!resolved || !resolved.data) return null
 
   return (
     <div className="mt-4 rounded-2xl border border-border bg-panel p-3">
       <Plot
-        data={figure.data}
+        data={resolved.data}
         layout={{
-          ...(figure.layout ?? {}),
+          ...(resolved.layout ?? {}),
           autosize: true,
-          margin: { l: 40, r: 20, t: 40, b: 40, ...(figure.layout?.margin ?? {}) }
+          margin: { l: 40, r: 20, t: 40, b: 40, ...(resolved.layout?.margin ?? {}) }
         }}
-        frames={figure.frames}
-        config={{ responsive: true, displayModeBar: false, ...(figure.config ?? {}) }}
+        frames={resolved.frames}
+        config={{ responsive: true, displayModeBar: false, ...(resolved.config ?? {}) }}
         style={{ width: "100%", height: "100%" }}
         useResizeHandler
       />
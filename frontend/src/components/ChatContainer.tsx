@@ -6,7 +6,8 @@ import { buildApiUrl } from "../api/client"
 import type { FileMetadata, FileStatus } from "../types"
 
 // Keep file validation aligned with the backend CSV/XLSX support.
-const MAX_FILE_MB = 10
+// VITE_MAX_FILE_SIZE (bytes) raises the cap; large CSVs are queried out of core.
+const MAX_FILE_MB = Number(import.meta.env.VITE_MAX_FILE_SIZE ?? 10 * 1024 * 1024) / (1024 * 1024)
 const ALLOWED_EXTENSIONS = ["csv", "xlsx"]
 
 const formatBytes = (bytes: number) => {
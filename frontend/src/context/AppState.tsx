@@ -10,15 +10,7 @@ import {
 } from "react"
 import type { ChatSession, FileMetadata, Message, Model } from "../types"
 import { MODEL_CATALOG, STARTER_MESSAGES } from "../data/seed"
-import { buildApiUrl } from "../api/client"
-
-type QueryResponse = {
-  success?: boolean
-  result?: unknown
-  plan?: unknown
-  chart?: unknown
-  error?: string
-}
+import { buildApiUrl, streamQuery } from "../api/client"
 
 interface AppState {
   models: Model[]
@@ -369,59 +361,42 @@ export const AppStateProvider = ({ children }: { children: ReactNode }) => {
         return
       }
 
+      const patchAssistant = (updates: Partial<Message>) =>
+        setMessages((prev) =>
+          prev.map((message) => (message.id === assistantId ? { ...message, ...updates } : message))
+        )
+
       try {
-        const response = await fetch(buildApiUrl("/api/query"), {
-          method: "POST",
-          headers: { "Content-Type": "application/json" },
-          body: JSON.stringify({
+        // Stages stream in as they finish: plan, then the table, then the chart.
+        let contentText = "No result returned."
+        await streamQuery(
+          {
             query: trimmed,
             model: selectedModelId,
-            filepath: latestFile.filepath
-          })
-        })
-
-        let data: QueryResponse | null = null
-
-        try {
-          data = (await response.json()) as QueryResponse
-        } catch {
-          data = null
-        }
-
-        if (!response.ok) {
-          const fallback = data?.error ?? `Request failed (${response.status})`
-          throw new Error(fallback)
-        }
-
-        if (data?.success === false) {
-          const fallback =
-            data?.error ?? (typeof data?.result === "string" ? data.result : "The request failed.")
-          throw new Error(fallback)
-        }
-
-        const rawResult = data?.result ?? "No result returned."
-        const contentText =
-          typeof rawResult === "string" ? rawResult : `\`\`\`json\n${JSON.stringify(rawResult, null, 2)}\n\`\`\``
-
-        let composed = contentText
-
-        const chartPayload = toChartPayload(data?.chart)
-        if (chartPayload) {
-          composed += `\n\nChart ready below.`
-        }
-
-        setMessages((prev) =>
-          prev.map((message) =>
-            message.id === assistantId
-              ? {
-                  ...message,
-                  content: composed,
-                  chart: chartPayload,
-                  isStreaming: false
-                }
-              : message
-          )
+            filepath: latestFile.filepath,
+            // Compact spec; ChartRenderer rebuilds the figure
+            chart_format: "spec"
+          },
+          {
+            onPlan: () => patchAssistant({ content: "Plan ready, running the analysis..." }),
+            onData: (payload) => {
+              const rawResult = payload.result ?? "No result returned."
+              contentText =
+                typeof rawResult === "string"
+                  ? rawResult
+                  : `\`\`\`json\n${JSON.stringify(rawResult, null, 2)}\n\`\`\``
+              patchAssistant({ content: contentText })
+            },
+            onChart: (payload) => {
+              const chartPayload = toChartPayload(payload.chart)
+              if (chartPayload) {
+                patchAssistant({ content: `${contentText}\n\nChart ready below.`, chart: chartPayload })
+              }
+            },
+            onDone: () => patchAssistant({ isStreaming: false })
+          }
         )
+        patchAssistant({ isStreaming: false })
       } catch (error) {
         const messageText = error instanceof Error ? error.message : "Something went wrong."
         const summarized = summarizeError(messageText, selectedModelId)